@@ -0,0 +1,388 @@
+"""Incremental aggregations for Dataset.group_by_and_aggregate and Dataset.aggregate.
+
+An Aggregator is updated one value at a time, so grouping only keeps one small accumulator per group rather than
+every value of the group. Accumulators of the same kind can be merged, which lets partial aggregates computed over
+separate parts of a dataset be combined. Missing values (None) are ignored.
+
+An Aggregator instance also serves as the prototype for the accumulators of each group, see Aggregator.new.
+"""
+import math
+
+
+class Aggregator(object):
+    """Base class for incremental aggregations"""
+
+    # true if the result depends on the order the values arrive in
+    order_sensitive = False
+
+    def new(self):
+        """Returns:
+            Aggregator: a new, empty accumulator with the same parameters as this one
+        """
+        return type(self)()
+
+    def update(self, value):
+        raise NotImplementedError
+
+    def merge(self, other):
+        """Adds the values seen by another accumulator of the same kind into this one. For order sensitive
+        aggregations, the other accumulator's values are treated as coming after this one's
+
+        Args:
+            other (Aggregator): the accumulator to merge in
+
+        Returns:
+            Aggregator: self
+        """
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return '{}()'.format(type(self).__name__)
+
+
+def exact_expansion(values):
+    """Returns:
+        list of float: a short list of non overlapping floats with the same exact sum as the values, so math.fsum
+            of it, together with other values, is correctly rounded. It is the sum itself if that is not finite
+    """
+    values = list(values)
+    partials = []
+    try:
+        # each pass peels off the correctly rounded value of what is left of the exact sum
+        while values:
+            total = math.fsum(values)
+            if not math.isfinite(total):
+                partials = [total]
+                break
+            if not total:
+                break
+            partials.append(total)
+            values.append(-total)
+    except (OverflowError, ValueError):
+        # infinities and nans have no exact expansion
+        partials = [sum(values[:len(values) - len(partials)])]
+    return partials
+
+
+class Sum(Aggregator):
+    """Sums values exactly, so the result is the correctly rounded total no matter what order the values were
+    added or merged in. Values are buffered and periodically folded into an exact expansion of the running total,
+    a short list of non overlapping floats, using math.fsum"""
+
+    BUFFER_SIZE = 128
+
+    def __init__(self):
+        self._partials = []
+        self._pending = []
+        self._integer = 0
+
+    def update(self, value):
+        if type(value) is int:
+            # integers are summed exactly by python itself
+            self._integer += value
+        elif value is not None:
+            pending = self._pending
+            pending.append(value)
+            if len(pending) >= self.BUFFER_SIZE:
+                self._fold()
+
+    def _fold(self):
+        self._partials = exact_expansion(self._partials + self._pending)
+        self._pending = []
+
+    def merge(self, other):
+        self._integer += other._integer
+        self._pending.extend(other._partials)
+        self._pending.extend(other._pending)
+        if len(self._pending) >= self.BUFFER_SIZE:
+            self._fold()
+        return self
+
+    def exact(self):
+        """Returns:
+            tuple of int, list of float: the sum of the int values, and an exact expansion of the sum of the rest,
+                which can be added to and subtracted from without rounding, see exact_expansion
+        """
+        return self._integer, exact_expansion(self._partials + self._pending)
+
+    def result(self):
+        if not self._partials and not self._pending:
+            return self._integer
+        if self._integer:
+            return math.fsum(self._partials + self._pending + [self._integer])
+        return math.fsum(self._partials + self._pending)
+
+
+class Count(Aggregator):
+    """Counts the values that are not missing"""
+
+    def __init__(self):
+        self.count = 0
+
+    def update(self, value):
+        if value is not None:
+            self.count += 1
+
+    def merge(self, other):
+        self.count += other.count
+        return self
+
+    def result(self):
+        return self.count
+
+
+class Min(Aggregator):
+    def __init__(self):
+        self.value = None
+
+    def update(self, value):
+        if value is not None and (self.value is None or value < self.value):
+            self.value = value
+
+    def merge(self, other):
+        self.update(other.value)
+        return self
+
+    def result(self):
+        return self.value
+
+
+class Max(Aggregator):
+    def __init__(self):
+        self.value = None
+
+    def update(self, value):
+        if value is not None and (self.value is None or value > self.value):
+            self.value = value
+
+    def merge(self, other):
+        self.update(other.value)
+        return self
+
+    def result(self):
+        return self.value
+
+
+class Mean(Aggregator):
+    """The exact sum of the values divided by their count, None if there are no values"""
+
+    def __init__(self):
+        self.sum = Sum()
+        self.count = 0
+
+    def update(self, value):
+        if value is not None:
+            self.sum.update(value)
+            self.count += 1
+
+    def merge(self, other):
+        self.sum.merge(other.sum)
+        self.count += other.count
+        return self
+
+    def result(self):
+        return self.sum.result() / self.count if self.count else None
+
+
+class Variance(Aggregator):
+    """The variance of the values, computed in one pass with Welford's algorithm. Partial variances are merged
+    with Chan et al.'s parallel formula"""
+
+    def __init__(self, sample=True):
+        """
+        Args:
+            sample (bool): if true, the sample variance (divided by n - 1), otherwise the population variance
+        """
+        self.sample = sample
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def new(self):
+        return Variance(sample=self.sample)
+
+    def update(self, value):
+        if value is not None:
+            self.count += 1
+            delta = value - self.mean
+            self.mean += delta / self.count
+            self.m2 += delta * (value - self.mean)
+
+    def merge(self, other):
+        if other.count:
+            count = self.count + other.count
+            delta = other.mean - self.mean
+            self.mean += delta * other.count / count
+            self.m2 += other.m2 + delta * delta * self.count * other.count / count
+            self.count = count
+        return self
+
+    def result(self):
+        denominator = self.count - 1 if self.sample else self.count
+        return self.m2 / denominator if denominator > 0 else None
+
+    def __repr__(self):
+        return 'Variance(sample={!r})'.format(self.sample)
+
+
+class Ratio(Aggregator):
+    """The exact sum of the numerators divided by the exact sum of the denominators, updated with (numerator,
+    denominator) pairs. Grouped ratio metrics such as ACoS are computed this way, rather than as the mean of
+    the per row ratios. None if the denominators sum to zero"""
+
+    def __init__(self):
+        self.numerator = Sum()
+        self.denominator = Sum()
+
+    def update(self, value):
+        numerator, denominator = value
+        self.numerator.update(numerator)
+        self.denominator.update(denominator)
+
+    def merge(self, other):
+        self.numerator.merge(other.numerator)
+        self.denominator.merge(other.denominator)
+        return self
+
+    def result(self):
+        denominator = self.denominator.result()
+        return self.numerator.result() / denominator if denominator else None
+
+
+class CountDistinct(Aggregator):
+    """Counts the distinct values exactly, holding each distinct value once"""
+
+    def __init__(self):
+        self.values = set()
+
+    def update(self, value):
+        if value is not None:
+            self.values.add(value)
+
+    def merge(self, other):
+        self.values |= other.values
+        return self
+
+    def result(self):
+        return len(self.values)
+
+
+class First(Aggregator):
+    """The first value that is not missing"""
+
+    order_sensitive = True
+
+    def __init__(self):
+        self.value = None
+
+    def update(self, value):
+        if self.value is None:
+            self.value = value
+
+    def merge(self, other):
+        self.update(other.value)
+        return self
+
+    def result(self):
+        return self.value
+
+
+class Last(Aggregator):
+    """The last value that is not missing"""
+
+    order_sensitive = True
+
+    def __init__(self):
+        self.value = None
+
+    def update(self, value):
+        if value is not None:
+            self.value = value
+
+    def merge(self, other):
+        self.update(other.value)
+        return self
+
+    def result(self):
+        return self.value
+
+
+class ListAggregator(Aggregator):
+    """Adapts a function of a list of values, such as the builtin sum, to the Aggregator interface by keeping
+    every value. Used when a callable is mixed with incremental aggregations in Dataset.aggregate"""
+
+    order_sensitive = True
+
+    def __init__(self, function):
+        self.function = function
+        self.values = []
+
+    def new(self):
+        return ListAggregator(self.function)
+
+    def update(self, value):
+        self.values.append(value)
+
+    def merge(self, other):
+        self.values.extend(other.values)
+        return self
+
+    def result(self):
+        return self.function(self.values)
+
+    def __repr__(self):
+        return 'ListAggregator({!r})'.format(self.function)
+
+
+def as_aggregator(aggregation):
+    """Returns:
+        Aggregator: a prototype accumulator for an Aggregator instance or subclass, or None for a plain callable
+    """
+    if isinstance(aggregation, Aggregator):
+        return aggregation
+    if isinstance(aggregation, type) and issubclass(aggregation, Aggregator):
+        return aggregation()
+    return None
+
+
+def resolve_aggregations(aggregations):
+    """Normalizes the aggregations passed to Dataset.aggregate
+
+    Args:
+        aggregations (iterable of tuple): (aggregate_column, aggregation) or (aggregate_column, aggregation,
+            output_column) tuples, where aggregation is an Aggregator or a function of a list of values. The output
+            column defaults to the aggregate column. The aggregate column can also be a list of columns, such as
+            the numerator and denominator columns of a Ratio, in which case the aggregation is given tuples of
+            their values and the output column must be passed
+
+    Returns:
+        list of tuple: (aggregate_column, prototype Aggregator, output_column) tuples, where list aggregate columns
+            are made tuples
+    """
+    resolved = []
+    for aggregation in aggregations:
+        aggregate_column, function = aggregation[0], aggregation[1]
+        if isinstance(aggregate_column, (list, tuple)):
+            aggregate_column = tuple(aggregate_column)
+            if len(aggregation) < 3:
+                raise ValueError('aggregations of several columns {} need an output column'.format(aggregate_column))
+        output_column = aggregation[2] if len(aggregation) > 2 else aggregate_column
+        prototype = as_aggregator(function)
+        if prototype is None:
+            prototype = ListAggregator(function)
+        resolved.append((aggregate_column, prototype, output_column))
+
+    output_columns = [output_column for _, _, output_column in resolved]
+    if len(set(output_columns)) != len(output_columns):
+        raise ValueError('output columns {} are not unique'.format(output_columns))
+    return resolved
+
+
+def aggregate_column_names(aggregate_column):
+    """Returns:
+        tuple of str: the column names read by an aggregation, see resolve_aggregations
+    """
+    return aggregate_column if isinstance(aggregate_column, tuple) else (aggregate_column,)
@@ -1,67 +1,308 @@
 import os
+from collections import Counter
+from aggregators import Count, CountDistinct, First, Last, Max, Mean, Min, Ratio, Sum, Variance
+from batch import result_key, scan_nodes, scan_of, shared_scans, source_key
 from dataset import Dataset
+from columnar import ColumnarDataset
+from expressions import METRICS, parse_expression
+from external import DEFAULT_SPILL_BYTES
+from joins import INNER
+from partitioned import data_size, open_reader
+from plan import Aggregate, Derive, ExecutionContext, Filter, Join, Limit, Scan, Sort, TopN, optimize
+from predicates import Between, Comparison, parse_predicate
+from profiling import HIT, MISS, Profiler
+from sketches import ApproxCountDistinct, ApproxQuantile, SampledQuantile
+from serialization import JSON, decode_cursor, request_key, serialize
 
 
 class DatasetAPI(object):
     """To be honest I wasnt sure if the API mentioned in the readme meant a RESTful API or
     an API represented by the Dataset object, in either case, this is an API spec that could be
-    wrapped by a service"""
+    wrapped by a service. service.DatasetService serves it over HTTP"""
     AGGREGATION_NAME_TO_FUNCTION = {
-        'sum': sum,
-        'max': max,
-        'min': min,
-        'average': lambda x: sum(x) / len(x) if x else None
+        'sum': Sum(),
+        'max': Max(),
+        'min': Min(),
+        'average': Mean(),
+        'mean': Mean(),
+        'count': Count(),
+        'count_distinct': CountDistinct(),
+        'variance': Variance(),
+        'first': First(),
+        'last': Last(),
+        'ratio': Ratio(),
+        'approx_count_distinct': ApproxCountDistinct(),
+        'approx_quantile': ApproxQuantile(),
+        'sampled_quantile': SampledQuantile(),
     }
 
-    def _parse_operations(self, operation_data, datasets):
-        """Parse the operation component of the dictionary"""
+    def __init__(self, columnar=False, cache=None, registry=None, executor=None, metrics=None, run_size=None,
+                 spill_bytes=DEFAULT_SPILL_BYTES):
+        """
+        Args:
+            columnar (bool): if true, loads datasets into column oriented storage, see ColumnarDataset
+            cache (DatasetCache): if passed, csvs are loaded through this cache instead of being parsed on every
+                request
+            registry (DatasetRegistry): if passed, csvs are loaded once into this registry and shared between
+                requests
+            executor (ParallelExecutor): if passed, scans, filters and aggregations are split into partitions that
+                run in worker processes, see the parallel module
+            metrics (MetricsHook): if passed, every request is profiled and its profile handed to this hook, see the
+                profiling module
+            run_size (int): if passed, sorts of a csv and joins with a csv larger than spill_bytes read it straight
+                into a sort on disk that holds run_size rows in memory at a time, rather than loading it first, see
+                the external module. Smaller csvs are loaded and then sorted or joined, see Dataset.sort_by and
+                Dataset.join. Not used with a cache or registry, whose datasets are loaded whole
+            spill_bytes (int): the size in bytes past which a csv, or the partitions of a partitioned dataset that
+                are read, is sorted or joined on disk
+        """
+        self.columnar = columnar
+        self.cache = cache
+        self.registry = registry
+        self.executor = executor
+        self.metrics = metrics
+        self.run_size = run_size
+        self.spill_bytes = spill_bytes
+
+    def _parse_operations(self, operation_data, plans):
+        """Parse the operation component of the dictionary into a node of its dataset's plan"""
         dataset_name = operation_data['dataset']
         operation_name = operation_data['operation_name']
         operation_args = operation_data['operation_args']
 
-        dataset = datasets[dataset_name]
+        plan = plans[dataset_name]
 
         # tbh this isnt the greatest solution, and there should be a more formal framework and system for this,
         # but this is the only way I can think of to support all of these operations
         if operation_name == 'equals_filter':
             column_name = operation_args['column_name']
             value = operation_args['value']
-            dataset = dataset.equals_filter(column_name, value)
+            plan = Filter(plan, Comparison(column_name, '==', value))
         elif operation_name == 'between_filter':
             column_name = operation_args['column_name']
             start = operation_args['start']
             end = operation_args['end']
-            dataset = dataset.between_filter(column_name, start, end)
+            plan = Filter(plan, Between(column_name, start, end))
+        elif operation_name == 'where':
+            predicate = parse_predicate(operation_args['predicate'])
+            plan = Filter(plan, predicate)
         elif operation_name == 'group_by_and_aggregate':
             group_by_columns = operation_args['group_by_columns']
             aggregate_column = operation_args['aggregate_column']
             aggregation = operation_args['aggregation']
-            aggregation = self.AGGREGATION_NAME_TO_FUNCTION[aggregation]
-            dataset = dataset.group_by_and_aggregate(group_by_columns, aggregate_column, aggregation)
+            aggregation = self._aggregation_function(aggregation, operation_args.get('aggregation_args'))
+            plan = Aggregate(plan, group_by_columns, [(aggregate_column, aggregation)])
+        elif operation_name == 'aggregate':
+            group_by_columns = operation_args['group_by_columns']
+            aggregations = [self._parse_aggregation(aggregation) for aggregation in operation_args['aggregations']]
+            plan = Aggregate(plan, group_by_columns, aggregations)
+        elif operation_name == 'derive':
+            column_name = operation_args['column_name']
+            expression = parse_expression(operation_args['expression'])
+            plan = Derive(plan, column_name, expression)
         elif operation_name == 'sort_by':
             column_name = operation_args['column_name']
-            dataset = dataset.sort_by(column_name)
+            plan = Sort(plan, column_name)
         elif operation_name == 'sort_by_desc':
             column_name = operation_args['column_name']
-            dataset = dataset.sort_by(column_name, reverse=True)
+            plan = Sort(plan, column_name, descending=True)
         elif operation_name == 'limit':
             value = operation_args['value']
-            dataset = dataset.limit(value)
+            plan = Limit(plan, value)
+        elif operation_name == 'top_n':
+            column_names = operation_args['column_names']
+            n = operation_args['n']
+            descending = operation_args.get('descending', False)
+            plan = TopN(plan, column_names, n, descending=descending)
         elif operation_name == 'inner_join':
             column_name = operation_args['column_name']
             other_dataset = operation_args['other_dataset']
-            dataset = dataset.inner_join(datasets[other_dataset], column_name)
+            plan = Join(plan, plans[other_dataset], column_name)
+        elif operation_name == 'join':
+            column_names = operation_args['column_names']
+            other_dataset = operation_args['other_dataset']
+            how = operation_args.get('how', INNER)
+            plan = Join(plan, plans[other_dataset], column_names, how=how)
         else:
             raise ValueError('Operation name {} is not supported'.format(operation_name))
 
-        return dataset
+        return plan
+
+    def _parse_aggregation(self, aggregation):
+        """Returns:
+            tuple: the aggregate column, aggregation and output column of one of the aggregations of an aggregate
+                operation. Metric names aggregate to the ratio of the sums of the metric's columns
+        """
+        name = aggregation['aggregation']
+        if name in METRICS:
+            return METRICS[name], Ratio(), aggregation.get('output_column', name)
+        column = aggregation['column']
+        if isinstance(column, list):
+            column = tuple(column)
+        function = self._aggregation_function(name, aggregation.get('args'))
+        return column, function, aggregation.get('output_column', column)
+
+    def _aggregation_function(self, name, args=None):
+        """Returns:
+            Aggregator: the aggregation of a name, made with the given keyword arguments if there are any, e.g.
+                {"q": 0.95} for the 95th percentile of approx_quantile
+        """
+        prototype = self.AGGREGATION_NAME_TO_FUNCTION[name]
+        if not args:
+            return prototype
+        try:
+            return type(prototype)(**args)
+        except TypeError as e:
+            raise ValueError('invalid arguments {} for aggregation {}: {}'.format(args, name, e))
+
+    def build_plans(self, payload):
+        """Compiles the operations of a request into an optimized plan for each returned dataset, see the plan
+        module. Nothing is loaded until the plans are executed
+
+        Args:
+            payload (dict): a request, see handle_request
+
+        Returns:
+            dict of str, PlanNode: the plan of each returned dataset
+        """
+        schemas = payload.get('schemas', {})
+        plans = {
+            dataset_name: Scan(dataset_name, csv_path, schema=schemas.get(dataset_name))
+            for dataset_name, csv_path in payload['datasets'].items()
+        }
+        for operation_data in payload['operations']:
+            plans[operation_data['dataset']] = self._parse_operations(operation_data, plans)
+
+        return {dataset_name: optimize(plans[dataset_name]) for dataset_name in payload['return']}
+
+    def explain(self, payload):
+        """Describes how a request would be run
+
+        Args:
+            payload (dict): a request, see handle_request
+
+        Returns:
+            str: the plan of each returned dataset
+        """
+        return '\n'.join('{}:\n{}'.format(dataset_name, plan.explain(indent=1))
+                         for dataset_name, plan in self.build_plans(payload).items())
+
+    def _dataset_class(self):
+        return ColumnarDataset if self.columnar else Dataset
+
+    def _load_aggregate(self, scan, group_by_columns, aggregations):
+        """Aggregates a csv in parallel as it is scanned, see ParallelExecutor.scan_aggregate"""
+        return self.executor.scan_aggregate(self._dataset_class(), scan.dataset_name, scan.csv_path,
+                                            group_by_columns, aggregations, columns=scan.projection,
+                                            predicate=scan.predicate, schema=scan.schema)
+
+    def _reader(self, scan):
+        return open_reader(scan.csv_path, columns=scan.projection, predicate=scan.predicate, limit=scan.limit,
+                           schema=scan.schema)
+
+    def _spills(self, scan):
+        """Returns:
+            bool: true if the scan reads more than spill_bytes of csv and may give more than run_size rows
+        """
+        if scan.limit is not None and scan.limit <= self.run_size:
+            return False
+        return data_size(scan.csv_path, scan.predicate) > self.spill_bytes
+
+    def _load_sorted(self, scan, column_name, descending):
+        """Sorts a csv on disk as it is scanned, see Dataset.from_sorted, unless it is small enough to load"""
+        if not self._spills(scan):
+            return None
+        return self._dataset_class().from_sorted(scan.dataset_name, self._reader(scan), column_name,
+                                                 reverse=descending, run_size=self.run_size)
+
+    def _load_join(self, left, right, column_names, how, ordered):
+        """Joins a csv on disk as it is scanned, see Dataset.from_join, unless every csv of the join is small enough
+        to load. The other side is a Scan or a Dataset"""
+        if not any(isinstance(side, Scan) and self._spills(side) for side in (left, right)):
+            return None
+        left_name = left.dataset_name if isinstance(left, Scan) else left.name
+        left, right = [self._reader(side) if isinstance(side, Scan) else side for side in (left, right)]
+        return self._dataset_class().from_join(left_name, left, right, column_names, how=how, run_size=self.run_size,
+                                               ordered=ordered)
+
+    def _load(self, dataset_name, csv_path, columns, predicate, schema, leases, limit=None, profiler=None):
+        """Loads a dataset from its csv, or from the registry or cache if there is one. Datasets acquired from the
+        registry are added to leases, and the profiler records whether the registry or cache had them"""
+        if self.registry is not None:
+            hits = self.registry.hits
+            dataset = self.registry.acquire(csv_path, name=dataset_name, schema=schema)
+            leases.append(dataset)
+            if profiler is not None:
+                profiler.annotate(cache=HIT if self.registry.hits > hits else MISS)
+        elif self.cache is not None:
+            hits = self.cache.hits
+            dataset = self.cache.load(csv_path, name=dataset_name, schema=schema)
+            if profiler is not None:
+                profiler.annotate(cache=HIT if self.cache.hits > hits else MISS)
+        elif self.executor is not None:
+            return self.executor.populate(self._dataset_class(), dataset_name, csv_path, limit=limit,
+                                          columns=columns, predicate=predicate, schema=schema)
+        else:
+            return self._dataset_class()(dataset_name).populate(csv_path, limit=limit, columns=columns,
+                                                                predicate=predicate, schema=schema)
+
+        if predicate is not None:
+            dataset = dataset.where(predicate)
+        if columns is not None:
+            dataset = dataset.select(columns)
+        if limit is not None:
+            dataset = dataset.limit(limit)
+        return dataset if self.columnar else dataset.to_rows()
+
+    def _profiler(self):
+        """Returns:
+            Profiler: a profiler for a request, if the metrics hook needs one
+        """
+        return Profiler(trace_memory=self.metrics.trace_memory) if self.metrics is not None else None
+
+    def _evaluate(self, plans, leases, profiler=None):
+        """Returns:
+            dict of str, Dataset: the result of each plan. Datasets acquired from the registry are added to leases
+        """
+        if profiler is None:
+            profiler = self._profiler()
+        # datasets shared through a registry or cache are loaded whole, so only plain csvs are aggregated as scanned
+        scanned = self.executor is not None and self.registry is None and self.cache is None
+        on_disk = self.run_size is not None and self.registry is None and self.cache is None
+        context = ExecutionContext(lambda scan: self._load(
+            scan.dataset_name, scan.csv_path, scan.projection, scan.predicate, scan.schema, leases, limit=scan.limit,
+            profiler=profiler
+        ), executor=self.executor, load_aggregate=self._load_aggregate if scanned else None, profiler=profiler,
+                                   load_sorted=self._load_sorted if on_disk else None,
+                                   load_join=self._load_join if on_disk else None)
+        return self._run(plans, context)
+
+    def _run(self, plans, context):
+        """Returns:
+            dict of str, Dataset: the result of each plan, evaluated in the context. The context's profiler, if any,
+                is handed to the metrics hook
+        """
+        profiler = context.profiler
+        if profiler is None:
+            return {dataset_name: context.evaluate(plan) for dataset_name, plan in plans.items()}
+
+        with profiler:
+            datasets = {dataset_name: context.evaluate(plan) for dataset_name, plan in plans.items()}
+        if self.metrics is not None:
+            self.metrics.observe(profiler)
+        return datasets
 
     def handle_request(self, payload):
         """Handle a request with the given API:
 
         {
           "datasets": {
-            <dataset_name>: <csv_path>
+            <dataset_name>: <csv_path, or the directory of a partitioned dataset, which reads back in csv order
+                             when the csv was grouped by its partition column, see the partitioned module>
+          },
+          "schemas": {
+            <optional, dataset_name>: "infer" or {<column name>: <column type, see the schema module>}. Without
+                one, numbers are floats and other cells strings, see Dataset.populate for what "infer" changes
           },
           "operations": [
             {
@@ -76,27 +317,164 @@ class DatasetAPI(object):
             <name of dataset to return>
           ]
 
+        The aggregate operation computes several aggregations in one pass, its aggregations argument is a list of
+        {"column": <column name>, "aggregation": <name>, "output_column": <optional, defaults to the column>},
+        where the aggregation names are the keys of AGGREGATION_NAME_TO_FUNCTION. The ratio aggregation takes a
+        list of two columns, and the names of the expressions.METRICS, such as "acos", aggregate to the ratio of
+        the sums of the metric's columns without needing a column.
+
+        An aggregation can also have "args", the keyword arguments of its Aggregator, which group_by_and_aggregate
+        takes as "aggregation_args". The approximate aggregations of the sketches module take these, e.g.
+        {"aggregation": "approx_quantile", "column": "cpc", "args": {"q": 0.95}}, or {"q": 0.5, "bound": "upper"}
+        for the upper end of the confidence interval of a sampled_quantile's median.
+
+        The top_n operation takes {"column_names": <column name or list of them>, "n": <int>, "descending": <bool>}.
+
+        The join operation joins on several columns or with other semantics than inner_join, its arguments are
+        {"other_dataset": <dataset name>, "column_names": <column name or list of them>, "how": "inner" | "left" |
+        "semi" | "anti"}, see Dataset.join.
+
+        The derive operation adds a computed column, its arguments are {"column_name": <new column name>,
+        "expression": <expression, see expressions.parse_expression>}.
+
+        The operations are compiled into a plan for each returned dataset, which is optimized and then run, see
+        build_plans. Operations on datasets that are not returned, or joined into one that is, are never run. With
+        an executor, scans, filters and aggregations run in parallel and give the same results
+
         Args:
             payload (dict): a dictionary with the above format
 
         Returns:
             dict: a mapping of the dataset name to its resulting value
         """
-        datasets = {}
-        for dataset_name, csv_path in payload['datasets'].items():
-            datasets[dataset_name] = Dataset(dataset_name).populate(csv_path)
+        return self._handle_request(payload)
 
-        for operation_data in payload['operations']:
-            dataset_name = operation_data['dataset']
-            datasets[dataset_name] = self._parse_operations(operation_data, datasets)
+    def handle_batch(self, payloads):
+        """Handles many requests, answering all of their scans of the same csv with one pass over it, see the batch
+        module. Without a registry or cache, each csv is read once however many requests read it, rather than once
+        per request, when the first request that reads it runs. With one, the requests already share their loads,
+        and are handled one at a time, as they are when a run_size is set and any csv of the batch is larger than
+        spill_bytes, so that it is sorted or joined on disk rather than loaded. Either way each request is profiled
+        for the metrics hook on its own, and a shared scan's result is released once the last request reading it
+        has been answered
+
+        Args:
+            payloads (list of dict): the requests, see handle_request
+
+        Returns:
+            list of dict: the result of each request, the same as handle_request gives
+        """
+        if self.registry is not None or self.cache is not None:
+            return [self.handle_request(payload) for payload in payloads]
+
+        all_plans = [self.build_plans(payload) for payload in payloads]
+        batch_plans = [plan for plans in all_plans for plan in plans.values()]
+        if self.run_size is not None and any(self._spills(scan_of(node)) for node in scan_nodes(batch_plans)):
+            return [self.handle_request(payload) for payload in payloads]
+        scans = shared_scans(batch_plans)
 
-        return {
-            datasets[dataset_name].name: {
-                'columns': datasets[dataset_name].columns,
-                'data': datasets[dataset_name].data
+        def shared(scan):
+            shared_scan = scans[source_key(scan)]
+            if not shared_scan.ran:
+                shared_scan.run(self._dataset_class())
+            return shared_scan
+
+        def load_aggregate(scan, group_by_columns, aggregations):
+            return shared(scan).aggregate(scan, group_by_columns, aggregations)
+
+        # the number of requests still to run that read each shared result
+        readers = Counter()
+        request_nodes = []
+        for plans in all_plans:
+            nodes = {result_key(node): node for node in scan_nodes(plans.values())}
+            readers.update(nodes.keys())
+            request_nodes.append(nodes)
+
+        results = []
+        for plans, nodes in zip(all_plans, request_nodes):
+            # each request is profiled on its own, like handle_request
+            context = ExecutionContext(lambda scan: shared(scan).load(scan), executor=self.executor,
+                                       load_aggregate=load_aggregate, profiler=self._profiler())
+            datasets = self._run(plans, context)
+            results.append({
+                dataset.name: {
+                    'columns': dataset.columns,
+                    'data': dataset.data
+                }
+                for dataset in datasets.values()
+            })
+            # the request's own references go before the shared results it was the last to read
+            del context, datasets
+            for key, node in nodes.items():
+                readers[key] -= 1
+                if not readers[key]:
+                    scans[source_key(scan_of(node))].release(node)
+        return results
+
+    def profile_request(self, payload, trace_memory=True):
+        """Handles a request, recording the time, rows and memory of each load and operation, see the profiling
+        module. The operations are the nodes of the optimized plans, see explain, so fused or pushed down
+        operations are recorded as part of the node they were merged into
+
+        Args:
+            payload (dict): see handle_request
+            trace_memory (bool): if true, the memory each node allocates is traced, which is slow
+
+        Returns:
+            dict: the result, see handle_request, and the profile, see Profiler.to_dict
+        """
+        profiler = Profiler(trace_memory=trace_memory)
+        result = self._handle_request(payload, profiler)
+        return {'result': result, 'profile': profiler.to_dict()}
+
+    def _handle_request(self, payload, profiler=None):
+        plans = self.build_plans(payload)
+        leases = []
+        try:
+            datasets = self._evaluate(plans, leases, profiler)
+            return {
+                dataset.name: {
+                    'columns': dataset.columns,
+                    'data': dataset.data
+                }
+                for dataset in datasets.values()
             }
-            for dataset_name in payload['return']
-        }
+        finally:
+            for dataset in leases:
+                self.registry.release(dataset)
+
+    def stream_request(self, payload, response_format=JSON, max_rows=None, cursor=None):
+        """Handles a request like handle_request, but encodes its result a block of rows or values at a time, see
+        the serialization module. Nothing runs until the first chunk is asked for
+
+        Args:
+            payload (dict): see handle_request
+            response_format (str): one of serialization.FORMATS, json has the layout handle_request returns
+            max_rows (int): if passed, the most rows of each returned dataset to include. Each dataset then has a
+                next_cursor for its following rows
+            cursor (str): the next_cursor of a dataset from an earlier response to the same payload, to return
+                that dataset's following rows alone
+
+        Yields:
+            bytes: the next chunk of the encoded result
+        """
+        key = request_key(payload)
+        plans = self.build_plans(payload)
+        offset = 0
+        if cursor is not None:
+            dataset_name, offset = decode_cursor(cursor, key)
+            if dataset_name not in plans:
+                raise ValueError('cursor {!r} is for dataset {}, which is not returned'.format(cursor, dataset_name))
+            plans = {dataset_name: plans[dataset_name]}
+
+        leases = []
+        try:
+            datasets = self._evaluate(plans, leases)
+            for chunk in serialize(datasets, response_format, max_rows=max_rows, key=key, offset=offset):
+                yield chunk
+        finally:
+            for dataset in leases:
+                self.registry.release(dataset)
 
 if __name__ == '__main__':
     api = DatasetAPI()
@@ -0,0 +1,184 @@
+"""Shared scans, which answer the scans of many requests over the same csv with one pass over it.
+
+DatasetAPI.handle_batch compiles every request of a batch into plans, and collects the scans of each csv, read with
+the same schema, into a SharedScan. Aggregations directly over a scan are collected with it, like the aggregations
+a ParallelExecutor runs as it scans. The shared scan parses each row once, with the union of the columns its
+scans read, and hands each chunk of rows to every scan and aggregation, which apply their own predicate, columns
+and limit. Aggregations only keep the accumulators of their groups. Identical scans and aggregations, such as those
+of repeated requests, are computed once.
+
+When every scan of a csv has a predicate, rows that pass none of them are dropped as they are read, and a
+partitioned dataset only reads the partitions that any of them may need.
+
+The requests' plans then run as usual, one request at a time, with their scans and scan aggregations answered from
+the shared scans, so each result is the same as handle_request would give. Each shared scan runs when the first
+request that reads its csv does, and a shared result is released once the last request that reads it has run.
+"""
+from aggregators import resolve_aggregations
+from dataset import Dataset, merge_groups
+from plan import Aggregate, Scan
+from predicates import Or
+from partitioned import open_reader
+from reader import DEFAULT_CHUNK_SIZE
+
+
+def source_key(scan):
+    """Returns:
+        tuple: identifies the scans that can share a pass, the csv and the schema it is parsed with
+    """
+    return scan.csv_path, repr(scan.schema)
+
+
+def aggregate_key(scan, group_by_columns, aggregations):
+    """Returns:
+        tuple: identifies an aggregation directly over a scan, see SharedScan.aggregate
+    """
+    return scan.key(), tuple(group_by_columns), repr(resolve_aggregations(aggregations))
+
+
+def is_scan_aggregate(node):
+    """Returns:
+        bool: true if the node is an aggregation that can be computed as its scan is read
+    """
+    return isinstance(node, Aggregate) and isinstance(node.child, Scan) and node.child.limit is None
+
+
+def scan_of(node):
+    """Returns:
+        Scan: the node if it is a Scan, or the scan an aggregation directly over one reads
+    """
+    return node if isinstance(node, Scan) else node.child
+
+
+def result_key(node):
+    """Returns:
+        tuple: identifies the result of a Scan, or of an aggregation directly over one, in its shared scan
+    """
+    if isinstance(node, Scan):
+        return node.key()
+    return aggregate_key(node.child, node.group_by_columns, node.aggregations)
+
+
+def scan_nodes(plans):
+    """Yields:
+        PlanNode: the scans and scan aggregations of plans, see is_scan_aggregate
+    """
+    for plan in plans:
+        if isinstance(plan, Scan) or is_scan_aggregate(plan):
+            yield plan
+        else:
+            for node in scan_nodes(plan.children):
+                yield node
+
+
+class SharedScan(object):
+    """The scans and scan aggregations of one csv, see the module docstring"""
+
+    def __init__(self, csv_path, schema=None):
+        """
+        Args:
+            csv_path (str): the path to the csv, or the directory of a partitioned dataset
+            schema (Schema or dict or str): the column types every scan parses with
+        """
+        self.csv_path = csv_path
+        self.schema = schema
+        # the scan and its rows so far, by the scan's key
+        self._scans = {}
+        # the scan, group by columns, aggregations and groups so far, by aggregate_key
+        self._aggregates = {}
+        self._results = {}
+        # whether run has read the csv yet
+        self.ran = False
+
+    def add(self, node):
+        """Adds a Scan, or an aggregation directly over one, see is_scan_aggregate"""
+        if isinstance(node, Scan):
+            self._scans.setdefault(result_key(node), [node, []])
+        else:
+            self._aggregates.setdefault(result_key(node), [node.child, node.group_by_columns,
+                                                           resolve_aggregations(node.aggregations), {}])
+
+    def _read(self, chunk_size):
+        """Returns:
+            CsvReader or PartitionedReader: reads the union of the columns of the scans, and the rows passing any
+                of their predicates
+        """
+        scans = [scan for scan, _ in self._scans.values()] + [scan for scan, _, _, _ in self._aggregates.values()]
+        required = set()
+        for scan in scans:
+            required.update(scan.columns())
+            if scan.predicate is not None:
+                required.update(scan.predicate.columns())
+        predicates = {repr(scan.predicate): scan.predicate for scan in scans}
+        predicate = None
+        if None not in predicates.values():
+            predicate = Or(*predicates.values()) if len(predicates) > 1 else next(iter(predicates.values()))
+        columns = [column_name for column_name in scans[0].header if column_name in required]
+        return open_reader(self.csv_path, columns=columns, predicate=predicate, chunk_size=chunk_size,
+                           schema=self.schema)
+
+    def run(self, dataset_class=Dataset, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Reads the csv once, computing the result of every scan and aggregation
+
+        Args:
+            dataset_class (type): Dataset or ColumnarDataset, the class of the results
+            chunk_size (int): the number of rows handed to the scans at a time
+        """
+        reader = self._read(chunk_size)
+        schema = reader.schema.select(reader.columns)
+        for chunk in reader:
+            dataset = Dataset('chunk', columns=reader.columns, data=chunk, schema=schema)
+            for scan, rows in self._scans.values():
+                if scan.limit is not None and len(rows) >= scan.limit:
+                    continue
+                part = dataset.where(scan.predicate) if scan.predicate is not None else dataset
+                rows.extend(part.select(scan.columns()).data)
+                if scan.limit is not None:
+                    del rows[scan.limit:]
+            for scan, group_by_columns, aggregations, groups in self._aggregates.values():
+                part = dataset.where(scan.predicate) if scan.predicate is not None else dataset
+                merge_groups(groups, part.partial_aggregate(group_by_columns, aggregations))
+
+        for key, (scan, rows) in self._scans.items():
+            self._results[key] = dataset_class.from_rows(scan.dataset_name, scan.columns(), rows,
+                                                         schema=reader.schema.select(scan.columns()))
+        for key, (scan, group_by_columns, aggregations, groups) in self._aggregates.items():
+            empty = dataset_class(scan.dataset_name, columns=scan.columns(),
+                                  schema=reader.schema.select(scan.columns()))
+            self._results[key] = empty.from_groups(group_by_columns, aggregations, groups)
+        self.ran = True
+
+    def load(self, scan):
+        """Returns:
+            Dataset: the result of a scan added to this shared scan, once it has run
+        """
+        return self._results[scan.key()]
+
+    def aggregate(self, scan, group_by_columns, aggregations):
+        """Returns:
+            Dataset: the result of an aggregation added to this shared scan, once it has run
+        """
+        return self._results[aggregate_key(scan, group_by_columns, aggregations)]
+
+    def release(self, node):
+        """Drops the result of a node added to this shared scan, once no request reads it any more"""
+        self._results.pop(result_key(node), None)
+
+
+def shared_scans(plans):
+    """Collects the scans and scan aggregations of plans into a shared scan per csv and schema
+
+    Args:
+        plans (iterable of PlanNode): the plans, of one or more requests
+
+    Returns:
+        dict of tuple, SharedScan: the shared scan of each source_key
+    """
+    scans = {}
+    for node in scan_nodes(plans):
+        scan = scan_of(node)
+        key = source_key(scan)
+        if key not in scans:
+            scans[key] = SharedScan(scan.csv_path, schema=scan.schema)
+        scans[key].add(node)
+    return scans
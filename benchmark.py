@@ -0,0 +1,278 @@
+"""Benchmarks of Dataset operations and DatasetAPI requests over synthetic reports, see synthetic.py.
+
+Each workload is run a number of times and reported with its throughput, in ad report rows per second at the
+median time, the p50, p90, p99 and max latencies in milliseconds, and the peak resident memory of the process it ran
+in. Workloads run one at a time in a fresh process, so that each one's peak memory is its own. Operations on loaded
+datasets are timed without loading them, which the populate and handle_request workloads measure.
+
+Results are saved as JSON, and compared against the results of an earlier run, the baseline. A workload regresses
+when its median latency or its peak memory grew by more than the threshold, and the script then exits with 1:
+
+    python benchmark.py --rows 1000000 --output baseline.json
+    python benchmark.py --rows 1000000 --baseline baseline.json --threshold 0.1
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+from aggregators import Sum
+from api import DatasetAPI
+from columnar import ColumnarDataset
+from dataset import Dataset
+from loadtest import percentile
+from synthetic import SyntheticReports
+
+DEFAULT_REPEATS = 5
+DEFAULT_THRESHOLD = 0.1
+# the days before the end of the reports that the filter workloads keep
+WINDOW_DAYS = 30
+
+
+def _load(dataset_class, paths, name):
+    return dataset_class(name).populate(paths[name])
+
+
+def _window(reports):
+    return (reports.end_date - timedelta(days=WINDOW_DAYS)).isoformat(), reports.end_date.isoformat()
+
+
+def _best_selling_payload(reports, paths):
+    start, end = _window(reports)
+    return {
+        'datasets': {'ad_report': paths['ad_report'], 'product_report': paths['product_report']},
+        'operations': [
+            {'dataset': 'ad_report', 'operation_name': 'between_filter',
+             'operation_args': {'column_name': 'date', 'start': start, 'end': end}},
+            {'dataset': 'ad_report', 'operation_name': 'group_by_and_aggregate',
+             'operation_args': {'group_by_columns': ['asin'], 'aggregate_column': 'sales', 'aggregation': 'sum'}},
+            {'dataset': 'ad_report', 'operation_name': 'sort_by_desc', 'operation_args': {'column_name': 'sales'}},
+            {'dataset': 'ad_report', 'operation_name': 'limit', 'operation_args': {'value': 1}},
+            {'dataset': 'ad_report', 'operation_name': 'inner_join',
+             'operation_args': {'column_name': 'asin', 'other_dataset': 'product_report'}},
+        ],
+        'return': ['ad_report'],
+    }
+
+
+def _populate(reports, paths, dataset_class, loaded):
+    return lambda: _load(dataset_class, paths, 'ad_report')
+
+
+def _between_filter(reports, paths, dataset_class, loaded):
+    ad_report, (start, end) = loaded('ad_report'), _window(reports)
+    return lambda: ad_report.between_filter('date', start, end)
+
+
+def _group_by_and_aggregate(reports, paths, dataset_class, loaded):
+    ad_report = loaded('ad_report')
+    return lambda: ad_report.group_by_and_aggregate(['asin'], 'sales', Sum())
+
+
+def _sort_by_limit(reports, paths, dataset_class, loaded):
+    ad_report = loaded('ad_report')
+    return lambda: ad_report.sort_by('sales', reverse=True).limit(10)
+
+
+def _inner_join(reports, paths, dataset_class, loaded):
+    ad_report, product_report = loaded('ad_report'), loaded('product_report')
+    return lambda: ad_report.inner_join(product_report, 'asin')
+
+
+def _handle_request(reports, paths, dataset_class, loaded):
+    api, payload = DatasetAPI(columnar=dataset_class is ColumnarDataset), _best_selling_payload(reports, paths)
+    return lambda: api.handle_request(payload)
+
+
+# each workload sets up its datasets and returns the operation to time
+WORKLOADS = {
+    'populate': _populate,
+    'between_filter': _between_filter,
+    'group_by_and_aggregate': _group_by_and_aggregate,
+    'sort_by_limit': _sort_by_limit,
+    'inner_join': _inner_join,
+    'handle_request': _handle_request,
+}
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)
+
+
+def run_workload(name, reports, paths, columnar=False, repeats=DEFAULT_REPEATS):
+    """Times one workload
+
+    Args:
+        name (str): one of the WORKLOADS
+        reports (SyntheticReports): the settings the reports were written with
+        paths (dict of str, str): the path of each report, see SyntheticReports.write
+        columnar (bool): if true, datasets are loaded into ColumnarDatasets
+        repeats (int): the number of times the workload is timed
+
+    Returns:
+        dict: the rows, repeats, median seconds, rows per second, latency percentiles and peak memory of the workload
+    """
+    if name not in WORKLOADS:
+        raise ValueError('workload {} does not exist'.format(name))
+    dataset_class = ColumnarDataset if columnar else Dataset
+    datasets = {}
+
+    def loaded(dataset_name):
+        if dataset_name not in datasets:
+            datasets[dataset_name] = _load(dataset_class, paths, dataset_name)
+        return datasets[dataset_name]
+
+    operation = WORKLOADS[name](reports, paths, dataset_class, loaded)
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        operation()
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    result = {'rows': reports.rows, 'repeats': repeats}
+    result.update(summarize(latencies))
+    result['seconds'] = result['p50_ms'] / 1000
+    result['rows_per_second'] = reports.rows / result['seconds'] if result['seconds'] else None
+    result['peak_rss_mb'] = _peak_rss_mb()
+    return result
+
+
+def summarize(latencies):
+    """Summarizes the latencies of a workload, the p50 being the median, which is the mean of the two middle
+    latencies when there is an even number of them
+
+    Args:
+        latencies (list of float): the latencies in milliseconds
+
+    Returns:
+        dict: the p50, p90, p99 and max latencies
+    """
+    latencies = sorted(latencies)
+    return {
+        'p50_ms': statistics.median(latencies),
+        'p90_ms': percentile(latencies, 90),
+        'p99_ms': percentile(latencies, 99),
+        'max_ms': latencies[-1],
+    }
+
+
+def run(reports, directory, workloads=None, columnar=False, repeats=DEFAULT_REPEATS, isolate=True):
+    """Writes the reports, unless they already are, and runs the workloads over them
+
+    Args:
+        reports (SyntheticReports): the settings of the reports
+        directory (str): the directory of the reports
+        workloads (list of str): the WORKLOADS to run, all of them by default
+        columnar (bool): if true, datasets are loaded into ColumnarDatasets
+        repeats (int): the number of times each workload is timed
+        isolate (bool): if true, each workload runs in a fresh process so its peak memory is its own
+
+    Returns:
+        dict: the config of the run, and the results of each workload, see run_workload
+    """
+    config = dict(reports.config(), columnar=columnar, repeats=repeats, python=platform.python_version())
+    config_path = os.path.join(directory, 'config.json')
+    try:
+        with open(config_path) as config_file:
+            written = json.load(config_file) == reports.config()
+    except (OSError, ValueError):
+        written = False
+    if not written:
+        paths = reports.write(directory)
+        with open(config_path, 'w') as config_file:
+            json.dump(reports.config(), config_file)
+    else:
+        paths = {os.path.splitext(file_name)[0]: os.path.join(directory, file_name)
+                 for file_name in os.listdir(directory) if file_name.endswith('.csv')}
+
+    results = {}
+    for name in workloads or list(WORKLOADS):
+        if isolate:
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                results[name] = pool.submit(run_workload, name, reports, paths, columnar, repeats).result()
+        else:
+            results[name] = run_workload(name, reports, paths, columnar, repeats)
+    return {'config': config, 'workloads': results}
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """Finds the workloads that got slower or bigger than in a baseline
+
+    Args:
+        results (dict): the results of a run, see run
+        baseline (dict): the results of an earlier run with the same reports
+        threshold (float): the fraction a median latency or peak memory may grow by before it is a regression
+
+    Returns:
+        list of dict: the workload, metric, baseline and current values and relative change of each regression
+    """
+    ignored = ('python',)
+    if {k: v for k, v in results['config'].items() if k not in ignored} != \
+            {k: v for k, v in baseline['config'].items() if k not in ignored}:
+        raise ValueError('the baseline was run with a different config: {}'.format(baseline['config']))
+
+    regressions = []
+    for name, result in results['workloads'].items():
+        before = baseline['workloads'].get(name)
+        if before is None:
+            continue
+        for metric in ('p50_ms', 'peak_rss_mb'):
+            if before[metric] and result[metric] > before[metric] * (1 + threshold):
+                regressions.append({
+                    'workload': name,
+                    'metric': metric,
+                    'baseline': before[metric],
+                    'current': result[metric],
+                    'change': result[metric] / before[metric] - 1,
+                })
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks Dataset operations over synthetic reports')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--asins', type=int, default=1000)
+    parser.add_argument('--keywords', type=int, default=5000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--skew', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--columnar', action='store_true', help='load datasets into column oriented storage')
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS)
+    parser.add_argument('--workloads', nargs='+', choices=list(WORKLOADS), default=None)
+    parser.add_argument('--data-dir', default=None,
+                        help='where the reports are written, and reused from by runs with the same settings')
+    parser.add_argument('--output', default=None, help='a path to save the results to')
+    parser.add_argument('--baseline', default=None, help='the saved results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args()
+
+    reports = SyntheticReports(rows=args.rows, asins=args.asins, keywords=args.keywords, days=args.days,
+                               skew=args.skew, seed=args.seed)
+    if args.data_dir is not None:
+        results = run(reports, args.data_dir, args.workloads, args.columnar, args.repeats)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            results = run(reports, directory, args.workloads, args.columnar, args.repeats)
+
+    print(json.dumps(results, indent=2))
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        for regression in regressions:
+            print('regression: {workload} {metric} {baseline:.1f} -> {current:.1f} (+{change:.0%})'
+                  .format(**regression))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,252 @@
+"""A persistent cache of parsed datasets.
+
+The first load of a csv parses it into a ColumnarDataset and writes its columns to a binary cache file. Later
+loads memory map that file, and numeric columns and dictionary codes are used straight from the mapped pages
+without being copied. A cache file is reused for as long as its csv has the same modification time and size,
+or failing that the same content hash.
+
+Cache file layout:
+    MAGIC
+    the csv's mtime in ns, the csv's size and the header length, see _STAT
+    a json header describing the columns and where their buffers start
+    padding to ALIGNMENT, then each column buffer, each padded to ALIGNMENT
+"""
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import struct
+import sys
+import tempfile
+from array import array
+from datetime import date
+
+from columnar import ColumnarDataset, DictionaryColumn, NumericColumn, ObjectColumn, typecode
+from schema import Schema
+
+MAGIC = b'TKMC\x00\x00\x00\x01'
+# the source stat is a fixed size field so that it can be updated in place
+_STAT = struct.Struct('<qqQ')
+ALIGNMENT = 8
+CACHE_EXTENSION = '.tkc'
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def hash_file(path):
+    """Returns:
+        str: the sha1 of the file's content
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as source_file:
+        for block in iter(lambda: source_file.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _aligned(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class DatasetCache(object):
+    """A directory of cache files, one per csv and schema, with a total size limit. When the limit is exceeded
+    the least recently used files are deleted"""
+
+    def __init__(self, directory, max_bytes=None, verify_hash=False):
+        """
+        Args:
+            directory (str): the directory the cache files are kept in, created if it does not exist
+            max_bytes (int): if passed, the total size the cache files are kept under
+            verify_hash (bool): if true, the csv's content hash is checked on every load, not only when its
+                modification time or size has changed
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.verify_hash = verify_hash
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def cache_path(self, csv_path, schema=None):
+        """Returns:
+            str: the path of the cache file for the csv when parsed with the given schema
+        """
+        key = json.dumps([os.path.abspath(csv_path), repr(schema)])
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + CACHE_EXTENSION)
+
+    def load(self, csv_path, name=None, schema=None):
+        """Loads a csv from its cache file, parsing it and writing the cache file first if needed
+
+        Args:
+            csv_path (str): the path to the csv
+            name (str): the name of the dataset, defaults to the csv's file name
+            schema (Schema or dict or str): the column types to parse with, see Dataset.populate
+
+        Returns:
+            ColumnarDataset: the loaded dataset
+        """
+        if name is None:
+            name = os.path.splitext(os.path.basename(csv_path))[0]
+        path = self.cache_path(csv_path, schema)
+
+        dataset = self._read(path, csv_path, name)
+        if dataset is not None:
+            self.hits += 1
+            # the cache file's modification time is its last use, for least recently used eviction
+            os.utime(path)
+            return dataset
+
+        self.misses += 1
+        source_stat = os.stat(csv_path)
+        dataset = ColumnarDataset(name).populate(csv_path, schema=schema)
+        self._write(path, source_stat, hash_file(csv_path), dataset)
+        self._evict(keep=path)
+        return dataset
+
+    def _read(self, path, csv_path, name):
+        """Returns:
+            ColumnarDataset: the dataset in the cache file, or None if it is missing or out of date
+        """
+        try:
+            cache_file = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+
+        with cache_file:
+            try:
+                if cache_file.read(len(MAGIC)) != MAGIC:
+                    return None
+                mtime_ns, size, header_length = _STAT.unpack(cache_file.read(_STAT.size))
+                header = json.loads(cache_file.read(header_length).decode())
+            except (struct.error, ValueError):
+                return None
+
+            source_stat = os.stat(csv_path)
+            if source_stat.st_size != size:
+                return None
+            if source_stat.st_mtime_ns != mtime_ns or self.verify_hash:
+                if hash_file(csv_path) != header['source_hash']:
+                    return None
+                self._update_stat(path, source_stat, header_length)
+
+            if header['byteorder'] != sys.byteorder or any(
+                    array(code).itemsize != itemsize for code, itemsize in header['itemsizes'].items()):
+                return None
+
+            buffer = memoryview(mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+        start = _aligned(len(MAGIC) + _STAT.size + header_length)
+        column_data = []
+        for layout in header['column_data']:
+            offset = start + layout['offset']
+            column_buffer = buffer[offset:offset + layout['length']]
+            if layout['kind'] == 'numeric':
+                column_data.append(NumericColumn(column_buffer.cast(layout['typecode'])))
+            elif layout['kind'] == 'dictionary':
+                dictionary = layout['dictionary']
+                if layout['dictionary_type'] == 'date':
+                    dictionary = [date.fromisoformat(value) for value in dictionary]
+                column_data.append(DictionaryColumn(column_buffer.cast(layout['typecode']), dictionary))
+            else:
+                column_data.append(ObjectColumn(pickle.loads(column_buffer)))
+
+        schema = Schema(header['schema'], inferred=header['inferred'], legacy=header.get('legacy', ()))
+        return ColumnarDataset(name, columns=header['columns'], column_data=column_data, schema=schema)
+
+    def _update_stat(self, path, source_stat, header_length):
+        """Records a csv's new modification time after its content was found to be unchanged"""
+        with open(path, 'r+b') as cache_file:
+            cache_file.seek(len(MAGIC))
+            cache_file.write(_STAT.pack(source_stat.st_mtime_ns, source_stat.st_size, header_length))
+
+    def _write(self, path, source_stat, source_hash, dataset):
+        layouts = []
+        buffers = []
+        itemsizes = {}
+        offset = 0
+        for column in dataset.column_data:
+            if isinstance(column, NumericColumn):
+                layout = {'kind': 'numeric', 'typecode': typecode(column.values)}
+                buffer = memoryview(column.values).cast('B')
+            elif isinstance(column, DictionaryColumn) and all(type(value) in (str, date)
+                                                              for value in column.dictionary):
+                is_date = bool(column.dictionary) and type(column.dictionary[0]) is date
+                layout = {
+                    'kind': 'dictionary',
+                    'typecode': typecode(column.values),
+                    'dictionary_type': 'date' if is_date else 'str',
+                    'dictionary': [value.isoformat() for value in column.dictionary] if is_date else column.dictionary
+                }
+                buffer = memoryview(column.values).cast('B')
+            else:
+                layout = {'kind': 'pickle'}
+                buffer = pickle.dumps(column.to_list(), protocol=pickle.HIGHEST_PROTOCOL)
+            if 'typecode' in layout:
+                itemsizes[layout['typecode']] = array(layout['typecode']).itemsize
+
+            layout['offset'] = offset
+            layout['length'] = len(buffer)
+            offset += _aligned(len(buffer))
+            layouts.append(layout)
+            buffers.append(buffer)
+
+        header = json.dumps({
+            'source_hash': source_hash,
+            'columns': dataset.columns,
+            'schema': dataset.schema.types if dataset.schema is not None else {},
+            'inferred': sorted(dataset.schema.inferred) if dataset.schema is not None else [],
+            'legacy': sorted(dataset.schema.legacy) if dataset.schema is not None else [],
+            'byteorder': sys.byteorder,
+            'itemsizes': itemsizes,
+            'column_data': layouts,
+        }).encode()
+
+        # write to a temporary file and move it into place, so readers never see a partial cache file
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as cache_file:
+                cache_file.write(MAGIC)
+                cache_file.write(_STAT.pack(source_stat.st_mtime_ns, source_stat.st_size, len(header)))
+                cache_file.write(header)
+                cache_file.write(b'\0' * (_aligned(cache_file.tell()) - cache_file.tell()))
+                for buffer in buffers:
+                    cache_file.write(buffer)
+                    cache_file.write(b'\0' * (_aligned(len(buffer)) - len(buffer)))
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    def _evict(self, keep=None):
+        """Deletes the least recently used cache files until the cache is under its size limit
+
+        Args:
+            keep (str): a cache file that is never deleted, such as the one just written
+        """
+        if self.max_bytes is None:
+            return
+
+        entries = []
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith(CACHE_EXTENSION):
+                continue
+            path = os.path.join(self.directory, file_name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
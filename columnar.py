@@ -0,0 +1,671 @@
+import heapq
+import sys
+from array import array
+from datetime import date
+from itertools import compress, repeat
+
+from aggregators import aggregate_column_names, as_aggregator, resolve_aggregations
+from dataset import Dataset, group_and_accumulate
+from external import MAX_MEMORY_ROWS, external_sort
+from joins import ANTI, DEFAULT_BATCH_SIZE, INNER, SEMI, join_indices, row_keys
+from partitioned import open_reader
+from reader import DEFAULT_CHUNK_SIZE
+
+# array typecodes used by the column storage
+NUMERIC_TYPECODES = {float: 'd', int: 'q'}
+CODE_TYPECODE = 'l'
+# types stored as codes into a dictionary of distinct values
+ENCODED_TYPES = (str, date)
+
+
+def typecode(values):
+    """Returns:
+        str: the item type of an array, or of a memoryview such as one over a cache file
+    """
+    return values.typecode if isinstance(values, array) else values.format
+
+
+def _array(values):
+    """Returns:
+        array: the items of an array or of a memoryview as an array, which unlike a memoryview can be pickled
+    """
+    if isinstance(values, array):
+        return values
+    copied = array(typecode(values))
+    copied.frombytes(values.cast('B'))
+    return copied
+
+
+class Column(object):
+    """Base class for a single column of values stored by a ColumnarDataset"""
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def __iter__(self):
+        raise NotImplementedError
+
+    def __getitem__(self, i):
+        raise NotImplementedError
+
+    def to_list(self):
+        """Returns:
+            list: the values of this column as python objects
+        """
+        return list(self)
+
+    def codes(self):
+        """Returns a hashable stand in for each value in this column, where two codes are equal
+        exactly when the values they represent are equal
+
+        Returns:
+            iterable: one code per row
+        """
+        return iter(self)
+
+    def decode(self, code):
+        """Converts a code returned by codes back into its value"""
+        return code
+
+    def take(self, indices):
+        """Builds a new column out of the rows at the given indices
+
+        Args:
+            indices (iterable of int): the row indices to select, in output order
+
+        Returns:
+            Column: the new column
+        """
+        raise NotImplementedError
+
+    def compress(self, mask):
+        """Builds a new column out of the rows whose mask value is truthy
+
+        Args:
+            mask (iterable): one truthy or falsy value per row
+
+        Returns:
+            Column: the new column
+        """
+        raise NotImplementedError
+
+    def slice(self, key):
+        """Builds a new column out of the rows selected by the given slice object"""
+        raise NotImplementedError
+
+    def is_encoded(self):
+        """Returns:
+            bool: true if this column stores each distinct value once
+        """
+        return False
+
+    def freeze(self):
+        """Returns:
+            Column: a column that shares this column's values, but cannot be modified
+        """
+        raise NotImplementedError
+
+    def memory_usage(self):
+        """Returns:
+            int: the approximate size of this column's values in bytes
+        """
+        raise NotImplementedError
+
+    def evaluate(self, test):
+        """Applies a test to every value in this column
+
+        Args:
+            test (callable): a function that takes a value and returns a bool
+
+        Returns:
+            list of bool: the result of the test for each row
+        """
+        return list(map(test, self))
+
+    def compare(self, function, value, null_safe=False):
+        """Compares every value in this column against a constant
+
+        Args:
+            function (callable): a binary comparison such as operator.lt
+            value (object): the right hand side of the comparison
+            null_safe (bool): if true, missing values compare as false instead of being passed to function
+
+        Returns:
+            list of bool: the result of the comparison for each row
+        """
+        if null_safe:
+            return self.evaluate(lambda x: x is not None and function(x, value))
+        return list(map(function, self, repeat(value)))
+
+
+class NumericColumn(Column):
+    """A column of numbers stored in a typed array"""
+
+    def __init__(self, values):
+        self.values = values
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __getitem__(self, i):
+        return self.values[i]
+
+    def to_list(self):
+        return self.values.tolist()
+
+    def take(self, indices):
+        return NumericColumn(array(typecode(self.values), map(self.values.__getitem__, indices)))
+
+    def compress(self, mask):
+        return NumericColumn(array(typecode(self.values), compress(self.values, mask)))
+
+    def slice(self, key):
+        return NumericColumn(self.values[key])
+
+    def freeze(self):
+        return NumericColumn(memoryview(self.values).toreadonly())
+
+    def __reduce__(self):
+        # frozen columns, and columns over a cache file, hold memoryviews, which cannot be pickled
+        return NumericColumn, (_array(self.values),)
+
+    def memory_usage(self):
+        return memoryview(self.values).nbytes
+
+    def evaluate(self, test):
+        return list(map(test, self.values))
+
+    def compare(self, function, value, null_safe=False):
+        # arrays cannot hold missing values, so every comparison runs over the raw buffer
+        return list(map(function, self.values, repeat(value)))
+
+
+class DictionaryColumn(Column):
+    """A column of repeated values, stored as integer codes into a list of the distinct values"""
+
+    def __init__(self, codes, dictionary):
+        self.values = codes
+        self.dictionary = dictionary
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return map(self.dictionary.__getitem__, self.values)
+
+    def __getitem__(self, i):
+        return self.dictionary[self.values[i]]
+
+    def codes(self):
+        return iter(self.values)
+
+    def decode(self, code):
+        return self.dictionary[code]
+
+    def take(self, indices):
+        return DictionaryColumn(array(typecode(self.values), map(self.values.__getitem__, indices)), self.dictionary)
+
+    def compress(self, mask):
+        return DictionaryColumn(array(typecode(self.values), compress(self.values, mask)), self.dictionary)
+
+    def slice(self, key):
+        return DictionaryColumn(self.values[key], self.dictionary)
+
+    def is_encoded(self):
+        return True
+
+    def freeze(self):
+        return DictionaryColumn(memoryview(self.values).toreadonly(), tuple(self.dictionary))
+
+    def __reduce__(self):
+        return DictionaryColumn, (_array(self.values), self.dictionary)
+
+    def memory_usage(self):
+        return memoryview(self.values).nbytes + sum(sys.getsizeof(value) for value in self.dictionary)
+
+    def evaluate(self, test):
+        # test each distinct value once, then look the result up for every row
+        table = list(map(test, self.dictionary))
+        return list(map(table.__getitem__, self.values))
+
+    def ranks(self):
+        """Returns:
+            list: for each code, the position of its value in the sorted dictionary
+        """
+        ranks = [0] * len(self.dictionary)
+        ordered = sorted(range(len(self.dictionary)), key=self.dictionary.__getitem__)
+        for rank, code in enumerate(ordered):
+            ranks[code] = rank
+        return ranks
+
+
+class ObjectColumn(Column):
+    """A column of arbitrary python objects, used when a column holds mixed types"""
+
+    def __init__(self, values):
+        self.values = values
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __getitem__(self, i):
+        return self.values[i]
+
+    def to_list(self):
+        return list(self.values)
+
+    def take(self, indices):
+        return ObjectColumn(list(map(self.values.__getitem__, indices)))
+
+    def compress(self, mask):
+        return ObjectColumn(list(compress(self.values, mask)))
+
+    def slice(self, key):
+        return ObjectColumn(self.values[key])
+
+    def freeze(self):
+        return ObjectColumn(tuple(self.values))
+
+    def memory_usage(self):
+        return sys.getsizeof(self.values) + sum(sys.getsizeof(value) for value in self.values)
+
+
+class ColumnBuilder(object):
+    """Accumulates values one at a time and picks the most compact column type that can hold them"""
+
+    def __init__(self):
+        self._type = None
+        self._numbers = None
+        self._codes = None
+        self._dictionary = None
+        self._index = None
+        self._objects = None
+
+    def append(self, value):
+        if self._objects is not None:
+            self._objects.append(value)
+        elif type(value) is not self._type:
+            if self._type is None and type(value) in NUMERIC_TYPECODES:
+                self._type = type(value)
+                self._numbers = array(NUMERIC_TYPECODES[self._type])
+                self._append_number(value)
+            elif self._type is None and type(value) in ENCODED_TYPES:
+                self._type = type(value)
+                self._codes = array(CODE_TYPECODE)
+                self._dictionary = []
+                self._index = {}
+                self._encode(value)
+            else:
+                # a second type of value, or a value that cannot be stored in an array
+                self._to_objects(value)
+        elif self._numbers is not None:
+            self._append_number(value)
+        else:
+            self._encode(value)
+
+    def _append_number(self, value):
+        try:
+            self._numbers.append(value)
+        except OverflowError:
+            # an int outside of the range of int64
+            self._to_objects(value)
+
+    def _to_objects(self, value):
+        self._objects = self._values()
+        self._numbers = self._codes = self._dictionary = self._index = None
+        self._objects.append(value)
+
+    def _encode(self, value):
+        code = self._index.get(value)
+        if code is None:
+            code = len(self._dictionary)
+            self._index[value] = code
+            self._dictionary.append(value)
+        self._codes.append(code)
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+        return self
+
+    def _values(self):
+        if self._numbers is not None:
+            return self._numbers.tolist()
+        if self._codes is not None:
+            return [self._dictionary[code] for code in self._codes]
+        return []
+
+    def build(self):
+        """Returns:
+            Column: a column holding every value appended so far
+        """
+        if self._numbers is not None:
+            return NumericColumn(self._numbers)
+        if self._codes is not None:
+            return DictionaryColumn(self._codes, self._dictionary)
+        return ObjectColumn(self._objects or [])
+
+
+def build_column(values):
+    """Builds the most compact column for the given values
+
+    Args:
+        values (iterable): the python values of the column
+
+    Returns:
+        Column: the new column
+    """
+    return ColumnBuilder().extend(values).build()
+
+
+class ColumnarDataset(Dataset):
+    """A Dataset that stores one typed column per column name instead of a list of row tuples.
+
+    Numbers are stored in arrays of doubles and strings are dictionary encoded, so repeated values
+    such as asins and keyword ids are stored once. Every operation returns a new ColumnarDataset with
+    the same results the row based Dataset gives.
+    """
+
+    def __init__(self, name, columns=None, column_data=None, schema=None):
+        self.name = name
+        self.columns = columns or []
+        self.column_data = column_data or [ObjectColumn([]) for _ in self.columns]
+        self.schema = schema
+        self.read_only = False
+
+    @classmethod
+    def from_rows(cls, name, columns, data, schema=None):
+        """Builds a ColumnarDataset out of row tuples
+
+        Args:
+            name (str): the name of the new dataset
+            columns (list of str): the column names
+            data (iterable of tuple): the rows
+            schema (Schema): the column types, if known
+
+        Returns:
+            ColumnarDataset: the new dataset
+        """
+        builders = [ColumnBuilder() for _ in columns]
+        for row in data:
+            for builder, value in zip(builders, row):
+                builder.append(value)
+        return cls(name, columns=list(columns), column_data=[builder.build() for builder in builders], schema=schema)
+
+    @property
+    def data(self):
+        return list(zip(*[column.to_list() for column in self.column_data]))
+
+    def __len__(self):
+        return len(self.column_data[0]) if self.column_data else 0
+
+    def populate(self, csv_path, limit=None, columns=None, predicate=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                 schema=None, byte_range=None):
+        """Populates this dataset with data from the csv_path, see Dataset.populate"""
+        self._check_writable()
+        reader = open_reader(csv_path, columns=columns, predicate=predicate, chunk_size=chunk_size, limit=limit,
+                             schema=schema, byte_range=byte_range)
+        builders = [ColumnBuilder() for _ in reader.columns]
+        for chunk in reader:
+            for builder, values in zip(builders, zip(*chunk)):
+                builder.extend(values)
+
+        self.columns = reader.columns
+        self.schema = reader.schema.select(reader.columns)
+        self.column_data = [builder.build() for builder in builders]
+        return self
+
+    def freeze(self):
+        """See Dataset.freeze"""
+        self.column_data = [column.freeze() for column in self.column_data]
+        self.read_only = True
+        return self
+
+    def view(self, name=None):
+        """See Dataset.view"""
+        dataset = ColumnarDataset(name or self.name, columns=list(self.columns), column_data=list(self.column_data),
+                                  schema=self.schema)
+        dataset.read_only = self.read_only
+        return dataset
+
+    def copy(self):
+        """See Dataset.copy"""
+        return ColumnarDataset.from_rows(self.name, self.columns, self.data, schema=self.schema)
+
+    def memory_usage(self, sample_size=None):
+        """See Dataset.memory_usage. Columns are measured exactly, so no sample is taken"""
+        return sum(column.memory_usage() for column in self.column_data)
+
+    def to_columnar(self):
+        return self
+
+    def to_rows(self):
+        """Returns:
+            Dataset: a row based copy of this dataset
+        """
+        return Dataset(self.name, columns=list(self.columns), data=self.data, schema=self.schema)
+
+    def get_column_data(self, column_name):
+        """Gets the stored column for the given column name
+
+        Args:
+            column_name (str): the column to select
+
+        Returns:
+            Column: the selected column
+        """
+        self._validate_column_name(column_name)
+        return self.column_data[self.columns.index(column_name)]
+
+    def _new(self, column_data, columns=None, schema=None):
+        if columns is None:
+            columns, schema = self.columns, self.schema
+        return ColumnarDataset(self.name, columns=columns, column_data=column_data, schema=schema)
+
+    def select(self, columns):
+        """See Dataset.select. The selected columns are shared with this dataset rather than copied"""
+        for column_name in columns:
+            self._validate_column_name(column_name)
+        return self._new([self.get_column_data(column_name) for column_name in columns], columns=list(columns),
+                         schema=self._select_schema(columns))
+
+    def _compress(self, mask):
+        mask = list(mask)
+        return self._new([column.compress(mask) for column in self.column_data])
+
+    def _take(self, indices):
+        return self._new([column.take(indices) for column in self.column_data])
+
+    def mask(self, predicate):
+        """See Dataset.mask. The predicate is evaluated one column at a time"""
+        for column_name in predicate.columns():
+            self._validate_column_name(column_name)
+        if self.schema is not None:
+            predicate = predicate.bind(self.schema)
+        return predicate.evaluate(self)
+
+    def compress(self, mask):
+        return self._compress(mask)
+
+    def row_range(self, start, end):
+        return self._new([column.slice(slice(start, end)) for column in self.column_data])
+
+    def filter(self, column_name, function):
+        """See Dataset.filter"""
+        return self._compress(self.get_column_data(column_name).evaluate(function))
+
+    def where(self, predicate):
+        """See Dataset.where. The predicate is evaluated one column at a time into a boolean mask"""
+        return self._compress(self.mask(predicate))
+
+    def derive(self, column_name, expression):
+        """See Dataset.derive. The expression is evaluated one operator at a time over whole columns"""
+        self._check_derived_column(column_name, expression)
+        if self.schema is not None:
+            expression = expression.bind(self.schema)
+        column = build_column(expression.evaluate(self))
+        return self._new(self.column_data + [column], columns=self.columns + [column_name], schema=self.schema)
+
+    def _group_codes(self, group_by_columns):
+        """Partitions the row indices of this dataset by the codes of the given columns
+
+        Returns:
+            tuple of list, dict: the key columns, and a mapping of key codes to lists of row indices in
+                order of first appearance
+        """
+        key_columns = [self.get_column_data(column_name) for column_name in group_by_columns]
+        groups = {}
+        for i, key in enumerate(zip(*[column.codes() for column in key_columns])):
+            rows = groups.get(key)
+            if rows is None:
+                groups[key] = [i]
+            else:
+                rows.append(i)
+        return key_columns, groups
+
+    def _decode_key(self, key_columns, key):
+        return tuple(column.decode(code) for column, code in zip(key_columns, key))
+
+    def group_by_and_aggregate(self, group_by_columns, aggregate_column, aggregation):
+        """See Dataset.group_by_and_aggregate"""
+        if as_aggregator(aggregation) is not None:
+            return self.aggregate(group_by_columns, [(aggregate_column, aggregation)])
+
+        for column_name in list(group_by_columns) + [aggregate_column]:
+            self._validate_column_name(column_name)
+
+        values = self.get_column_data(aggregate_column).to_list()
+        key_columns, groups = self._group_codes(group_by_columns)
+
+        builders = [ColumnBuilder() for _ in range(len(key_columns) + 1)]
+        for key, rows in groups.items():
+            element = self._decode_key(key_columns, key) + (aggregation([values[i] for i in rows]),)
+            for builder, value in zip(builders, element):
+                builder.append(value)
+
+        new_columns = list(group_by_columns) + [aggregate_column]
+        return self._new([builder.build() for builder in builders], columns=new_columns,
+                         schema=self._select_schema(group_by_columns))
+
+    def partial_aggregate(self, group_by_columns, aggregations):
+        """See Dataset.partial_aggregate. Groups are keyed on dictionary codes rather than the values themselves,
+        and only the key of each group is decoded"""
+        aggregations = resolve_aggregations(aggregations)
+        for column_name in list(group_by_columns) + [column_name for aggregate_column, _, _ in aggregations
+                                                     for column_name in aggregate_column_names(aggregate_column)]:
+            self._validate_column_name(column_name)
+
+        key_columns = [self.get_column_data(column_name) for column_name in group_by_columns]
+        keys = zip(*[column.codes() for column in key_columns]) if key_columns else repeat((), len(self))
+        values = zip(*[zip(*[self.get_column_data(column_name) for column_name in aggregate_column])
+                       if isinstance(aggregate_column, tuple) else self.get_column_data(aggregate_column)
+                       for aggregate_column, _, _ in aggregations])
+        groups = group_and_accumulate(keys, values, [prototype for _, prototype, _ in aggregations])
+        return {self._decode_key(key_columns, key): accumulators for key, accumulators in groups.items()}
+
+    def from_groups(self, group_by_columns, aggregations, groups):
+        """See Dataset.from_groups"""
+        aggregations = resolve_aggregations(aggregations)
+        builders = [ColumnBuilder() for _ in range(len(group_by_columns) + len(aggregations))]
+        for key, accumulators in groups.items():
+            element = key + tuple([accumulator.result() for accumulator in accumulators])
+            for builder, value in zip(builders, element):
+                builder.append(value)
+
+        new_columns = list(group_by_columns) + [output_column for _, _, output_column in aggregations]
+        return self._new([builder.build() for builder in builders], columns=new_columns,
+                         schema=self._select_schema(group_by_columns))
+
+    def _sort_keys(self, column_names):
+        """Returns:
+            list: the sort key of each row, tuples if there are several columns
+        """
+        keys = []
+        for column_name in column_names:
+            column = self.get_column_data(column_name)
+            if isinstance(column, DictionaryColumn):
+                # compare small integer ranks instead of the values themselves
+                ranks = column.ranks()
+                keys.append([ranks[code] for code in column.values])
+            else:
+                keys.append(column.to_list())
+        return keys[0] if len(keys) == 1 else list(zip(*keys))
+
+    def sort_by(self, column_name, reverse=False, max_rows=MAX_MEMORY_ROWS):
+        """See Dataset.sort_by. Only the row indices are sorted, and each column is then taken in their order"""
+        self._validate_column_name(column_name)
+        keys = self._sort_keys([column_name])
+        if len(keys) > max_rows:
+            order = list(external_sort(range(len(keys)), key=keys.__getitem__, reverse=reverse, run_size=max_rows))
+        else:
+            order = sorted(range(len(keys)), key=keys.__getitem__, reverse=reverse)
+        return self._take(order)
+
+    def top_n(self, column_names, n, descending=False):
+        """See Dataset.top_n"""
+        column_names = [column_names] if isinstance(column_names, str) else list(column_names)
+        for column_name in column_names:
+            self._validate_column_name(column_name)
+        keys = self._sort_keys(column_names)
+        select = heapq.nlargest if descending else heapq.nsmallest
+        return self._take(select(n, range(len(keys)), key=keys.__getitem__))
+
+    def limit(self, n):
+        return self._new([column.slice(slice(None, n)) for column in self.column_data])
+
+    def _key_column_values(self, join_columns):
+        return [self.get_column_data(column_name).to_list() for column_name in join_columns]
+
+    def _join_column_data(self, other_dataset, join_columns, how, pairs):
+        """Returns:
+            list of Column: the columns of the joined rows of the given (our index, their index) pairs
+        """
+        our_indices = array(CODE_TYPECODE, [i for i, _ in pairs])
+        column_data = [column.take(our_indices) for column in self.column_data]
+        if how in (SEMI, ANTI):
+            return column_data
+
+        their_indices = [j for _, j in pairs]
+        their_columns = [other_dataset.get_column_data(column_name) for column_name in other_dataset.columns
+                         if column_name not in join_columns]
+        if None in their_indices:
+            # rows of a left join without a match have missing values for the other dataset's columns
+            column_data += [build_column([column[j] if j is not None else None for j in their_indices])
+                            for column in their_columns]
+        else:
+            their_indices = array(CODE_TYPECODE, their_indices)
+            column_data += [column.take(their_indices) for column in their_columns]
+        return column_data
+
+    def join(self, other_dataset, join_columns, how=INNER, batch_size=DEFAULT_BATCH_SIZE,
+             max_hash_rows=MAX_MEMORY_ROWS):
+        """See Dataset.join. Only the row indices of the matches are collected, and each column is then taken at
+        those indices"""
+        join_columns = self._check_join_columns(other_dataset, join_columns)
+        if min(len(self), len(other_dataset)) > max_hash_rows:
+            return ColumnarDataset.from_join(self.name, self, other_dataset, join_columns, how=how,
+                                             run_size=max_hash_rows)
+        other_dataset = other_dataset.to_columnar()
+        batches = join_indices(row_keys(self._key_column_values(join_columns)),
+                               row_keys(other_dataset._key_column_values(join_columns)),
+                               how=how, batch_size=batch_size)
+        pairs = [pair for batch in batches for pair in batch]
+        return self._new(self._join_column_data(other_dataset, join_columns, how, pairs),
+                         columns=self._join_columns(other_dataset, join_columns, how),
+                         schema=self._join_schema(other_dataset, how))
+
+    def join_batches(self, other_dataset, join_columns, how=INNER, batch_size=DEFAULT_BATCH_SIZE):
+        """See Dataset.join_batches"""
+        join_columns = self._check_join_columns(other_dataset, join_columns)
+        other_dataset = other_dataset.to_columnar()
+        for batch in join_indices(row_keys(self._key_column_values(join_columns)),
+                                  row_keys(other_dataset._key_column_values(join_columns)),
+                                  how=how, batch_size=batch_size):
+            column_data = self._join_column_data(other_dataset, join_columns, how, batch)
+            yield list(zip(*[column.to_list() for column in column_data]))
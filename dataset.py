@@ -1,38 +1,255 @@
-import csv, os
+import heapq
+import os
+import sys
+from itertools import chain, compress
 from operator import itemgetter
 
+from aggregators import aggregate_column_names, as_aggregator, resolve_aggregations
+from external import DEFAULT_RUN_SIZE, MAX_MEMORY_ROWS, external_join, external_sort
+from joins import ANTI, DEFAULT_BATCH_SIZE, INNER, SEMI, is_sorted, join_indices, row_key, row_keys
+from partitioned import open_reader
+from predicates import Between, Comparison
+from reader import DEFAULT_CHUNK_SIZE
+from schema import parse_cell
+
+
+def tuple_getter(indices):
+    """Returns:
+        callable: a function that takes a row and returns a tuple of the values at the given indices
+    """
+    if not indices:
+        return lambda row: ()
+    if len(indices) == 1:
+        index = indices[0]
+        return lambda row: (row[index],)
+    return itemgetter(*indices)
+
+
+def _rows(source):
+    """Returns:
+        iterable of tuple: the rows of a Dataset, or of a csv reader a chunk at a time
+    """
+    if isinstance(source, Dataset):
+        return source.data
+    return chain.from_iterable(source)
+
+
+def group_and_accumulate(keys, values, prototypes, groups=None):
+    """Updates one set of accumulators per distinct key
+
+    Args:
+        keys (iterable of tuple): the group key of each row
+        values (iterable of tuple): the values of each row, one per prototype
+        prototypes (list of Aggregator): the aggregations to compute for each group
+        groups (dict): if passed, existing accumulators to update, otherwise a new dict is made
+
+    Returns:
+        dict of tuple, list: the accumulators of each key, in order of first appearance
+    """
+    if groups is None:
+        groups = {}
+    if len(prototypes) == 1:
+        prototype = prototypes[0]
+        for key, (value,) in zip(keys, values):
+            accumulator = groups.get(key)
+            if accumulator is None:
+                accumulator = groups[key] = [prototype.new()]
+            accumulator[0].update(value)
+        return groups
+
+    for key, row_values in zip(keys, values):
+        accumulators = groups.get(key)
+        if accumulators is None:
+            accumulators = groups[key] = [prototype.new() for prototype in prototypes]
+        for accumulator, value in zip(accumulators, row_values):
+            accumulator.update(value)
+    return groups
+
+
+def merge_groups(groups, partial_groups):
+    """Merges the partial aggregates of one part of a dataset into those of the parts before it. Groups first seen
+    in the later part are added after the existing groups, as they would be by a single pass over every part
+
+    Args:
+        groups (dict of tuple, list): the accumulators of each group so far, updated in place
+        partial_groups (dict of tuple, list): the accumulators of each group of the later part
+
+    Returns:
+        dict of tuple, list: groups
+    """
+    for key, accumulators in partial_groups.items():
+        existing = groups.get(key)
+        if existing is None:
+            groups[key] = accumulators
+        else:
+            for accumulator, partial in zip(existing, accumulators):
+                accumulator.merge(partial)
+    return groups
+
 
 class Dataset(object):
     """This object is used to represent the data in the given CSVs and to perform filtering/aggregations on."""
 
-    def __init__(self, name, columns=None, data=None):
+    def __init__(self, name, columns=None, data=None, schema=None):
         self.name = name
         self.columns = columns or []
         self.data = data or []
+        self.schema = schema
+        self.read_only = False
+
+    @classmethod
+    def from_rows(cls, name, columns, data, schema=None):
+        """Builds a Dataset out of row tuples, see ColumnarDataset.from_rows"""
+        return cls(name, columns=list(columns), data=list(data), schema=schema)
 
-    def populate(self, csv_path, limit=None):
-        """Populates this dataset with data from the csv_path
+    @classmethod
+    def from_sorted(cls, name, reader, column_name, reverse=False, run_size=DEFAULT_RUN_SIZE, directory=None):
+        """Builds a dataset out of the rows of a csv sorted by a column, the same as populating it and then calling
+        sort_by, without first loading the unsorted rows. They are sorted run_size at a time and spilled to
+        temporary files, see external.external_sort
+
+        Args:
+            name (str): the name of the new dataset
+            reader (CsvReader or PartitionedReader): reads the rows, see partitioned.open_reader
+            column_name (str): the column to sort the rows by
+            reverse (bool): if true, sorts the rows in descending order
+            run_size (int): the number of rows sorted in memory at a time
+            directory (str): where the runs are spilled, the system's temporary directory if not passed
+
+        Returns:
+            Dataset: the sorted dataset
+        """
+        if column_name not in reader.columns:
+            raise ValueError('column name {} does not exist'.format(column_name))
+        rows = external_sort(_rows(reader), key=itemgetter(reader.columns.index(column_name)), reverse=reverse,
+                             run_size=run_size, directory=directory)
+        return cls.from_rows(name, reader.columns, rows, schema=reader.schema.select(reader.columns))
+
+    @classmethod
+    def from_join(cls, name, left, right, join_columns, how=INNER, run_size=DEFAULT_RUN_SIZE, directory=None,
+                  ordered=True):
+        """Builds a dataset out of the join of two csvs, the same as populating them and then calling join, with a
+        sort-merge join on disk rather than a hash join in memory, see external.external_join. Only the joined
+        rows and run_size rows of each sort are held. A side passed as a Dataset that is already sorted on the join
+        columns is not sorted again
 
         Args:
-             csv_path (str): the path to the csv
+            name (str): the name of the new dataset
+            left (CsvReader or PartitionedReader or Dataset): reads the left rows, see partitioned.open_reader.
+                A side that is already loaded can be passed as a Dataset
+            right (CsvReader or PartitionedReader or Dataset): reads the right rows
+            join_columns (str or list of str): the common columns between the two sides to join on
+            how (str): 'inner', 'left', 'semi' or 'anti', see join
+            run_size (int): the number of rows sorted in memory at a time
+            directory (str): where the runs are spilled
+            ordered (bool): if false, the joined rows may be in order of the join columns rather than of the left
+                rows, which saves sorting them back
+
+        Returns:
+            Dataset: the joined dataset
+        """
+        join_columns = [join_columns] if isinstance(join_columns, str) else list(join_columns)
+        for join_column in join_columns:
+            if join_column not in left.columns or join_column not in right.columns:
+                raise ValueError('join_column {} does not exist in both datasets'.format(join_column))
+        left_schema, right_schema = [source.schema.select(source.columns) if source.schema is not None else None
+                                     for source in (left, right)]
+        left_sorted, right_sorted = [isinstance(source, Dataset) and is_sorted(row_keys(source._key_column_values(
+            join_columns))) for source in (left, right)]
+        pairs = external_join(_rows(left), _rows(right),
+                              row_key([left.columns.index(column_name) for column_name in join_columns]),
+                              row_key([right.columns.index(column_name) for column_name in join_columns]),
+                              how=how, run_size=run_size, directory=directory, left_sorted=left_sorted,
+                              right_sorted=right_sorted, ordered=ordered)
+        if how in (SEMI, ANTI):
+            return cls.from_rows(name, left.columns, (left_row for left_row, _ in pairs), schema=left_schema)
+
+        other_columns = [column_name for column_name in right.columns if column_name not in join_columns]
+        project = tuple_getter([right.columns.index(column_name) for column_name in other_columns])
+        missing = (None,) * len(other_columns)
+        rows = (left_row + (project(right_row) if right_row is not None else missing) for left_row, right_row in pairs)
+        schema = left_schema or right_schema
+        if left_schema is not None and right_schema is not None:
+            schema = left_schema.merge(right_schema.select(other_columns))
+        return cls.from_rows(name, list(left.columns) + other_columns, rows, schema=schema)
+
+    def populate(self, csv_path, limit=None, columns=None, predicate=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                 schema=None, byte_range=None):
+        """Populates this dataset with data from the csv_path. The csv is streamed in chunks, and the
+        columns and predicate are applied while parsing so that unwanted rows are never held in memory
+
+        Args:
+             csv_path (str): the path to the csv, or the directory of a partitioned dataset, in which case only
+                the partitions that may hold rows passing the predicate are read, see the partitioned module
              limit(int): if passed, stops processing after limit rows
+             columns (list of str): if passed, only these columns are loaded
+             predicate (Predicate): if passed, only rows that pass this predicate are loaded
+             chunk_size (int): the number of rows parsed at a time
+             schema (Schema or dict or str): the column types to parse with. By default numbers are parsed as
+                floats and everything else, dates included, is left as strings, as this method always has, which is
+                only about 1.2-1.7x faster than the original row by row parsing. 'infer' infers int64, float64,
+                date, categorical and string columns from the leading rows, see reader.resolve_schema, which is
+                about 1.7-2x faster but gives dates, ints and None for empty cells, so it has to be asked for
+             byte_range (tuple of int): if passed, only the rows in this range of the csv are loaded, see
+                reader.byte_ranges
 
         Returns:
             Dataset: self
         """
-        with open(csv_path) as csv_file:
-            csv_reader = csv.reader(csv_file, delimiter=',')
-            for i, row in enumerate(csv_reader):
-                if limit and i > limit:
-                    break
+        self._check_writable()
+        reader = open_reader(csv_path, columns=columns, predicate=predicate, chunk_size=chunk_size, limit=limit,
+                             schema=schema, byte_range=byte_range)
+        self.columns = reader.columns
+        self.schema = reader.schema.select(reader.columns)
+        for chunk in reader:
+            self.data.extend(chunk)
+
+        return self
+
+    def _check_writable(self):
+        if self.read_only:
+            raise ValueError('dataset {} is read only'.format(self.name))
 
-                if i == 0:
-                    self.columns = row
-                    continue
-                self.data.append(self._parse_row(row))
+    def freeze(self):
+        """Makes this dataset read only, so that it can be shared. Operations on a read only dataset still
+        return new, writable datasets, and copy can be used to get a writable copy of the dataset itself
 
+        Returns:
+            Dataset: self
+        """
+        self.data = tuple(self.data)
+        self.read_only = True
         return self
 
+    def view(self, name=None):
+        """Returns:
+            Dataset: a dataset that shares this dataset's rows, under a new name
+        """
+        dataset = Dataset(name or self.name, columns=list(self.columns), data=self.data, schema=self.schema)
+        dataset.read_only = self.read_only
+        return dataset
+
+    def copy(self):
+        """Returns:
+            Dataset: a writable copy of this dataset
+        """
+        return Dataset(self.name, columns=list(self.columns), data=list(self.data), schema=self.schema)
+
+    def memory_usage(self, sample_size=100):
+        """Estimates the memory held by this dataset's rows from a sample of them
+
+        Args:
+            sample_size (int): the number of rows to measure
+
+        Returns:
+            int: the estimated size in bytes
+        """
+        sample = self.data[:sample_size]
+        if not sample:
+            return sys.getsizeof(self.data)
+        sample_bytes = sum(sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row) for row in sample)
+        return sys.getsizeof(self.data) + sample_bytes * len(self.data) // len(sample)
+
     def _parse_row(self, row):
         """Parses a row from a CSV and converts numbers to floats
 
@@ -42,14 +259,10 @@ class Dataset(object):
         Returns:
             tuple: the new row, after converting types
         """
-        element = []
-        for i, cell in enumerate(row):
-            try:
-                cell = float(cell)
-            except ValueError:
-                pass
-            element.append(cell)
-        return tuple(element)
+        return tuple(map(parse_cell, row))
+
+    def _select_schema(self, columns):
+        return self.schema.select(columns) if self.schema is not None else None
 
     def _validate_column_name(self, column_name):
         if column_name not in self.columns:
@@ -68,11 +281,95 @@ class Dataset(object):
         self._validate_column_name(column_name)
         return row[self.columns.index(column_name)]
 
+    def select(self, columns):
+        """Keeps only the given columns of this dataset
+
+        Args:
+            columns (list of str): the columns to keep, in their new order
+
+        Returns:
+            Dataset: the projected dataset
+        """
+        for column_name in columns:
+            self._validate_column_name(column_name)
+        if not columns:
+            new_data = [()] * len(self.data)
+        elif len(columns) == 1:
+            index = self.columns.index(columns[0])
+            new_data = [(row[index],) for row in self.data]
+        else:
+            new_data = list(map(itemgetter(*[self.columns.index(column_name) for column_name in columns]), self.data))
+        return Dataset(self.name, columns=list(columns), data=new_data, schema=self._select_schema(columns))
+
     def equals_filter(self, column_name, value):
-        return self.filter(column_name, lambda x: x == value)
+        return self.where(Comparison(column_name, '==', value))
 
     def between_filter(self, column_name, start, end):
-        return self.filter(column_name, lambda x: start < x < end)
+        return self.where(Between(column_name, start, end))
+
+    def where(self, predicate):
+        """Removes data from this dataset that does not pass the given predicate. The predicate is compiled
+        once against this dataset's columns, so no per row column lookups are made
+
+        Args:
+            predicate (Predicate): the predicate each row must pass, see the predicates module
+
+        Returns:
+            Dataset: this dataset after filtering
+        """
+        for column_name in predicate.columns():
+            self._validate_column_name(column_name)
+        if self.schema is not None:
+            predicate = predicate.bind(self.schema)
+        new_data = list(filter(predicate.compile(self.columns), self.data))
+        return Dataset(self.name, columns=self.columns, data=new_data, schema=self.schema)
+
+    def derive(self, column_name, expression):
+        """Adds a column computed from the other columns of each row, e.g. the ACoS of each row with
+        derive('acos', Field('ad_spend') / Field('sales')). The new column can then be filtered, grouped and
+        sorted by like any other
+
+        Args:
+            column_name (str): the name of the new column
+            expression (Expression): the expression to compute, see the expressions module
+
+        Returns:
+            Dataset: this dataset with the new column added at the end
+        """
+        self._check_derived_column(column_name, expression)
+        if self.schema is not None:
+            expression = expression.bind(self.schema)
+        function = expression.compile(self.columns)
+        new_data = [row + (function(row),) for row in self.data]
+        return Dataset(self.name, columns=self.columns + [column_name], data=new_data, schema=self.schema)
+
+    def _check_derived_column(self, column_name, expression):
+        if column_name in self.columns:
+            raise ValueError('column name {} already exists'.format(column_name))
+        for expression_column in expression.columns():
+            self._validate_column_name(expression_column)
+
+    def mask(self, predicate):
+        """Returns:
+            list of bool: whether each row of this dataset passes the predicate
+        """
+        for column_name in predicate.columns():
+            self._validate_column_name(column_name)
+        if self.schema is not None:
+            predicate = predicate.bind(self.schema)
+        return list(map(predicate.compile(self.columns), self.data))
+
+    def compress(self, mask):
+        """Returns:
+            Dataset: the rows of this dataset whose mask value is truthy
+        """
+        return Dataset(self.name, columns=self.columns, data=list(compress(self.data, mask)), schema=self.schema)
+
+    def row_range(self, start, end):
+        """Returns:
+            Dataset: the rows of this dataset from index start up to end
+        """
+        return Dataset(self.name, columns=self.columns, data=self.data[start:end], schema=self.schema)
 
     def filter(self, column_name, function):
         """Removes data from this dataset based on if the given column passed the
@@ -86,12 +383,10 @@ class Dataset(object):
             Dataset: this dataset after filtering
         """
         self._validate_column_name(column_name)
-        new_data = []
-        for row in self.data:
-            if function(self.get_column(column_name, row)):
-                new_data.append(row)
+        index = self.columns.index(column_name)
+        new_data = [row for row in self.data if function(row[index])]
 
-        return Dataset(self.name, columns=self.columns, data=new_data)
+        return Dataset(self.name, columns=self.columns, data=new_data, schema=self.schema)
 
     def _partition(self, group_by_columns, aggregate_column=None):
         """splits the data in this dataset into partitions based on the passed group_by_columns,
@@ -106,20 +401,21 @@ class Dataset(object):
                 by columns that exist in this dataset, and the values are the rows that contain the values
                 in the key
         """
+        get_key = tuple_getter([self.columns.index(column_name) for column_name in group_by_columns])
+        value_index = self.columns.index(aggregate_column) if aggregate_column else None
+
         partitioned_data = {}
         for row in self.data:
-            key = []
-            for column_name in group_by_columns:
-                key.append(self.get_column(column_name, row))
-            key = tuple(key)
+            key = get_key(row)
 
-            if aggregate_column:
-                row = self.get_column(aggregate_column, row)
+            if value_index is not None:
+                row = row[value_index]
 
-            if key in partitioned_data:
-                partitioned_data[key].append(row)
-            else:
+            rows = partitioned_data.get(key)
+            if rows is None:
                 partitioned_data[key] = [row]
+            else:
+                rows.append(row)
 
         return partitioned_data
 
@@ -130,13 +426,17 @@ class Dataset(object):
         Args:
             group_by_columns (iterable of str): the columns in this dataset to partition the data by
             aggregate_column (str): the column to execute the given aggregation against
-            aggregation (callable): a function to execute on a list of the values for the given aggregate
-                column
+            aggregation (callable or Aggregator): a function to execute on a list of the values for the given
+                aggregate column, or an incremental aggregation from the aggregators module, which is computed
+                without holding the values of each group
 
         Returns:
             Dataset: The resulting dataset, where the resulting columns are only the group_by_columns and the aggregate
                 column
         """
+        if as_aggregator(aggregation) is not None:
+            return self.aggregate(group_by_columns, [(aggregate_column, aggregation)])
+
         for column_name in list(group_by_columns) + [aggregate_column]:
             self._validate_column_name(column_name)
 
@@ -150,24 +450,105 @@ class Dataset(object):
             element = tuple(element)
             new_data.append(element)
 
-        return Dataset(self.name, columns=new_columns, data=new_data)
+        return Dataset(self.name, columns=new_columns, data=new_data, schema=self._select_schema(group_by_columns))
+
+    def aggregate(self, group_by_columns, aggregations):
+        """Groups the data in this dataset by the group_by_columns, and computes several aggregations of each group
+        in a single pass over the data, e.g. the sums of sales, ad_spend and clicks by asin
+
+        Args:
+            group_by_columns (iterable of str): the columns in this dataset to partition the data by
+            aggregations (iterable of tuple): (aggregate_column, aggregation) or (aggregate_column, aggregation,
+                output_column) tuples, see aggregators.resolve_aggregations
+
+        Returns:
+            Dataset: The resulting dataset, with the group_by_columns followed by one column per aggregation
+        """
+        aggregations = resolve_aggregations(aggregations)
+        return self.from_groups(group_by_columns, aggregations, self.partial_aggregate(group_by_columns, aggregations))
+
+    def partial_aggregate(self, group_by_columns, aggregations):
+        """Computes the accumulators of each group without finishing them, so that the partial aggregates of
+        separate parts of a dataset can be combined with merge_groups
+
+        Args:
+            group_by_columns (iterable of str): the columns in this dataset to partition the data by
+            aggregations (iterable of tuple): see aggregate
+
+        Returns:
+            dict of tuple, list: the group_by_columns values of each group, and its accumulators, one per aggregation
+        """
+        aggregations = resolve_aggregations(aggregations)
+        for column_name in list(group_by_columns) + [column_name for aggregate_column, _, _ in aggregations
+                                                     for column_name in aggregate_column_names(aggregate_column)]:
+            self._validate_column_name(column_name)
+
+        get_key = tuple_getter([self.columns.index(column_name) for column_name in group_by_columns])
+        if all(isinstance(aggregate_column, str) for aggregate_column, _, _ in aggregations):
+            get_values = tuple_getter([self.columns.index(column_name) for column_name, _, _ in aggregations])
+        else:
+            getters = [tuple_getter([self.columns.index(column_name) for column_name in aggregate_column])
+                       if isinstance(aggregate_column, tuple) else itemgetter(self.columns.index(aggregate_column))
+                       for aggregate_column, _, _ in aggregations]
+            get_values = lambda row: tuple([getter(row) for getter in getters])
+        return group_and_accumulate(map(get_key, self.data), map(get_values, self.data),
+                                    [prototype for _, prototype, _ in aggregations])
+
+    def from_groups(self, group_by_columns, aggregations, groups):
+        """Finishes the accumulators returned by partial_aggregate
+
+        Returns:
+            Dataset: the aggregated dataset, see aggregate
+        """
+        aggregations = resolve_aggregations(aggregations)
+        new_columns = list(group_by_columns) + [output_column for _, _, output_column in aggregations]
+        new_data = [key + tuple([accumulator.result() for accumulator in accumulators])
+                    for key, accumulators in groups.items()]
+        return Dataset(self.name, columns=new_columns, data=new_data, schema=self._select_schema(group_by_columns))
 
-    def sort_by(self, column_name, reverse=False):
-        """Sorts the data in this dataset by the passed column_name in ascending order by default
+    def sort_by(self, column_name, reverse=False, max_rows=MAX_MEMORY_ROWS):
+        """Sorts the data in this dataset by the passed column_name in ascending order by default. A csv too large
+        to load is sorted on disk with from_sorted instead
 
         Args:
             column_name (str): the column to sort the data by
             reverse (bool): if true, sorts the data in descending order
+            max_rows (int): the most rows sorted in memory at once. A larger dataset is sorted max_rows rows at a
+                time and spilled to temporary files, see external.external_sort
 
         Returns:
             Dataset: the sorted dataset
         """
         self._validate_column_name(column_name)
-        new_data = sorted(self.data, key=itemgetter(self.columns.index(column_name)), reverse=reverse)
-        return Dataset(self.name, columns=self.columns, data=new_data)
+        key = itemgetter(self.columns.index(column_name))
+        if len(self.data) > max_rows:
+            new_data = list(external_sort(self.data, key=key, reverse=reverse, run_size=max_rows))
+        else:
+            new_data = sorted(self.data, key=key, reverse=reverse)
+        return Dataset(self.name, columns=self.columns, data=new_data, schema=self.schema)
 
     def limit(self, n):
-        return Dataset(self.name, columns=self.columns, data=self.data[:n])
+        return Dataset(self.name, columns=self.columns, data=list(self.data[:n]), schema=self.schema)
+
+    def top_n(self, column_names, n, descending=False):
+        """Keeps the first n rows of this dataset in sorted order, the same rows in the same order as
+        sort_by(column_name, reverse=descending).limit(n), ties included. Only n rows are kept while the
+        data is scanned, so this takes O(len * log n) time rather than sorting every row
+
+        Args:
+            column_names (str or list of str): the column, or columns in order of priority, to sort by
+            n (int): the number of rows to keep
+            descending (bool): if true, keeps the largest rows rather than the smallest
+
+        Returns:
+            Dataset: the top n rows
+        """
+        column_names = [column_names] if isinstance(column_names, str) else list(column_names)
+        for column_name in column_names:
+            self._validate_column_name(column_name)
+        key = itemgetter(*[self.columns.index(column_name) for column_name in column_names])
+        select = heapq.nlargest if descending else heapq.nsmallest
+        return Dataset(self.name, columns=self.columns, data=select(n, self.data, key=key), schema=self.schema)
 
     def inner_join(self, other_dataset, join_column):
         """Performs an inner join, where the column names are assumed to be unique except
@@ -182,31 +563,97 @@ class Dataset(object):
         """
         if join_column not in self.columns or join_column not in other_dataset.columns:
             raise ValueError('join_column {} does not exist in both datasets'.format(join_column))
+        return self.join(other_dataset, [join_column])
 
-        indexed_data = other_dataset._partition((join_column,))
+    def join(self, other_dataset, join_columns, how=INNER, batch_size=DEFAULT_BATCH_SIZE,
+             max_hash_rows=MAX_MEMORY_ROWS):
+        """Joins the rows of this dataset to the rows of another with equal values in the join columns, see the
+        joins module. Column names are assumed to be unique except for the join columns. Csvs too large to load
+        are joined on disk with from_join instead
 
-        # create a new instance of this list to avoid modifying the other_dataset argument by reference
-        their_columns = list(other_dataset.columns)
-        their_columns.remove(join_column)
-        new_columns = self.columns + their_columns
+        Args:
+            other_dataset (Dataset): an external dataset to join on
+            join_columns (str or list of str): the common columns between these two datasets to join on
+            how (str): 'inner', 'left' to keep rows without a match with their other columns missing, 'semi' to
+                keep only this dataset's rows that have a match, or 'anti' to keep only those that do not
+            batch_size (int): the number of rows joined at a time
+            max_hash_rows (int): the most rows a hash table is built over. When both datasets have more, the ones
+                that are not sorted on the join columns are sorted max_hash_rows rows at a time on disk and they are
+                merge joined instead, see from_join. Datasets that are both sorted are merge joined whatever their size
 
+        Returns:
+            Dataset: the joined dataset. Semi and anti joins only have this dataset's columns
+        """
+        if min(len(self), len(other_dataset)) > max_hash_rows:
+            join_columns = self._check_join_columns(other_dataset, join_columns)
+            return Dataset.from_join(self.name, self, other_dataset, join_columns, how=how, run_size=max_hash_rows)
         new_data = []
-        for row in self.data:
-            # convert this string to a tuple
-            key = (self.get_column(join_column, row),)
-            if key in indexed_data:
-                their_data = indexed_data[key]
-                # handle cases where there are duplicate values to join on
-                for their_row in their_data:
-                    new_row = list(row)
-                    # append each external column onto this dataset
-                    for their_column in their_columns:
-                        their_column_value = other_dataset.get_column(their_column, their_row)
-                        new_row.append(their_column_value)
-                    new_row = tuple(new_row)
-                    new_data.append(new_row)
-
-        return Dataset(self.name, columns=new_columns, data=new_data)
+        for batch in self.join_batches(other_dataset, join_columns, how=how, batch_size=batch_size):
+            new_data.extend(batch)
+        return Dataset(self.name, columns=self._join_columns(other_dataset, join_columns, how), data=new_data,
+                       schema=self._join_schema(other_dataset, how))
+
+    def _check_join_columns(self, other_dataset, join_columns):
+        join_columns = [join_columns] if isinstance(join_columns, str) else list(join_columns)
+        for join_column in join_columns:
+            if join_column not in self.columns or join_column not in other_dataset.columns:
+                raise ValueError('join_column {} does not exist in both datasets'.format(join_column))
+        return join_columns
+
+    def _join_columns(self, other_dataset, join_columns, how):
+        """Returns:
+            list of str: the columns of a join's result
+        """
+        if how in (SEMI, ANTI):
+            return list(self.columns)
+        join_columns = [join_columns] if isinstance(join_columns, str) else join_columns
+        return self.columns + [column_name for column_name in other_dataset.columns if column_name not in join_columns]
+
+    def _key_column_values(self, join_columns):
+        return [[row[i] for row in self.data] for i in [self.columns.index(column_name) for column_name in join_columns]]
+
+    def join_batches(self, other_dataset, join_columns, how=INNER, batch_size=DEFAULT_BATCH_SIZE):
+        """Joins this dataset to another a batch of rows at a time, see join
+
+        Yields:
+            list of tuple: the next batch of joined rows
+        """
+        join_columns = self._check_join_columns(other_dataset, join_columns)
+        batches = join_indices(row_keys(self._key_column_values(join_columns)),
+                               row_keys(other_dataset._key_column_values(join_columns)),
+                               how=how, batch_size=batch_size)
+        our_data = self.data
+        if how in (SEMI, ANTI):
+            for batch in batches:
+                yield [our_data[i] for i, _ in batch]
+            return
+
+        # only the other dataset's non key columns are copied into the joined rows
+        their_data = other_dataset.data
+        project = tuple_getter([other_dataset.columns.index(column_name) for column_name in other_dataset.columns
+                                if column_name not in join_columns])
+        missing = (None,) * (len(other_dataset.columns) - len(join_columns))
+        for batch in batches:
+            yield [our_data[i] + (project(their_data[j]) if j is not None else missing) for i, j in batch]
+
+    def _join_schema(self, other_dataset, how=INNER):
+        if how in (SEMI, ANTI):
+            return self.schema
+        if self.schema is None or other_dataset.schema is None:
+            return self.schema or other_dataset.schema
+        return self.schema.merge(other_dataset.schema.select(
+            [column_name for column_name in other_dataset.columns if column_name not in self.columns]
+        ))
+
+    def to_columnar(self):
+        """Returns:
+            ColumnarDataset: a column oriented copy of this dataset
+        """
+        from columnar import ColumnarDataset
+        return ColumnarDataset.from_rows(self.name, self.columns, self.data, schema=self.schema)
+
+    def __len__(self):
+        return len(self.data)
 
     def __repr__(self):
         return str((self.name, self.columns, self.data))
@@ -220,8 +667,7 @@ if __name__ == '__main__':
         .populate(os.path.join('data', 'ad_report.csv'))\
         .between_filter('date', '2017-05-01', '2017-06-01')\
         .group_by_and_aggregate(('asin',), 'sales', sum)\
-        .sort_by('sales', reverse=True)\
-        .limit(1)\
+        .top_n('sales', 1, descending=True)\
         .inner_join(product_report, 'asin')
 
     print(answer)
@@ -0,0 +1,285 @@
+"""Computed columns, built out of columns and constants with arithmetic, safe division and conditionals.
+
+Like a predicate, an expression can be compiled against a list of column names into a function of a row tuple,
+or evaluated against a ColumnarDataset into a list with one value per row, one operator at a time over whole
+columns. Arithmetic on a missing value gives a missing value, and so does dividing by zero.
+"""
+import operator
+
+from predicates import parse_predicate
+
+ARITHMETIC_OPERATORS = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+}
+
+# the ratio metrics of an ad report, as (numerator, denominator) columns. Grouped, each one is the ratio of the
+# sums of its columns, see aggregators.Ratio
+METRICS = {
+    'ctr': ('clicks', 'impressions'),
+    'cpc': ('ad_spend', 'clicks'),
+    'acos': ('ad_spend', 'sales'),
+    'roas': ('sales', 'ad_spend'),
+}
+
+
+def _null_safe(function):
+    return lambda left, right: None if left is None or right is None else function(left, right)
+
+
+def _divide(numerator, denominator):
+    if numerator is None or not denominator:
+        return None
+    return numerator / denominator
+
+
+def as_expression(value):
+    """Returns:
+        Expression: the value if it is an expression, otherwise a Constant of it
+    """
+    return value if isinstance(value, Expression) else Constant(value)
+
+
+class Expression(object):
+    """Base class for expressions. Expressions can be combined with +, -, * and /"""
+
+    def columns(self):
+        """Returns:
+            set of str: the column names this expression reads
+        """
+        raise NotImplementedError
+
+    def compile(self, columns):
+        """Compiles this expression into a function that computes its value for a single row
+
+        Args:
+            columns (list of str): the column names of the rows it will be computed for
+
+        Returns:
+            callable: a function that takes a row tuple and returns the value
+        """
+        raise NotImplementedError
+
+    def evaluate(self, dataset):
+        """Computes this expression for every row of a ColumnarDataset at once
+
+        Args:
+            dataset (ColumnarDataset): the dataset to evaluate against
+
+        Returns:
+            list: one value per row
+        """
+        raise NotImplementedError
+
+    def bind(self, schema):
+        """See Predicate.bind"""
+        return self
+
+    def __add__(self, other):
+        return Arithmetic('+', self, other)
+
+    def __radd__(self, other):
+        return Arithmetic('+', other, self)
+
+    def __sub__(self, other):
+        return Arithmetic('-', self, other)
+
+    def __rsub__(self, other):
+        return Arithmetic('-', other, self)
+
+    def __mul__(self, other):
+        return Arithmetic('*', self, other)
+
+    def __rmul__(self, other):
+        return Arithmetic('*', other, self)
+
+    def __truediv__(self, other):
+        return Divide(self, other)
+
+    def __rtruediv__(self, other):
+        return Divide(other, self)
+
+
+class Field(Expression):
+    """The value of a column"""
+
+    def __init__(self, column_name):
+        self.column_name = column_name
+
+    def columns(self):
+        return {self.column_name}
+
+    def compile(self, columns):
+        index = columns.index(self.column_name)
+        return lambda row: row[index]
+
+    def evaluate(self, dataset):
+        return dataset.get_column_data(self.column_name).to_list()
+
+    def __repr__(self):
+        return self.column_name
+
+
+class Constant(Expression):
+    def __init__(self, value):
+        self.value = value
+
+    def columns(self):
+        return set()
+
+    def compile(self, columns):
+        value = self.value
+        return lambda row: value
+
+    def evaluate(self, dataset):
+        return [self.value] * len(dataset)
+
+    def __repr__(self):
+        return repr(self.value)
+
+
+class Arithmetic(Expression):
+    """Adds, subtracts or multiplies two expressions, e.g. Arithmetic('-', Field('sales'), Field('ad_spend'))"""
+
+    def __init__(self, op, left, right):
+        if op not in ARITHMETIC_OPERATORS:
+            raise ValueError('arithmetic operator {} is not supported'.format(op))
+        self.op = op
+        self.left = as_expression(left)
+        self.right = as_expression(right)
+
+    def columns(self):
+        return self.left.columns() | self.right.columns()
+
+    def compile(self, columns):
+        function = _null_safe(ARITHMETIC_OPERATORS[self.op])
+        left, right = self.left.compile(columns), self.right.compile(columns)
+        return lambda row: function(left(row), right(row))
+
+    def bind(self, schema):
+        return Arithmetic(self.op, self.left.bind(schema), self.right.bind(schema))
+
+    def evaluate(self, dataset):
+        function = ARITHMETIC_OPERATORS[self.op]
+        left, right = self.left.evaluate(dataset), self.right.evaluate(dataset)
+        try:
+            return list(map(function, left, right))
+        except TypeError:
+            # only columns with missing values take the slower null checking path
+            return list(map(_null_safe(function), left, right))
+
+    def __repr__(self):
+        return '({!r} {} {!r})'.format(self.left, self.op, self.right)
+
+
+class Divide(Expression):
+    """Divides two expressions, giving the default rather than an error where the denominator is zero or missing"""
+
+    def __init__(self, numerator, denominator, default=None):
+        self.numerator = as_expression(numerator)
+        self.denominator = as_expression(denominator)
+        self.default = default
+
+    def columns(self):
+        return self.numerator.columns() | self.denominator.columns()
+
+    def compile(self, columns):
+        numerator, denominator = self.numerator.compile(columns), self.denominator.compile(columns)
+        default = self.default
+
+        def divide(row):
+            result = _divide(numerator(row), denominator(row))
+            return default if result is None else result
+
+        return divide
+
+    def bind(self, schema):
+        return Divide(self.numerator.bind(schema), self.denominator.bind(schema), default=self.default)
+
+    def evaluate(self, dataset):
+        numerator, denominator = self.numerator.evaluate(dataset), self.denominator.evaluate(dataset)
+        try:
+            return list(map(operator.truediv, numerator, denominator))
+        except (TypeError, ZeroDivisionError):
+            results = list(map(_divide, numerator, denominator))
+            if self.default is not None:
+                results = [self.default if result is None else result for result in results]
+            return results
+
+    def __repr__(self):
+        return '({!r} / {!r})'.format(self.numerator, self.denominator)
+
+
+class Conditional(Expression):
+    """Takes the value of one expression where a predicate passes, and another where it fails"""
+
+    def __init__(self, predicate, then, otherwise=None):
+        self.predicate = predicate
+        self.then = as_expression(then)
+        self.otherwise = as_expression(otherwise)
+
+    def columns(self):
+        return self.predicate.columns() | self.then.columns() | self.otherwise.columns()
+
+    def compile(self, columns):
+        test = self.predicate.compile(columns)
+        then, otherwise = self.then.compile(columns), self.otherwise.compile(columns)
+        return lambda row: then(row) if test(row) else otherwise(row)
+
+    def bind(self, schema):
+        return Conditional(self.predicate.bind(schema), self.then.bind(schema), self.otherwise.bind(schema))
+
+    def evaluate(self, dataset):
+        mask = self.predicate.evaluate(dataset)
+        then, otherwise = self.then.evaluate(dataset), self.otherwise.evaluate(dataset)
+        return [a if passed else b for passed, a, b in zip(mask, then, otherwise)]
+
+    def __repr__(self):
+        return '({!r} if {!r} else {!r})'.format(self.then, self.predicate, self.otherwise)
+
+
+def metric(name):
+    """Returns:
+        Expression: the per row value of one of the METRICS, e.g. metric('acos') is ad_spend / sales
+    """
+    if name not in METRICS:
+        raise ValueError('metric {} is not supported'.format(name))
+    numerator, denominator = METRICS[name]
+    return Divide(Field(numerator), Field(denominator))
+
+
+def parse_expression(spec):
+    """Builds an expression out of its JSON representation, as used by the DatasetAPI:
+
+    <column name>
+    <number>
+    {"value": <value>}
+    {"op": "+" | "-" | "*" | "/", "left": <expression>, "right": <expression>}
+    {"op": "if", "predicate": <predicate, see parse_predicate>, "then": <expression>, "else": <expression>}
+    {"metric": "ctr" | "cpc" | "acos" | "roas"}
+
+    Args:
+        spec (str or number or dict): one of the above formats
+
+    Returns:
+        Expression: the parsed expression
+    """
+    if isinstance(spec, str):
+        return Field(spec)
+    if not isinstance(spec, dict):
+        return Constant(spec)
+    if 'value' in spec:
+        return Constant(spec['value'])
+    if 'metric' in spec:
+        return metric(spec['metric'])
+
+    op = spec['op']
+    if op in ARITHMETIC_OPERATORS:
+        return Arithmetic(op, parse_expression(spec['left']), parse_expression(spec['right']))
+    elif op == '/':
+        return Divide(parse_expression(spec['left']), parse_expression(spec['right']), default=spec.get('default'))
+    elif op == 'if':
+        return Conditional(parse_predicate(spec['predicate']), parse_expression(spec['then']),
+                           parse_expression(spec.get('else')))
+    raise ValueError('expression op {} is not supported'.format(op))
@@ -0,0 +1,162 @@
+"""Sorting and joining data that does not fit in memory.
+
+external_sort sorts its input run_size rows at a time, spilling each sorted run to a temporary file, and then
+merges the runs, so at most one run and one block per run are held at once. external_join joins inputs in any order
+by sorting the sides that are not already sorted on disk and merge joining them, see joins.merge_join. When the
+joined rows are needed in the order of the left side and it was sorted, they are sorted back on disk.
+
+Dataset.from_sorted and Dataset.from_join build datasets out of a csv this way, without loading it first.
+Dataset.sort_by and Dataset.join use them past max_rows and max_hash_rows rows, and a DatasetAPI given a run_size
+uses them for the sorts and joins of csvs larger than its spill_bytes.
+"""
+import csv
+import heapq
+import pickle
+import tempfile
+from itertools import islice
+from operator import itemgetter
+
+from joins import INNER, JOIN_TYPES, merge_join
+from reader import CsvReader, read_header
+
+DEFAULT_RUN_SIZE = 100000
+# the default number of rows past which an in-memory sort or hash join spills to disk
+MAX_MEMORY_ROWS = 1000000
+# the default size in bytes past which a DatasetAPI given a run_size sorts or joins a csv on disk
+DEFAULT_SPILL_BYTES = 64 * 1024 * 1024
+# rows are pickled to and from a run file this many at a time
+BLOCK_SIZE = 1000
+
+
+def _write_run(rows, directory):
+    run_file = tempfile.TemporaryFile(dir=directory)
+    for start in range(0, len(rows), BLOCK_SIZE):
+        pickle.dump(rows[start:start + BLOCK_SIZE], run_file, protocol=pickle.HIGHEST_PROTOCOL)
+    run_file.seek(0)
+    return run_file
+
+
+def _read_run(run_file):
+    with run_file:
+        while True:
+            try:
+                block = pickle.load(run_file)
+            except EOFError:
+                return
+            for row in block:
+                yield row
+
+
+def external_sort(rows, key=None, reverse=False, run_size=DEFAULT_RUN_SIZE, directory=None):
+    """Sorts rows with bounded memory. Like sorted, the sort is stable
+
+    Args:
+        rows (iterable): the rows to sort, which are only iterated once
+        key (callable): a function of a row to sort by, the rows themselves if not passed
+        reverse (bool): if true, sorts in descending order
+        run_size (int): the number of rows sorted in memory at a time
+        directory (str): where the runs are spilled, the system's temporary directory if not passed
+
+    Yields:
+        object: the rows in sorted order
+    """
+    rows = iter(rows)
+    run = sorted(islice(rows, run_size), key=key, reverse=reverse)
+    if len(run) < run_size:
+        # everything fit in a single run
+        for row in run:
+            yield row
+        return
+
+    run_files = []
+    try:
+        while run:
+            run_files.append(_write_run(run, directory))
+            run = sorted(islice(rows, run_size), key=key, reverse=reverse)
+        # merge takes equal rows from earlier runs first, which keeps the sort stable
+        for row in heapq.merge(*[_read_run(run_file) for run_file in run_files], key=key, reverse=reverse):
+            yield row
+    finally:
+        for run_file in run_files:
+            run_file.close()
+
+
+def _missing_last(item):
+    # rows without a key sort after every other row, rather than failing to compare with them
+    return item[0] is None, item[0]
+
+
+def external_join(left, right, left_key, right_key, how=INNER, run_size=DEFAULT_RUN_SIZE, directory=None,
+                  left_sorted=False, right_sorted=False, ordered=True):
+    """Joins two row iterables in any order with bounded memory, giving the same pairs as joins.join_indices. Both
+    sides are sorted on their keys with external_sort, unless they are already sorted, and joined with merge_join.
+    Each sort holds at most run_size rows at a time. Keys must be comparable with each other, as for a sort
+
+    Args:
+        left (iterable): the left rows, which are only iterated once
+        right (iterable): the right rows, which are only iterated once
+        left_key (callable): a function of a left row that returns its key
+        right_key (callable): a function of a right row that returns its key
+        how (str): 'inner', 'left', 'semi' or 'anti', see joins.join_indices
+        run_size (int): the number of rows sorted in memory at a time
+        directory (str): where the runs are spilled
+        left_sorted (bool): if true, the left rows are already in ascending order of their keys, see
+            joins.is_sorted, and are not sorted again
+        right_sorted (bool): if true, the right rows are already in ascending order of their keys
+        ordered (bool): if true, the pairs are in the order of the left rows, as with join_indices, and a left side
+            that had to be sorted is sorted back into its order. Otherwise they are in order of their keys
+
+    Yields:
+        tuple: the (left row, right row) pairs, see merge_join
+    """
+    if how not in JOIN_TYPES:
+        raise ValueError('join type {} is not supported'.format(how))
+    key = itemgetter(0)
+    keyed_left = ((left_key(row), i, row) for i, row in enumerate(left))
+    if not left_sorted:
+        keyed_left = external_sort(keyed_left, key=_missing_last, run_size=run_size, directory=directory)
+    keyed_right = ((key, row) for key, row in ((right_key(row), row) for row in right) if key is not None)
+    if not right_sorted:
+        keyed_right = external_sort(keyed_right, key=key, run_size=run_size, directory=directory)
+    # each left row keeps its index, which the joined rows can be sorted back by
+    joined = ((left_item[1], left_item[2], right_item[1] if right_item is not None else None)
+              for left_item, right_item in merge_join(keyed_left, keyed_right, key, key, how=how))
+    if ordered and not left_sorted:
+        joined = external_sort(joined, key=key, run_size=run_size, directory=directory)
+    for _, left_row, right_row in joined:
+        yield left_row, right_row
+
+
+def sort_csv(csv_path, output_path, column_names, reverse=False, run_size=DEFAULT_RUN_SIZE, schema=None,
+             directory=None):
+    """Sorts the rows of a csv into a new csv with bounded memory. Cells are written back exactly as they were
+    read, only the sort columns are parsed
+
+    Args:
+        csv_path (str): the path to the csv
+        output_path (str): the path to write the sorted csv to
+        column_names (str or list of str): the column, or columns in order of priority, to sort by
+        reverse (bool): if true, sorts in descending order
+        run_size (int): the number of rows sorted in memory at a time
+        schema (Schema or dict or str): the types the sort columns are compared as, see Dataset.populate
+        directory (str): where the runs are spilled
+    """
+    column_names = [column_names] if isinstance(column_names, str) else list(column_names)
+    header = read_header(csv_path)
+    # a reader of only the sort columns, to work out their types and validate them
+    parse_key = CsvReader(csv_path, columns=column_names, schema=schema).schema.row_parser(header, column_names)
+
+    def rows():
+        with open(csv_path) as csv_file:
+            csv_reader = csv.reader(csv_file, delimiter=',')
+            next(csv_reader, None)
+            for row in csv_reader:
+                yield parse_key(row), row
+
+    # sort on the parsed key only, the raw row is never compared
+    sorted_rows = external_sort(rows(), key=lambda item: item[0], reverse=reverse, run_size=run_size,
+                                directory=directory)
+    with open(output_path, 'w', newline='') as output_file:
+        csv_writer = csv.writer(output_file, delimiter=',', lineterminator='\n')
+        csv_writer.writerow(header)
+        csv_writer.writerows(row for _, row in sorted_rows)
@@ -0,0 +1,235 @@
+"""Hash and merge joins between two datasets.
+
+The smaller side of a join is built into a hash table of row indices, and the other side probes it, so only the
+keys of the smaller side are held and no rows are copied until the joined rows are emitted. When both sides are
+already sorted on their keys they are merge joined instead, which holds no hash table. Joined rows are emitted in
+batches, in the order of the left side's rows and then the order of their matches on the right side, whichever
+strategy was used. Joins of inputs too large to hash are done on disk instead, see external.external_join.
+
+Missing keys (None) never match, and a key of several columns is missing if any of its columns is.
+"""
+from itertools import islice
+from operator import itemgetter, le
+
+INNER = 'inner'
+LEFT = 'left'
+SEMI = 'semi'
+ANTI = 'anti'
+JOIN_TYPES = (INNER, LEFT, SEMI, ANTI)
+
+HASH = 'hash'
+MERGE = 'merge'
+STRATEGIES = (HASH, MERGE)
+
+DEFAULT_BATCH_SIZE = 10000
+
+
+def row_keys(key_columns):
+    """Combines the values of one or more key columns into one hashable key per row
+
+    Args:
+        key_columns (list of sequence): the values of each key column
+
+    Returns:
+        sequence: one key per row, the value itself for a single column and a tuple otherwise, None if any of the
+            values are missing
+    """
+    if len(key_columns) == 1:
+        return key_columns[0]
+    return [None if None in key else key for key in zip(*key_columns)]
+
+
+def row_key(indices):
+    """Returns:
+        callable: a function of a row that returns its key out of the key columns at the given indices, see row_keys
+    """
+    if len(indices) == 1:
+        return itemgetter(indices[0])
+    get = itemgetter(*indices)
+
+    def key(row):
+        values = get(row)
+        return None if None in values else values
+
+    return key
+
+
+def is_sorted(keys):
+    """Returns:
+        bool: true if the keys that are not missing are in ascending order, so that they can be merge joined
+    """
+    if None in keys:
+        keys = [key for key in keys if key is not None]
+    try:
+        return all(map(le, keys, islice(keys, 1, None)))
+    except TypeError:
+        # keys of several types have no order
+        return False
+
+
+def merge_join(left, right, left_key, right_key, how=INNER):
+    """Joins two row iterables that are sorted in ascending order of their keys, see is_sorted. Only the right rows
+    that share the current key are held
+
+    Args:
+        left (iterable): the left rows
+        right (iterable): the right rows
+        left_key (callable): a function of a left row that returns its key
+        right_key (callable): a function of a right row that returns its key
+        how (str): 'inner', 'left', 'semi' or 'anti', see join_indices
+
+    Yields:
+        tuple: the (left row, right row) pairs with equal keys, in left order and then right order. The right row
+            is None for the left rows of a left join without a match, and for every row of a semi or anti join.
+            Missing keys (None) never match
+    """
+    if how not in JOIN_TYPES:
+        raise ValueError('join type {} is not supported'.format(how))
+    right = iter(right)
+    right_row = next(right, None)
+    group_key, group, grouped = None, [], False
+    for left_row in left:
+        key = left_key(left_row)
+        if key is None:
+            matches = ()
+        else:
+            if not grouped or group_key != key:
+                # move the right side up to this key
+                while right_row is not None and (right_key(right_row) is None or right_key(right_row) < key):
+                    right_row = next(right, None)
+                group_key, group, grouped = key, [], True
+                while right_row is not None and right_key(right_row) == key:
+                    group.append(right_row)
+                    right_row = next(right, None)
+            matches = group
+
+        if how == SEMI or how == ANTI:
+            if bool(matches) == (how == SEMI):
+                yield left_row, None
+            continue
+        for matched_row in matches:
+            yield left_row, matched_row
+        if not matches and how == LEFT:
+            yield left_row, None
+
+
+def _index(keys):
+    """Returns:
+        dict: the row indices of each key, in row order
+    """
+    index = {}
+    for i, key in enumerate(keys):
+        if key is None:
+            continue
+        rows = index.get(key)
+        if rows is None:
+            index[key] = [i]
+        else:
+            rows.append(i)
+    return index
+
+
+def _split(pairs, batch_size):
+    """Yields the pairs in batches of at most batch_size"""
+    for start in range(0, len(pairs), batch_size):
+        yield pairs[start:start + batch_size]
+
+
+def _filter_pairs(left_keys, right_keys, keep_matched, batch_size):
+    """Yields the (left index, None) pairs of the left rows with, or without, a match on the right"""
+    if len(right_keys) <= len(left_keys):
+        matched = set(right_keys)
+    else:
+        # only hold the distinct keys of the smaller left side
+        left_set = set(left_keys)
+        matched = {key for key in right_keys if key in left_set}
+    matched.discard(None)
+    contains = matched.__contains__
+    for start in range(0, len(left_keys), batch_size):
+        batch = [(i, None) for i, found in enumerate(map(contains, left_keys[start:start + batch_size]), start)
+                 if found == keep_matched]
+        if batch:
+            yield batch
+
+
+def _pairs(matches, start, outer):
+    """Returns:
+        list of tuple: the pairs of a run of left rows, given the list of right indices each one matches
+    """
+    pairs = []
+    for i, rows in enumerate(matches, start):
+        if rows:
+            if len(rows) == 1:
+                pairs.append((i, rows[0]))
+            else:
+                pairs.extend([(i, j) for j in rows])
+        elif outer:
+            pairs.append((i, None))
+    return pairs
+
+
+def _probe_right(left_keys, right_keys, outer, batch_size):
+    # missing keys are never indexed, so they find no matches
+    get = _index(right_keys).get
+    for start in range(0, len(left_keys), batch_size):
+        for batch in _split(_pairs(map(get, left_keys[start:start + batch_size]), start, outer), batch_size):
+            yield batch
+
+
+def _probe_left(left_keys, right_keys, outer, batch_size):
+    index = _index(left_keys)
+    matches = {}
+    for j, key in enumerate(right_keys):
+        for i in index.get(key, ()):
+            rows = matches.get(i)
+            if rows is None:
+                matches[i] = [j]
+            else:
+                rows.append(j)
+
+    # emit in left order, whatever order the matches were found in
+    get = matches.get
+    for start in range(0, len(left_keys), batch_size):
+        rows = map(get, range(start, min(start + batch_size, len(left_keys))))
+        for batch in _split(_pairs(rows, start, outer), batch_size):
+            yield batch
+
+
+def _merge_pairs(left_keys, right_keys, how, batch_size):
+    key = itemgetter(1)
+    pairs = ((left_item[0], right_item[0] if right_item is not None else None)
+             for left_item, right_item in merge_join(enumerate(left_keys), enumerate(right_keys), key, key, how=how))
+    for batch in iter(lambda: list(islice(pairs, batch_size)), []):
+        yield batch
+
+
+def join_indices(left_keys, right_keys, how=INNER, batch_size=DEFAULT_BATCH_SIZE, strategy=None):
+    """Matches the rows of two datasets by key
+
+    Args:
+        left_keys (sequence): the key of each left row, see row_keys
+        right_keys (sequence): the key of each right row
+        how (str): 'inner' for every matching pair of rows, 'left' to also keep left rows without a match, 'semi'
+            for the left rows with a match and 'anti' for the left rows without one
+        batch_size (int): the maximum number of pairs in each batch
+        strategy (str): 'hash' or 'merge'. By default the sides are merge joined when both are sorted on their
+            keys, and hash joined otherwise
+
+    Yields:
+        list of tuple: the next batch of (left index, right index) pairs. The right index is None for the left
+            rows of a left join that have no match, and for every row of a semi or anti join
+    """
+    if how not in JOIN_TYPES:
+        raise ValueError('join type {} is not supported'.format(how))
+    if strategy is None:
+        strategy = MERGE if is_sorted(left_keys) and is_sorted(right_keys) else HASH
+    elif strategy not in STRATEGIES:
+        raise ValueError('join strategy {} is not supported'.format(strategy))
+
+    if strategy == MERGE:
+        return _merge_pairs(left_keys, right_keys, how, batch_size)
+    elif how in (SEMI, ANTI):
+        return _filter_pairs(left_keys, right_keys, how == SEMI, batch_size)
+    elif len(right_keys) <= len(left_keys):
+        return _probe_right(left_keys, right_keys, how == LEFT, batch_size)
+    return _probe_left(left_keys, right_keys, how == LEFT, batch_size)
@@ -0,0 +1,160 @@
+"""A load test harness for the HTTP service, see service.py.
+
+A number of concurrent clients each keep one connection open and send requests one after another, until the total
+number of requests has been sent. The report gives the throughput and the latency percentiles of the requests.
+
+    python loadtest.py --serve --payload request.json --requests 2000 --concurrency 32
+
+--serve starts a service in this process against the local csvs the payload names, otherwise --host and --port
+point at a running one. The payload file holds one request, or a list of requests that the clients take turns
+sending.
+"""
+import argparse
+import asyncio
+import json
+import math
+import time
+
+from service import DEFAULT_CACHE_SIZE, DatasetService
+
+DEFAULT_REQUESTS = 1000
+DEFAULT_CONCURRENCY = 16
+
+
+def percentile(values, q):
+    """Returns:
+        float: the nearest rank q-th percentile of sorted values, None if there are none
+    """
+    if not values:
+        return None
+    rank = max(int(math.ceil(q / 100.0 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+async def post(reader, writer, host, path, body):
+    """Sends one request over an open connection and reads its response
+
+    Returns:
+        tuple of int, bytes: the status and body of the response
+    """
+    writer.write('POST {} HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'
+                 .format(path, host, len(body)).encode('latin-1') + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    chunked = False
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+        elif name.strip().lower() == 'transfer-encoding':
+            chunked = value.strip().lower() == 'chunked'
+    if not chunked:
+        return status, await reader.readexactly(length)
+    chunks = []
+    while True:
+        length = int((await reader.readline()).split(b';')[0], 16)
+        # each chunk ends with a line break, and the last one is empty
+        chunks.append((await reader.readexactly(length + 2))[:-2])
+        if not length:
+            return status, b''.join(chunks)
+
+
+async def run(host, port, payloads, requests=DEFAULT_REQUESTS, concurrency=DEFAULT_CONCURRENCY, path='/query'):
+    """Sends requests from concurrent clients and measures them
+
+    Args:
+        host (str): the service's host
+        port (int): the service's port
+        payloads (list of dict): the requests to send, in turn
+        requests (int): the total number of requests
+        concurrency (int): the number of clients
+        path (str): the path the requests are sent to
+
+    Returns:
+        dict: the number of requests and errors, the statuses of the errors, the elapsed seconds, the requests per
+            second and the p50, p90, p99 and max latencies in milliseconds
+    """
+    bodies = [json.dumps(payload).encode() for payload in payloads]
+    latencies = []
+    errors = {}
+    sent = [0]
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            while sent[0] < requests:
+                body = bodies[sent[0] % len(bodies)]
+                sent[0] += 1
+                start = time.perf_counter()
+                status, _ = await post(reader, writer, host, path, body)
+                latencies.append((time.perf_counter() - start) * 1000)
+                if status != 200:
+                    errors[status] = errors.get(status, 0) + 1
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': sum(errors.values()),
+        'error_statuses': errors,
+        'seconds': elapsed,
+        'requests_per_second': len(latencies) / elapsed if elapsed else None,
+        'p50_ms': percentile(latencies, 50),
+        'p90_ms': percentile(latencies, 90),
+        'p99_ms': percentile(latencies, 99),
+        'max_ms': latencies[-1] if latencies else None,
+    }
+
+
+async def run_with_service(service, payloads, requests=DEFAULT_REQUESTS, concurrency=DEFAULT_CONCURRENCY):
+    """Starts a service on a free port, runs the load test against it and stops it
+
+    Returns:
+        dict: see run
+    """
+    server = await service.start('127.0.0.1', 0)
+    try:
+        port = server.sockets[0].getsockname()[1]
+        return await run('127.0.0.1', port, payloads, requests=requests, concurrency=concurrency)
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures the throughput and latency of the HTTP service')
+    parser.add_argument('--payload', required=True, help='a JSON file of a request, or a list of requests')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--requests', type=int, default=DEFAULT_REQUESTS)
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--serve', action='store_true', help='start a service in this process to test')
+    parser.add_argument('--workers', type=int, default=None, help='the workers of the started service')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE,
+                        help='the cache size of the started service, 0 to measure every request running')
+    args = parser.parse_args()
+
+    with open(args.payload) as payload_file:
+        payloads = json.load(payload_file)
+    if isinstance(payloads, dict):
+        payloads = [payloads]
+
+    if args.serve:
+        service = DatasetService(workers=args.workers, cache_size=args.cache_size)
+        try:
+            report = asyncio.run(run_with_service(service, payloads, args.requests, args.concurrency))
+        finally:
+            service.close()
+    else:
+        report = asyncio.run(run(args.host, args.port, payloads, args.requests, args.concurrency))
+    print(json.dumps(report, indent=2))
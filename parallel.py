@@ -0,0 +1,226 @@
+"""Parallel execution of scans, filters and aggregations over partitions of a dataset.
+
+A csv is split into byte ranges that each start at the start of a row, see reader.byte_ranges, a partitioned
+dataset into the partitions that may hold rows passing the scan's predicate, and a loaded dataset into ranges of
+rows. Each partition is processed by a worker process of a pool the executor keeps for every operation: scans are
+sent the path and byte range to read and return their rows, filters are sent their range of rows and return a
+mask, and aggregations are sent their range of rows and return the partial accumulators of each of their groups,
+see Dataset.partial_aggregate. The results are combined in partition order, so rows and groups come out in the
+same order as they would serially.
+
+With a single worker, or on a single cpu, where worker processes only add the cost of sending them partitions,
+every operation runs serially.
+
+Sums are exact, so sums, means and ratios are identical to a serial run, as are counts, minimums, maximums and
+first and last values. Merged variances can differ from a serial run in the last few bits.
+"""
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+from aggregators import aggregate_column_names, resolve_aggregations
+from dataset import merge_groups
+from partitioned import PartitionedReader, is_partitioned, open_reader
+from reader import byte_ranges
+
+# the approximate number of bytes of csv in each partition
+DEFAULT_PARTITION_SIZE = 16 * 1024 * 1024
+# the number of rows of a loaded dataset in each partition
+DEFAULT_PARTITION_ROWS = 100000
+
+
+def _scan_partition(dataset_class, csv_path, byte_range, columns, predicate, schema, limit):
+    dataset = dataset_class('partition').populate(csv_path, limit=limit, columns=columns, predicate=predicate,
+                                                  schema=schema, byte_range=byte_range)
+    return dataset.data
+
+
+def _scan_aggregate_partition(dataset_class, csv_path, byte_range, columns, predicate, schema, group_by_columns,
+                              aggregations):
+    dataset = dataset_class('partition').populate(csv_path, columns=columns, predicate=predicate, schema=schema,
+                                                  byte_range=byte_range)
+    return dataset.partial_aggregate(group_by_columns, aggregations)
+
+
+def _mask_partition(partition, predicate):
+    return partition.mask(predicate)
+
+
+def _aggregate_partition(partition, group_by_columns, aggregations):
+    return partition.partial_aggregate(group_by_columns, aggregations)
+
+
+def cpu_count():
+    """Returns:
+        int: the number of cpus this process can run on
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _picklable(*objects):
+    """Returns:
+        bool: true if the objects can be sent to a worker process, aggregations of lambdas for example cannot
+    """
+    try:
+        pickle.dumps(objects)
+    except (pickle.PicklingError, AttributeError, TypeError):
+        return False
+    return True
+
+
+class ParallelExecutor(object):
+    """Runs scans, filters and aggregations over partitions of a dataset in a pool of worker processes. Operations
+    with a single partition, or that cannot be sent to a worker, run serially. The pool is started by the first
+    operation that uses it and kept until close, or the end of a with block"""
+
+    def __init__(self, workers=None, partition_size=DEFAULT_PARTITION_SIZE, partition_rows=DEFAULT_PARTITION_ROWS):
+        """
+        Args:
+            workers (int): the number of worker processes, the number of cpus by default
+            partition_size (int): the approximate number of bytes of csv in each partition
+            partition_rows (int): the number of rows of a loaded dataset in each partition
+        """
+        self.workers = workers or cpu_count()
+        self.partition_size = partition_size
+        self.partition_rows = partition_rows
+        # whether operations are split between worker processes, see the module docstring
+        self.parallel = self.workers > 1 and cpu_count() > 1
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        """Stops the worker processes"""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _map(self, function, partitions):
+        """Calls function on each partition in the pool
+
+        Returns:
+            list: the result of each partition, in partition order
+        """
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        futures = [self._pool.submit(function, *partition) for partition in partitions]
+        return [future.result() for future in futures]
+
+    def _csv_partitions(self, csv_path, predicate):
+        """Returns:
+            list of tuple: the (csv path, byte range) of each partition of a csv or a partitioned dataset
+        """
+        if not self.parallel:
+            return []
+        if is_partitioned(csv_path):
+            return [(path, None) for path in PartitionedReader(csv_path, predicate=predicate).paths()]
+        return [(csv_path, byte_range) for byte_range in byte_ranges(csv_path, self.partition_size)]
+
+    def _row_ranges(self, dataset):
+        if not self.parallel:
+            return []
+        return [(start, min(start + self.partition_rows, len(dataset)))
+                for start in range(0, len(dataset), self.partition_rows)]
+
+    def populate(self, dataset_class, name, csv_path, limit=None, columns=None, predicate=None, schema=None):
+        """Loads a dataset from a csv, see Dataset.populate
+
+        Args:
+            dataset_class (type): Dataset or ColumnarDataset
+            name (str): the name of the new dataset
+
+        Returns:
+            Dataset: the new dataset, an instance of dataset_class
+        """
+        partitions = self._csv_partitions(csv_path, predicate)
+        if len(partitions) <= 1 or not _picklable(predicate):
+            return dataset_class(name).populate(csv_path, limit=limit, columns=columns, predicate=predicate,
+                                                schema=schema)
+
+        # the schema is resolved once, so that every partition parses its rows the same way
+        reader = open_reader(csv_path, columns=columns, predicate=predicate, schema=schema)
+        parts = self._map(_scan_partition, [(dataset_class, path, byte_range, reader.columns, predicate,
+                                             reader.schema, limit) for path, byte_range in partitions])
+        rows = [row for part in parts for row in part]
+        if limit is not None:
+            rows = rows[:limit]
+        return dataset_class.from_rows(name, reader.columns, rows, schema=reader.schema.select(reader.columns))
+
+    def scan_aggregate(self, dataset_class, name, csv_path, group_by_columns, aggregations, columns=None,
+                       predicate=None, schema=None):
+        """Loads and aggregates a csv without loading all of its rows at once, see Dataset.aggregate. Each worker
+        only sends back the accumulators of the groups in its partition
+
+        Args:
+            dataset_class (type): Dataset or ColumnarDataset
+            name (str): the name of the aggregated dataset
+            csv_path (str): the path to the csv, or the directory of a partitioned dataset
+            group_by_columns (list of str): the columns to group by
+            aggregations (iterable of tuple): see aggregators.resolve_aggregations
+            columns (list of str): the columns to load, every column read by the aggregations by default
+            predicate (Predicate): if passed, only rows that pass this predicate are aggregated
+            schema (Schema or dict or str): the column types to parse with
+
+        Returns:
+            Dataset: the aggregated dataset
+        """
+        aggregations = resolve_aggregations(aggregations)
+        if columns is None:
+            columns = list(group_by_columns)
+            for aggregate_column, _, _ in aggregations:
+                columns += [column_name for column_name in aggregate_column_names(aggregate_column)
+                            if column_name not in columns]
+        partitions = self._csv_partitions(csv_path, predicate)
+        if len(partitions) <= 1 or not _picklable(predicate, aggregations):
+            dataset = dataset_class(name).populate(csv_path, columns=columns, predicate=predicate, schema=schema)
+            return dataset.aggregate(group_by_columns, aggregations)
+
+        reader = open_reader(csv_path, columns=columns, predicate=predicate, schema=schema)
+        parts = self._map(_scan_aggregate_partition, [(dataset_class, path, byte_range, reader.columns,
+                                                       predicate, reader.schema, group_by_columns, aggregations)
+                                                      for path, byte_range in partitions])
+        groups = {}
+        for part in parts:
+            merge_groups(groups, part)
+        empty = dataset_class(name, columns=reader.columns, schema=reader.schema.select(reader.columns))
+        return empty.from_groups(group_by_columns, aggregations, groups)
+
+    def where(self, dataset, predicate):
+        """Filters a loaded dataset, see Dataset.where
+
+        Returns:
+            Dataset: the rows of the dataset that pass the predicate
+        """
+        ranges = self._row_ranges(dataset)
+        if len(ranges) <= 1 or not _picklable(predicate):
+            return dataset.where(predicate)
+        masks = self._map(_mask_partition, [(dataset.row_range(start, end), predicate) for start, end in ranges])
+        return dataset.compress([passed for mask in masks for passed in mask])
+
+    def aggregate(self, dataset, group_by_columns, aggregations):
+        """Aggregates a loaded dataset, see Dataset.aggregate
+
+        Returns:
+            Dataset: the aggregated dataset
+        """
+        aggregations = resolve_aggregations(aggregations)
+        ranges = self._row_ranges(dataset)
+        if len(ranges) <= 1 or not _picklable(aggregations):
+            return dataset.aggregate(group_by_columns, aggregations)
+        parts = self._map(_aggregate_partition, [(dataset.row_range(start, end), group_by_columns, aggregations)
+                                                 for start, end in ranges])
+        groups = {}
+        for part in parts:
+            merge_groups(groups, part)
+        return dataset.from_groups(group_by_columns, aggregations, groups)
+
+    def group_by_and_aggregate(self, dataset, group_by_columns, aggregate_column, aggregation):
+        """See Dataset.group_by_and_aggregate, for Aggregator aggregations"""
+        return self.aggregate(dataset, group_by_columns, [(aggregate_column, aggregation)])
@@ -0,0 +1,294 @@
+"""Storage for a csv partitioned by a date column, with one csv per day or month.
+
+A partitioned dataset is a directory that holds one csv per partition and a manifest. The manifest records the
+partitions, and the minimum and maximum value of every column in each one. Reading with a predicate skips the
+partitions whose bounds show that none of their rows can pass, see Predicate.may_match. A date range filter
+therefore only reads the partitions that overlap the range. New rows are appended to the partition of their day
+or month, which is created if it does not exist yet, and no other partition is rewritten.
+
+Wherever Dataset.populate, and so the DatasetAPI, takes a csv path, the directory of a partitioned dataset can be
+passed instead. Partitions are read in the order their first rows were appended, and rows in the order they were
+appended within a partition, so a csv whose rows are grouped by day or month, such as a report with the newest day
+first, reads back in its own order, and limit, first and last give the same rows as on the csv. Rows of different
+partitions that were interleaved in the csv come back grouped by partition.
+"""
+import csv
+import json
+import os
+import tempfile
+from datetime import date
+from itertools import islice
+
+from reader import CsvReader, DEFAULT_CHUNK_SIZE, read_header as read_csv_header, read_sample, resolve_schema
+from schema import DATE, DEFAULT_SAMPLE_SIZE, Schema
+
+DAY = 'day'
+MONTH = 'month'
+# the length of the ISO date prefix that keys the partitions of each granularity
+GRANULARITIES = {
+    DAY: 10,
+    MONTH: 7,
+}
+MANIFEST = 'manifest.json'
+
+
+def is_partitioned(path):
+    """Returns:
+        bool: true if the path is the directory of a partitioned dataset
+    """
+    return os.path.isfile(os.path.join(path, MANIFEST))
+
+
+def read_header(path):
+    """Reads just the column names of a csv or a partitioned dataset, see reader.read_header"""
+    if is_partitioned(path):
+        return list(PartitionedStore(path).columns)
+    return read_csv_header(path)
+
+
+def data_size(path, predicate=None):
+    """Returns:
+        int: the size in bytes of a csv, or of the partitions of a partitioned dataset that may hold rows passing
+            the predicate
+    """
+    if is_partitioned(path):
+        store = PartitionedStore(path)
+        return sum(os.path.getsize(store.path(partition)) for partition in store.select(predicate))
+    return os.path.getsize(path)
+
+
+def open_reader(path, byte_range=None, **reader_args):
+    """Opens a reader over a csv or a partitioned dataset
+
+    Args:
+        path (str): the path to a csv, or the directory of a partitioned dataset
+        byte_range (tuple of int): see CsvReader, csvs only
+        **reader_args: the other arguments of CsvReader
+
+    Returns:
+        CsvReader or PartitionedReader: a reader of chunks of parsed rows
+    """
+    if is_partitioned(path):
+        if byte_range is not None:
+            raise ValueError('{} is partitioned and cannot be read by byte range'.format(path))
+        return PartitionedReader(path, **reader_args)
+    return CsvReader(path, byte_range=byte_range, **reader_args)
+
+
+def _encode(value):
+    return value.isoformat() if isinstance(value, date) else value
+
+
+class PartitionedStore(object):
+    """The directory of a partitioned dataset, see the module docstring. Rows are parsed with the schema inferred
+    from the first csv added, and the bounds of each column are the minimum and maximum of its parsed values"""
+
+    def __init__(self, directory):
+        """
+        Args:
+            directory (str): the directory of an existing partitioned dataset, see create
+        """
+        with open(os.path.join(directory, MANIFEST)) as manifest_file:
+            manifest = json.load(manifest_file)
+        self.directory = directory
+        self.column_name = manifest['column_name']
+        self.granularity = manifest['granularity']
+        self.columns = manifest['columns']
+        self.schema = Schema(manifest['types'], inferred=self.columns)
+        # in the order their first rows were appended
+        self.partitions = manifest['partitions']
+
+    @classmethod
+    def create(cls, directory, csv_path, column_name='date', granularity=DAY, sample_size=DEFAULT_SAMPLE_SIZE,
+               chunk_size=DEFAULT_CHUNK_SIZE):
+        """Partitions a csv into a new partitioned dataset
+
+        Args:
+            directory (str): the directory to create it in, which must not already hold one
+            csv_path (str): the path to the csv
+            column_name (str): the date column to partition by, with ISO formatted dates
+            granularity (str): 'day' or 'month'
+            sample_size (int): the number of leading rows used to infer column types
+            chunk_size (int): the number of rows held at once while partitioning
+
+        Returns:
+            PartitionedStore: the new partitioned dataset
+        """
+        if granularity not in GRANULARITIES:
+            raise ValueError('granularity {} is not supported'.format(granularity))
+        if is_partitioned(directory):
+            raise ValueError('{} already holds a partitioned dataset'.format(directory))
+        header, sample = read_sample(csv_path, sample_size)
+        if column_name not in header:
+            raise ValueError('column name {} does not exist'.format(column_name))
+
+        os.makedirs(directory, exist_ok=True)
+        _write_manifest(directory, {
+            'column_name': column_name,
+            'granularity': granularity,
+            'columns': header,
+            'types': Schema.infer(header, sample).types,
+            'partitions': [],
+        })
+        return cls(directory).append(csv_path, chunk_size=chunk_size)
+
+    def path(self, partition):
+        """Returns:
+            str: the path to the csv of one of the partitions
+        """
+        return os.path.join(self.directory, partition['path'])
+
+    def _key(self, cell):
+        try:
+            date.fromisoformat(cell[:GRANULARITIES[DAY]])
+        except ValueError:
+            raise ValueError('{!r} in column {} is not an ISO date'.format(cell, self.column_name))
+        return cell[:GRANULARITIES[self.granularity]]
+
+    def append(self, csv_path, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Appends the rows of a csv with the same columns. Rows are added to the end of the partition of their
+        day or month, and the bounds of the partitions they were added to are widened
+
+        Args:
+            csv_path (str): the path to the csv
+            chunk_size (int): the number of rows held at once
+
+        Returns:
+            PartitionedStore: self
+        """
+        header = read_csv_header(csv_path)
+        if header != self.columns:
+            raise ValueError('the columns of {} do not match {}'.format(csv_path, self.columns))
+
+        index = header.index(self.column_name)
+        parse_row = self.schema.row_parser(header, header)
+        partitions = {partition['key']: partition for partition in self.partitions}
+        with open(csv_path) as csv_file:
+            csv_reader = csv.reader(csv_file, delimiter=',')
+            next(csv_reader, None)
+            for chunk in iter(lambda: list(islice(csv_reader, chunk_size)), []):
+                rows_by_key = {}
+                for row in chunk:
+                    rows_by_key.setdefault(self._key(row[index]), []).append(row)
+                for key, rows in rows_by_key.items():
+                    if key not in partitions:
+                        partitions[key] = {'key': key, 'path': key + '.csv', 'rows': 0, 'bounds': {}}
+                    self._append_rows(partitions[key], rows, parse_row)
+
+        # the manifest is only replaced once every row is written
+        self.partitions = list(partitions.values())
+        _write_manifest(self.directory, {
+            'column_name': self.column_name,
+            'granularity': self.granularity,
+            'columns': self.columns,
+            'types': self.schema.types,
+            'partitions': self.partitions,
+        })
+        return self
+
+    def _append_rows(self, partition, rows, parse_row):
+        path = self.path(partition)
+        new = not os.path.exists(path)
+        with open(path, 'a', newline='') as partition_file:
+            csv_writer = csv.writer(partition_file, delimiter=',', lineterminator='\n')
+            if new:
+                csv_writer.writerow(self.columns)
+            csv_writer.writerows(rows)
+        partition['rows'] += len(rows)
+
+        bounds = partition['bounds']
+        for column_name, values in zip(self.columns, zip(*map(parse_row, rows))):
+            values = [value for value in values if value is not None and value != '']
+            if column_name in bounds and bounds[column_name] is None or not values:
+                continue
+            if column_name in bounds:
+                values += list(self._decode(column_name, bounds[column_name]))
+            try:
+                bounds[column_name] = [_encode(min(values)), _encode(max(values))]
+            except TypeError:
+                # a column with values of several types has no order, so it is never used to skip the partition
+                bounds[column_name] = None
+
+    def _decode(self, column_name, bound):
+        if self.schema.get(column_name) == DATE:
+            return tuple(date.fromisoformat(value) if isinstance(value, str) else value for value in bound)
+        return tuple(bound)
+
+    def bounds(self, partition, decode=True):
+        """Returns:
+            dict of str, tuple: the (minimum, maximum) of each column of the partition that has them, with dates as
+                ISO strings unless decoded
+        """
+        return {column_name: self._decode(column_name, bound) if decode else tuple(bound)
+                for column_name, bound in partition['bounds'].items() if bound is not None}
+
+    def select(self, predicate=None):
+        """Returns:
+            list of dict: the partitions that may hold rows passing the predicate, in order
+        """
+        if predicate is None:
+            return list(self.partitions)
+        try:
+            predicate, decode = predicate.bind(self.schema), True
+        except ValueError:
+            # a constant that is not a whole ISO date, such as '2017-05', is compared to date strings as it is when
+            # the rows are parsed without a schema, and ISO strings order like the dates they hold
+            decode = False
+        return [partition for partition in self.partitions if predicate.may_match(self.bounds(partition, decode))]
+
+
+def _write_manifest(directory, manifest):
+    # written to a temporary file and renamed, so that readers never see a partly written manifest
+    with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.tmp', delete=False) as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    os.replace(manifest_file.name, os.path.join(directory, MANIFEST))
+
+
+class PartitionedReader(object):
+    """Reads the partitions of a partitioned dataset that may hold rows passing the predicate, see CsvReader"""
+
+    def __init__(self, directory, columns=None, predicate=None, chunk_size=DEFAULT_CHUNK_SIZE, limit=None,
+                 schema=None, sample_size=DEFAULT_SAMPLE_SIZE):
+        """
+        Args:
+            directory (str): the directory of the partitioned dataset
+            columns, predicate, chunk_size, limit, schema, sample_size: see CsvReader. Column types are inferred
+                from the leading rows of the first partition
+        """
+        self.store = PartitionedStore(directory)
+        self.header = list(self.store.columns)
+        sample = []
+        if self.store.partitions:
+            _, sample = read_sample(self.store.path(self.store.partitions[0]), sample_size)
+        self.schema = resolve_schema(self.header, sample, schema)
+        self.columns = list(columns) if columns is not None else list(self.header)
+        required = set(self.columns) | (predicate.columns() if predicate is not None else set())
+        for column_name in sorted(required):
+            if column_name not in self.header:
+                raise ValueError('column name {} does not exist'.format(column_name))
+        self.predicate = predicate
+        self.chunk_size = chunk_size
+        self.limit = limit
+        self.partitions = self.store.select(predicate)
+
+    def paths(self):
+        """Returns:
+            list of str: the paths to the csvs of the partitions that are read
+        """
+        return [self.store.path(partition) for partition in self.partitions]
+
+    def __iter__(self):
+        """Yields:
+            list of tuple: the next chunk of rows
+        """
+        remaining = self.limit
+        for path in self.paths():
+            if remaining is not None and remaining <= 0:
+                return
+            # the schema covers every column, so the partition's rows are not sampled again
+            reader = CsvReader(path, columns=self.columns, predicate=self.predicate, chunk_size=self.chunk_size,
+                               limit=remaining, schema=self.schema, sample_size=0)
+            for chunk in reader:
+                yield chunk
+                if remaining is not None:
+                    remaining -= len(chunk)
@@ -0,0 +1,541 @@
+"""Logical query plans for the DatasetAPI.
+
+The operations of a request are compiled into a tree of plan nodes, one node per operation, which is rewritten by
+optimize and only run when its result is needed. Running a plan loads each csv once with only the columns and
+rows that the rest of the plan uses:
+
+    filters are fused and pushed below joins, sorts, derived columns and aggregations, and into the csv reader
+    limits are pushed into the csv reader or below derived columns, and a sort followed by a limit becomes a top n
+    sorts under an aggregation that does not depend on row order are dropped, and joins under one may give their
+    rows in any order
+    columns that no later node reads are never loaded
+
+Given a ParallelExecutor, an ExecutionContext runs filters and aggregations over partitions in worker processes,
+and aggregates a csv as it is scanned when an aggregation reads a scan directly. Given load_sorted and load_join,
+sorts of a scan and joins with a scan may read the csv straight into a sort on disk rather than loading it first.
+
+Aggregations output their groups in order of first appearance, so dropping a sort below one changes the order of
+its groups. explain shows the plan that was chosen.
+"""
+from aggregators import aggregate_column_names, resolve_aggregations
+from joins import ANTI, INNER, SEMI
+from predicates import And
+from partitioned import read_header
+
+
+def _conjuncts(predicate):
+    """Returns:
+        list of Predicate: the predicates that must all pass for the given predicate to pass
+    """
+    if isinstance(predicate, And):
+        return [conjunct for child in predicate.predicates for conjunct in _conjuncts(child)]
+    return [predicate]
+
+
+def _and(*predicates):
+    conjuncts = [conjunct for predicate in predicates if predicate is not None for conjunct in _conjuncts(predicate)]
+    if not conjuncts:
+        return None
+    return conjuncts[0] if len(conjuncts) == 1 else And(*conjuncts)
+
+
+def _format_columns(column_names):
+    return '[{}]'.format(', '.join(column_names))
+
+
+class PlanNode(object):
+    """Base class for plan nodes"""
+
+    children = ()
+
+    def columns(self):
+        """Returns:
+            list of str: the column names of this node's result
+        """
+        raise NotImplementedError
+
+    def with_children(self, children):
+        """Returns:
+            PlanNode: a copy of this node over new children
+        """
+        raise NotImplementedError
+
+    def execute(self, context):
+        """Computes this node's result
+
+        Args:
+            context (ExecutionContext): evaluates this node's children
+
+        Returns:
+            Dataset: the result
+        """
+        raise NotImplementedError
+
+    def describe(self):
+        """Returns:
+            str: a one line description of this node, without its children
+        """
+        raise NotImplementedError
+
+    def explain(self, indent=0):
+        """Returns:
+            str: the plan rooted at this node, one node per line with children indented below their parent
+        """
+        lines = ['  ' * indent + self.describe()]
+        lines += [child.explain(indent + 1) for child in self.children]
+        return '\n'.join(lines)
+
+
+class Scan(PlanNode):
+    """Loads a dataset from its csv, with only the projected columns and the rows that pass the predicate"""
+
+    def __init__(self, dataset_name, csv_path, schema=None, projection=None, predicate=None, limit=None, header=None):
+        self.dataset_name = dataset_name
+        self.csv_path = csv_path
+        self.schema = schema
+        self.projection = projection
+        self.predicate = predicate
+        self.limit = limit
+        self._header = header
+
+    @property
+    def header(self):
+        if self._header is None:
+            self._header = read_header(self.csv_path)
+        return self._header
+
+    def columns(self):
+        return list(self.projection) if self.projection is not None else list(self.header)
+
+    def replace(self, **changes):
+        """Returns:
+            Scan: a copy of this scan with the given attributes changed
+        """
+        attributes = {
+            'schema': self.schema,
+            'projection': self.projection,
+            'predicate': self.predicate,
+            'limit': self.limit,
+            'header': self._header,
+        }
+        attributes.update(changes)
+        return Scan(self.dataset_name, self.csv_path, **attributes)
+
+    def with_children(self, children):
+        return self
+
+    def key(self):
+        """Returns:
+            tuple: identifies the data this scan loads, so that identical scans are only loaded once
+        """
+        projection = tuple(self.projection) if self.projection is not None else None
+        return self.dataset_name, self.csv_path, repr(self.schema), projection, repr(self.predicate), self.limit
+
+    def execute(self, context):
+        return context.load(self)
+
+    def describe(self):
+        description = 'Scan {} ({})'.format(self.dataset_name, self.csv_path)
+        if self.projection is not None:
+            description += ' columns={}'.format(_format_columns(self.projection))
+        if self.predicate is not None:
+            description += ' where {!r}'.format(self.predicate)
+        if self.limit is not None:
+            description += ' limit {}'.format(self.limit)
+        return description
+
+
+class Filter(PlanNode):
+    def __init__(self, child, predicate):
+        self.child = child
+        self.predicate = predicate
+        self.children = (child,)
+
+    def columns(self):
+        return self.child.columns()
+
+    def with_children(self, children):
+        return Filter(children[0], self.predicate)
+
+    def execute(self, context):
+        return context.where(context.evaluate(self.child), self.predicate)
+
+    def describe(self):
+        return 'Filter {!r}'.format(self.predicate)
+
+
+class Derive(PlanNode):
+    def __init__(self, child, column_name, expression):
+        self.child = child
+        self.column_name = column_name
+        self.expression = expression
+        self.children = (child,)
+
+    def columns(self):
+        return self.child.columns() + [self.column_name]
+
+    def with_children(self, children):
+        return Derive(children[0], self.column_name, self.expression)
+
+    def execute(self, context):
+        return context.evaluate(self.child).derive(self.column_name, self.expression)
+
+    def describe(self):
+        return 'Derive {} = {!r}'.format(self.column_name, self.expression)
+
+
+class Aggregate(PlanNode):
+    def __init__(self, child, group_by_columns, aggregations):
+        """
+        Args:
+            child (PlanNode): the node to aggregate
+            group_by_columns (list of str): the columns to group by
+            aggregations (iterable of tuple): see aggregators.resolve_aggregations
+        """
+        self.child = child
+        self.group_by_columns = list(group_by_columns)
+        self.aggregations = resolve_aggregations(aggregations)
+        self.children = (child,)
+
+    def columns(self):
+        return self.group_by_columns + [output_column for _, _, output_column in self.aggregations]
+
+    def input_columns(self):
+        """Returns:
+            set of str: the columns this aggregation reads
+        """
+        return set(self.group_by_columns).union(*[aggregate_column_names(aggregate_column)
+                                                  for aggregate_column, _, _ in self.aggregations])
+
+    def order_sensitive(self):
+        return any(prototype.order_sensitive for _, prototype, _ in self.aggregations)
+
+    def with_children(self, children):
+        return Aggregate(children[0], self.group_by_columns, self.aggregations)
+
+    def execute(self, context):
+        if context.load_aggregate is not None and isinstance(self.child, Scan) and self.child.limit is None \
+                and not context.is_evaluated(self.child):
+            # aggregate the csv as it is scanned rather than loading it first
+            return context.load_aggregate(self.child, self.group_by_columns, self.aggregations)
+        return context.aggregate(context.evaluate(self.child), self.group_by_columns, self.aggregations)
+
+    def describe(self):
+        aggregations = ', '.join('{} = {!r} of {}'.format(output_column, prototype, aggregate_column)
+                                 for aggregate_column, prototype, output_column in self.aggregations)
+        return 'Aggregate by {}: {}'.format(_format_columns(self.group_by_columns), aggregations)
+
+
+class Sort(PlanNode):
+    def __init__(self, child, column_name, descending=False):
+        self.child = child
+        self.column_name = column_name
+        self.descending = descending
+        self.children = (child,)
+
+    def columns(self):
+        return self.child.columns()
+
+    def with_children(self, children):
+        return Sort(children[0], self.column_name, descending=self.descending)
+
+    def execute(self, context):
+        if context.load_sorted is not None and isinstance(self.child, Scan) and not context.is_evaluated(self.child):
+            sorted_dataset = context.load_sorted(self.child, self.column_name, self.descending)
+            if sorted_dataset is not None:
+                return sorted_dataset
+        return context.evaluate(self.child).sort_by(self.column_name, reverse=self.descending)
+
+    def describe(self):
+        return 'Sort by {}{}'.format(self.column_name, ' desc' if self.descending else '')
+
+
+class Limit(PlanNode):
+    def __init__(self, child, n):
+        self.child = child
+        self.n = n
+        self.children = (child,)
+
+    def columns(self):
+        return self.child.columns()
+
+    def with_children(self, children):
+        return Limit(children[0], self.n)
+
+    def execute(self, context):
+        return context.evaluate(self.child).limit(self.n)
+
+    def describe(self):
+        return 'Limit {}'.format(self.n)
+
+
+class TopN(PlanNode):
+    def __init__(self, child, column_names, n, descending=False):
+        self.child = child
+        self.column_names = [column_names] if isinstance(column_names, str) else list(column_names)
+        self.n = n
+        self.descending = descending
+        self.children = (child,)
+
+    def columns(self):
+        return self.child.columns()
+
+    def with_children(self, children):
+        return TopN(children[0], self.column_names, self.n, descending=self.descending)
+
+    def execute(self, context):
+        return context.evaluate(self.child).top_n(self.column_names, self.n, descending=self.descending)
+
+    def describe(self):
+        return 'TopN {} by {}{}'.format(self.n, _format_columns(self.column_names),
+                                        ' desc' if self.descending else '')
+
+
+class Join(PlanNode):
+    """A hash or merge join on one or more columns, see Dataset.join, or a sort-merge join on disk, see
+    Dataset.from_join. An unordered join may give its rows in order of the join columns rather than of the left rows"""
+
+    def __init__(self, left, right, column_names, how=INNER, ordered=True):
+        self.left = left
+        self.right = right
+        self.column_names = [column_names] if isinstance(column_names, str) else list(column_names)
+        self.how = how
+        self.ordered = ordered
+        self.children = (left, right)
+
+    def columns(self):
+        if self.how in (SEMI, ANTI):
+            return self.left.columns()
+        return self.left.columns() + [column_name for column_name in self.right.columns()
+                                      if column_name not in self.column_names]
+
+    def with_children(self, children):
+        return Join(children[0], children[1], self.column_names, how=self.how, ordered=self.ordered)
+
+    def execute(self, context):
+        if context.load_join is not None and any(isinstance(child, Scan) and not context.is_evaluated(child)
+                                                 for child in self.children):
+            # scans are read as they are joined, the other side is evaluated first
+            left, right = [child if isinstance(child, Scan) and not context.is_evaluated(child)
+                           else context.evaluate(child) for child in self.children]
+            joined = context.load_join(left, right, self.column_names, self.how, self.ordered)
+            if joined is not None:
+                return joined
+        left, right = context.evaluate(self.left), context.evaluate(self.right)
+        if self.how == INNER and len(self.column_names) == 1:
+            return left.inner_join(right, self.column_names[0])
+        return left.join(right, self.column_names, how=self.how)
+
+    def describe(self):
+        return '{}Join on {}{}'.format(self.how.capitalize(), ', '.join(self.column_names),
+                                       '' if self.ordered else ' unordered')
+
+
+class ExecutionContext(object):
+    """Runs plans, evaluating each node once even when it is shared by several plans"""
+
+    def __init__(self, load, executor=None, load_aggregate=None, profiler=None, load_sorted=None, load_join=None):
+        """
+        Args:
+            load (callable): a function that takes a Scan and returns its loaded Dataset
+            executor (ParallelExecutor): if passed, filters and aggregations run in parallel, see the parallel module
+            load_aggregate (callable): if passed, a function that takes a Scan, group by columns and aggregations and
+                returns the aggregated Dataset, used for aggregations directly over a scan
+            profiler (Profiler): if passed, records the evaluation of each node, see the profiling module
+            load_sorted (callable): if passed, a function that takes a Scan, a column name and whether to sort in
+                descending order and returns the sorted Dataset, used for sorts directly over a scan. It returns
+                None for a scan that should be loaded and sorted in memory instead
+            load_join (callable): if passed, a function that takes the left and right sides of a join, each a Scan
+                or a Dataset, the join columns, the join type and whether the left order must be kept and returns
+                the joined Dataset, used for joins with a scan. It returns None for sides that should be loaded and
+                joined in memory instead
+        """
+        self.load = load
+        self.executor = executor
+        self.load_aggregate = load_aggregate
+        self.profiler = profiler
+        self.load_sorted = load_sorted
+        self.load_join = load_join
+        self._results = {}
+
+    @staticmethod
+    def _key(node):
+        return node.key() if isinstance(node, Scan) else id(node)
+
+    def is_evaluated(self, node):
+        return self._key(node) in self._results
+
+    def evaluate(self, node):
+        """Returns:
+            Dataset: the result of the plan rooted at node
+        """
+        key = self._key(node)
+        if key not in self._results:
+            if self.profiler is None:
+                self._results[key] = node.execute(self)
+            else:
+                self._results[key] = self._profile(node)
+        return self._results[key]
+
+    def _profile(self, node):
+        with self.profiler.measure(node) as record:
+            result = node.execute(self)
+            # a child that was never evaluated, like a scan aggregated as it is read, has no row count
+            inputs = [self._results.get(self._key(child)) for child in node.children]
+            if node.children and all(dataset is not None for dataset in inputs):
+                record['input_rows'] = sum(len(dataset) for dataset in inputs)
+            record['output_rows'] = len(result)
+        return result
+
+    def where(self, dataset, predicate):
+        if self.executor is not None:
+            return self.executor.where(dataset, predicate)
+        return dataset.where(predicate)
+
+    def aggregate(self, dataset, group_by_columns, aggregations):
+        if self.executor is not None:
+            return self.executor.aggregate(dataset, group_by_columns, aggregations)
+        return dataset.aggregate(group_by_columns, aggregations)
+
+
+def _push_filter(node):
+    """Moves a filter below its child when that gives the same rows"""
+    if not isinstance(node, Filter):
+        return None
+    child, predicate = node.child, node.predicate
+
+    if isinstance(child, Filter):
+        return Filter(child.child, _and(child.predicate, predicate))
+    if isinstance(child, Scan):
+        if child.limit is not None:
+            return None
+        return child.replace(predicate=_and(child.predicate, predicate))
+    if isinstance(child, (Sort, Derive, Aggregate)):
+        if isinstance(child, Sort):
+            can_push = lambda columns: True
+        elif isinstance(child, Derive):
+            can_push = lambda columns: child.column_name not in columns
+        else:
+            # only filters on the group columns keep or drop whole groups
+            outputs = {output_column for _, _, output_column in child.aggregations}
+            can_push = lambda columns: columns <= set(child.group_by_columns) and not columns & outputs
+        pushed, remaining = [], []
+        for conjunct in _conjuncts(predicate):
+            (pushed if can_push(conjunct.columns()) else remaining).append(conjunct)
+        if not pushed:
+            return None
+        swapped = child.with_children([Filter(child.child, _and(*pushed))])
+        return Filter(swapped, _and(*remaining)) if remaining else swapped
+
+    if isinstance(child, Join):
+        left_columns, right_columns = set(child.left.columns()), set(child.right.columns())
+        keys = set(child.column_names)
+        left, right, remaining = [], [], []
+        for conjunct in _conjuncts(predicate):
+            columns = conjunct.columns()
+            if columns <= left_columns:
+                left.append(conjunct)
+                if columns <= keys:
+                    # rows are only joined on equal keys, so the other side can be filtered the same way
+                    right.append(conjunct)
+            elif child.how == INNER and columns <= right_columns - keys:
+                # the other joins keep left rows whatever their match, so only inner joins can filter the right
+                right.append(conjunct)
+            else:
+                remaining.append(conjunct)
+        if not left and not right:
+            return None
+        join = child.with_children([Filter(child.left, _and(*left)) if left else child.left,
+                                    Filter(child.right, _and(*right)) if right else child.right])
+        return Filter(join, _and(*remaining)) if remaining else join
+
+    return None
+
+
+def _push_limit(node):
+    """Turns a sort followed by a limit into a top n, and moves limits closer to the csv reader"""
+    if isinstance(node, Limit):
+        child = node.child
+        if isinstance(child, Sort):
+            return TopN(child.child, child.column_name, node.n, descending=child.descending)
+        if isinstance(child, Limit):
+            return Limit(child.child, min(node.n, child.n))
+        if isinstance(child, Derive):
+            return child.with_children([Limit(child.child, node.n)])
+        if isinstance(child, Scan):
+            # the reader counts rows after its predicate, so the limit applies to the filtered rows
+            return child.replace(limit=node.n if child.limit is None else min(node.n, child.limit))
+    if isinstance(node, TopN) and isinstance(node.child, Derive) and node.child.column_name not in node.column_names:
+        return node.child.with_children([node.with_children([node.child.child])])
+    return None
+
+
+def _drop_sort(node):
+    """Removes a sort whose order is lost when its rows are aggregated, and lets a join under such an aggregation
+    give its rows in any order"""
+    if isinstance(node, Aggregate) and not node.order_sensitive():
+        if isinstance(node.child, Sort):
+            return node.with_children([node.child.child])
+        if isinstance(node.child, Join) and node.child.ordered:
+            join = node.child
+            return node.with_children([Join(join.left, join.right, join.column_names, how=join.how, ordered=False)])
+    return None
+
+
+RULES = (_push_filter, _push_limit, _drop_sort)
+
+
+def _rewrite(node):
+    node = node.with_children([_rewrite(child) for child in node.children])
+    for rule in RULES:
+        rewritten = rule(node)
+        if rewritten is not None:
+            return _rewrite(rewritten)
+    return node
+
+
+def _prune(node, required):
+    """Removes the columns that are not required by the nodes above, and derived columns that no node uses
+
+    Args:
+        node (PlanNode): the plan to prune
+        required (set of str): the columns of node's result that are used
+
+    Returns:
+        PlanNode: the pruned plan
+    """
+    if isinstance(node, Scan):
+        projection = [column_name for column_name in node.header if column_name in required]
+        if node.projection is None and len(projection) == len(node.header):
+            return node
+        return node.replace(projection=projection)
+    if isinstance(node, Filter):
+        return node.with_children([_prune(node.child, required | node.predicate.columns())])
+    if isinstance(node, Derive):
+        if node.column_name not in required:
+            return _prune(node.child, required)
+        return node.with_children([_prune(node.child, (required - {node.column_name}) | node.expression.columns())])
+    if isinstance(node, Aggregate):
+        return node.with_children([_prune(node.child, node.input_columns())])
+    if isinstance(node, Sort):
+        return node.with_children([_prune(node.child, required | {node.column_name})])
+    if isinstance(node, TopN):
+        return node.with_children([_prune(node.child, required | set(node.column_names))])
+    if isinstance(node, Join):
+        keys = set(node.column_names)
+        return node.with_children([_prune(node.left, (required & set(node.left.columns())) | keys),
+                                   _prune(node.right, (required & set(node.right.columns())) | keys)])
+    return node.with_children([_prune(child, required) for child in node.children])
+
+
+def optimize(node):
+    """Rewrites a plan into one that gives the same result with less work, see the module docstring
+
+    Args:
+        node (PlanNode): the plan to optimize
+
+    Returns:
+        PlanNode: the optimized plan
+    """
+    node = _rewrite(node)
+    return _prune(node, set(node.columns()))
@@ -0,0 +1,397 @@
+"""Declarative row predicates that are compiled once and then evaluated over a whole dataset.
+
+A predicate can be compiled against a list of column names into a function that tests a row tuple,
+or evaluated against a ColumnarDataset into a boolean mask with one entry per row.
+"""
+import operator
+from functools import reduce
+
+from schema import coerce_literal
+
+COMPARISON_OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+# builds a row test for each comparison operator out of a column index and a constant. Ordering comparisons
+# against a missing value are false rather than an error
+_ROW_TESTS = {
+    '==': lambda i, value: lambda row: row[i] == value,
+    '!=': lambda i, value: lambda row: row[i] != value,
+    '<': lambda i, value: lambda row: row[i] is not None and row[i] < value,
+    '<=': lambda i, value: lambda row: row[i] is not None and row[i] <= value,
+    '>': lambda i, value: lambda row: row[i] is not None and row[i] > value,
+    '>=': lambda i, value: lambda row: row[i] is not None and row[i] >= value,
+}
+
+# tests whether some value between a column's minimum and maximum could pass each comparison operator. Bounds
+# do not cover missing values, which pass !=
+_BOUND_TESTS = {
+    '==': lambda low, high, value: low <= value <= high,
+    '!=': lambda low, high, value: True,
+    '<': lambda low, high, value: low < value,
+    '<=': lambda low, high, value: low <= value,
+    '>': lambda low, high, value: high > value,
+    '>=': lambda low, high, value: high >= value,
+}
+
+
+def _may_match(bounds, column_name, test):
+    """Applies a bound test to a column's bounds, assuming a match when the column has no bounds or they cannot be
+    compared to the predicate's constants"""
+    if column_name not in bounds:
+        return True
+    low, high = bounds[column_name]
+    try:
+        return test(low, high)
+    except TypeError:
+        return True
+
+
+def is_null(value):
+    """Missing cells are either None or, when left unparsed, an empty string"""
+    return value is None or value == ''
+
+
+class Predicate(object):
+    """Base class for predicates. Predicates can be combined with &, | and ~"""
+
+    def columns(self):
+        """Returns:
+            set of str: the column names this predicate reads
+        """
+        raise NotImplementedError
+
+    def compile(self, columns):
+        """Compiles this predicate into a function that tests a single row
+
+        Args:
+            columns (list of str): the column names of the rows that will be tested
+
+        Returns:
+            callable: a function that takes a row tuple and returns a bool
+        """
+        raise NotImplementedError
+
+    def evaluate(self, dataset):
+        """Evaluates this predicate over every row of a ColumnarDataset at once
+
+        Args:
+            dataset (ColumnarDataset): the dataset to evaluate against
+
+        Returns:
+            list of bool: one entry per row, true where the row passes
+        """
+        raise NotImplementedError
+
+    def bind(self, schema):
+        """Converts the constants in this predicate to the types of the columns they are compared against, e.g.
+        date strings compared against a date column become dates
+
+        Args:
+            schema (Schema): the schema of the dataset this predicate will be applied to
+
+        Returns:
+            Predicate: the converted predicate
+        """
+        return self
+
+    def may_match(self, bounds):
+        """Tests whether any row within the given bounds could pass this predicate, so that a partition whose
+        minimum and maximum values rule it out can be skipped without being read
+
+        Args:
+            bounds (dict of str, tuple): the (minimum, maximum) of some of the columns. Other columns may take any
+                value
+
+        Returns:
+            bool: false only if no row within the bounds can pass
+        """
+        return True
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+
+class Comparison(Predicate):
+    """Compares a column against a constant, e.g. Comparison('sales', '>', 100)"""
+
+    def __init__(self, column_name, op, value):
+        if op not in COMPARISON_OPERATORS:
+            raise ValueError('comparison operator {} is not supported'.format(op))
+        self.column_name = column_name
+        self.op = op
+        self.value = value
+
+    def columns(self):
+        return {self.column_name}
+
+    def compile(self, columns):
+        return _ROW_TESTS[self.op](columns.index(self.column_name), self.value)
+
+    def bind(self, schema):
+        return Comparison(self.column_name, self.op, coerce_literal(schema.get(self.column_name), self.value))
+
+    def may_match(self, bounds):
+        if self.value is None:
+            return True
+        test, value = _BOUND_TESTS[self.op], self.value
+        return _may_match(bounds, self.column_name, lambda low, high: test(low, high, value))
+
+    def evaluate(self, dataset):
+        column = dataset.get_column_data(self.column_name)
+        return column.compare(COMPARISON_OPERATORS[self.op], self.value, null_safe=self.op not in ('==', '!='))
+
+    def __repr__(self):
+        return '{} {} {!r}'.format(self.column_name, self.op, self.value)
+
+
+class Between(Predicate):
+    """Tests start < column < end, or start <= column <= end when inclusive"""
+
+    def __init__(self, column_name, start, end, inclusive=False):
+        self.column_name = column_name
+        self.start = start
+        self.end = end
+        self.inclusive = inclusive
+
+    def columns(self):
+        return {self.column_name}
+
+    def bind(self, schema):
+        column_type = schema.get(self.column_name)
+        return Between(self.column_name, coerce_literal(column_type, self.start), coerce_literal(column_type, self.end),
+                       inclusive=self.inclusive)
+
+    def _operators(self):
+        return (operator.ge, operator.le) if self.inclusive else (operator.gt, operator.lt)
+
+    def may_match(self, bounds):
+        lower, upper = self._operators()
+        start, end = self.start, self.end
+        # some value in [low, high] lies within the range if the range and the bounds overlap
+        return _may_match(bounds, self.column_name, lambda low, high: lower(high, start) and upper(low, end))
+
+    def compile(self, columns):
+        index = columns.index(self.column_name)
+        start, end = self.start, self.end
+
+        if self.inclusive:
+            def test(row):
+                x = row[index]
+                return x is not None and start <= x <= end
+        else:
+            def test(row):
+                x = row[index]
+                return x is not None and start < x < end
+
+        return test
+
+    def evaluate(self, dataset):
+        column = dataset.get_column_data(self.column_name)
+        lower, upper = self._operators()
+        if column.is_encoded():
+            # test each distinct value once
+            start, end = self.start, self.end
+            return column.evaluate(lambda x: x is not None and lower(x, start) and upper(x, end))
+        return list(map(operator.and_,
+                        column.compare(lower, self.start, null_safe=True),
+                        column.compare(upper, self.end, null_safe=True)))
+
+    def __repr__(self):
+        symbol = '<=' if self.inclusive else '<'
+        return '{!r} {} {} {} {!r}'.format(self.start, symbol, self.column_name, symbol, self.end)
+
+
+class In(Predicate):
+    """Tests whether a column value is one of a list of values"""
+
+    def __init__(self, column_name, values):
+        self.column_name = column_name
+        self.values = frozenset(values)
+
+    def columns(self):
+        return {self.column_name}
+
+    def compile(self, columns):
+        index = columns.index(self.column_name)
+        values = self.values
+        return lambda row: row[index] in values
+
+    def bind(self, schema):
+        column_type = schema.get(self.column_name)
+        return In(self.column_name, [coerce_literal(column_type, value) for value in self.values])
+
+    def may_match(self, bounds):
+        values = [value for value in self.values if value is not None]
+        if len(values) != len(self.values):
+            return True
+        return _may_match(bounds, self.column_name, lambda low, high: any(low <= value <= high for value in values))
+
+    def evaluate(self, dataset):
+        return dataset.get_column_data(self.column_name).evaluate(self.values.__contains__)
+
+    def __repr__(self):
+        return '{} in {!r}'.format(self.column_name, sorted(self.values, key=repr))
+
+
+class IsNull(Predicate):
+    """Tests whether a column value is missing"""
+
+    def __init__(self, column_name):
+        self.column_name = column_name
+
+    def columns(self):
+        return {self.column_name}
+
+    def compile(self, columns):
+        index = columns.index(self.column_name)
+        return lambda row: is_null(row[index])
+
+    def evaluate(self, dataset):
+        return dataset.get_column_data(self.column_name).evaluate(is_null)
+
+    def __repr__(self):
+        return '{} is null'.format(self.column_name)
+
+
+def NotNull(column_name):
+    """Tests whether a column value is present"""
+    return Not(IsNull(column_name))
+
+
+class And(Predicate):
+    """Passes rows that pass every one of the given predicates"""
+
+    def __init__(self, *predicates):
+        self.predicates = predicates
+
+    def columns(self):
+        return set().union(*[predicate.columns() for predicate in self.predicates])
+
+    def compile(self, columns):
+        tests = [predicate.compile(columns) for predicate in self.predicates]
+
+        def test(row):
+            for t in tests:
+                if not t(row):
+                    return False
+            return True
+
+        return test
+
+    def bind(self, schema):
+        return And(*[predicate.bind(schema) for predicate in self.predicates])
+
+    def may_match(self, bounds):
+        return all(predicate.may_match(bounds) for predicate in self.predicates)
+
+    def evaluate(self, dataset):
+        masks = [predicate.evaluate(dataset) for predicate in self.predicates]
+        return reduce(lambda a, b: list(map(operator.and_, a, b)), masks)
+
+    def __repr__(self):
+        return '({})'.format(' and '.join(repr(predicate) for predicate in self.predicates))
+
+
+class Or(Predicate):
+    """Passes rows that pass any of the given predicates"""
+
+    def __init__(self, *predicates):
+        self.predicates = predicates
+
+    def columns(self):
+        return set().union(*[predicate.columns() for predicate in self.predicates])
+
+    def compile(self, columns):
+        tests = [predicate.compile(columns) for predicate in self.predicates]
+
+        def test(row):
+            for t in tests:
+                if t(row):
+                    return True
+            return False
+
+        return test
+
+    def bind(self, schema):
+        return Or(*[predicate.bind(schema) for predicate in self.predicates])
+
+    def may_match(self, bounds):
+        return any(predicate.may_match(bounds) for predicate in self.predicates)
+
+    def evaluate(self, dataset):
+        masks = [predicate.evaluate(dataset) for predicate in self.predicates]
+        return reduce(lambda a, b: list(map(operator.or_, a, b)), masks)
+
+    def __repr__(self):
+        return '({})'.format(' or '.join(repr(predicate) for predicate in self.predicates))
+
+
+class Not(Predicate):
+    """Passes rows that fail the given predicate"""
+
+    def __init__(self, predicate):
+        self.predicate = predicate
+
+    def columns(self):
+        return self.predicate.columns()
+
+    def compile(self, columns):
+        test = self.predicate.compile(columns)
+        return lambda row: not test(row)
+
+    def bind(self, schema):
+        return Not(self.predicate.bind(schema))
+
+    def evaluate(self, dataset):
+        return list(map(operator.not_, self.predicate.evaluate(dataset)))
+
+    def __repr__(self):
+        return 'not {!r}'.format(self.predicate)
+
+
+def parse_predicate(spec):
+    """Builds a predicate out of its dictionary representation, as used by the DatasetAPI:
+
+    {"op": "==" | "!=" | "<" | "<=" | ">" | ">=", "column_name": <column>, "value": <value>}
+    {"op": "between", "column_name": <column>, "start": <value>, "end": <value>, "inclusive": <bool>}
+    {"op": "in", "column_name": <column>, "values": [<value>, ...]}
+    {"op": "is_null" | "not_null", "column_name": <column>}
+    {"op": "and" | "or", "predicates": [<predicate>, ...]}
+    {"op": "not", "predicate": <predicate>}
+
+    Args:
+        spec (dict): a dictionary with one of the above formats
+
+    Returns:
+        Predicate: the parsed predicate
+    """
+    op = spec['op']
+    if op in COMPARISON_OPERATORS:
+        return Comparison(spec['column_name'], op, spec['value'])
+    elif op == 'between':
+        return Between(spec['column_name'], spec['start'], spec['end'], inclusive=spec.get('inclusive', False))
+    elif op == 'in':
+        return In(spec['column_name'], spec['values'])
+    elif op == 'is_null':
+        return IsNull(spec['column_name'])
+    elif op == 'not_null':
+        return NotNull(spec['column_name'])
+    elif op == 'and':
+        return And(*[parse_predicate(predicate) for predicate in spec['predicates']])
+    elif op == 'or':
+        return Or(*[parse_predicate(predicate) for predicate in spec['predicates']])
+    elif op == 'not':
+        return Not(parse_predicate(spec['predicate']))
+    raise ValueError('predicate op {} is not supported'.format(op))
@@ -0,0 +1,246 @@
+"""Per-operation profiling of DatasetAPI requests, and a hook to export it as metrics.
+
+A Profiler is handed to the ExecutionContext that runs a request's plans, and records each plan node as it is
+evaluated: its wall and cpu time, the rows of its inputs and its output, and, when tracing memory, the bytes it
+allocated and still held when it finished and the peak of traced memory while it ran. Times and allocations are
+the node's own, its children's are left out, while the peak includes them. Loads through a DatasetRegistry or
+DatasetCache also record whether they were a cache hit or miss.
+
+CPU time is that of this process, so the work of ParallelExecutor workers only shows in wall time, and memory is
+traced with tracemalloc, which slows a request down by several times. Without a profiler, running a plan only
+checks that there is none for each node.
+
+A MetricsHook given to DatasetAPI receives the Profiler of every request, see PrometheusExporter.
+"""
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HIT = 'hit'
+MISS = 'miss'
+
+
+class Profiler(object):
+    """Records the evaluation of each node of a request's plans, see the module docstring. Used as a context manager
+    around the request, which also times the request as a whole"""
+
+    def __init__(self, trace_memory=True):
+        """
+        Args:
+            trace_memory (bool): if true, the memory allocated by each node is traced with tracemalloc
+        """
+        self.trace_memory = trace_memory
+        self.records = []
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self._frames = []
+        self._started_tracing = False
+        self._start = None
+
+    def __enter__(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._start = time.perf_counter(), time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.wall_seconds = time.perf_counter() - self._start[0]
+        self.cpu_seconds = time.process_time() - self._start[1]
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        return False
+
+    @contextmanager
+    def measure(self, node):
+        """Records the evaluation of a node, which the with block runs
+
+        Args:
+            node (PlanNode): the node
+
+        Yields:
+            dict: the node's record, whose input_rows and output_rows the caller fills in
+        """
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        current = 0
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            if self._frames:
+                # the parent's peak so far is kept before the peak is reset for this node
+                self._frames[-1]['peak'] = max(self._frames[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+        record = {
+            'operation': type(node).__name__.lower(),
+            'description': node.describe(),
+            'depth': len(self._frames),
+            'wall_seconds': None,
+            'cpu_seconds': None,
+            'input_rows': None,
+            'output_rows': None,
+            'allocated_bytes': None,
+            'peak_bytes': None,
+            'cache': None,
+        }
+        frame = {'record': record, 'peak': current, 'wall': 0.0, 'cpu': 0.0, 'allocated': 0}
+        self.records.append(record)
+        self._frames.append(frame)
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+            self._frames.pop()
+            record['wall_seconds'] = wall - frame['wall']
+            record['cpu_seconds'] = cpu - frame['cpu']
+            allocated = 0
+            if tracing:
+                now, peak = tracemalloc.get_traced_memory()
+                allocated = now - current
+                peak = max(frame['peak'], peak)
+                record['allocated_bytes'] = allocated - frame['allocated']
+                record['peak_bytes'] = peak - current
+            if self._frames:
+                parent = self._frames[-1]
+                parent['wall'] += wall
+                parent['cpu'] += cpu
+                parent['allocated'] += allocated
+                if tracing:
+                    parent['peak'] = max(parent['peak'], peak)
+
+    def annotate(self, **fields):
+        """Adds fields to the record of the node being evaluated, such as whether its load was a cache hit"""
+        if self._frames:
+            self._frames[-1]['record'].update(fields)
+
+    def to_dict(self):
+        """Returns:
+            dict: the wall and cpu time of the request, its cache hits and misses, and the record of each node in
+                the order they started, with children one deeper than their parent
+        """
+        return {
+            'wall_seconds': self.wall_seconds,
+            'cpu_seconds': self.cpu_seconds,
+            'cache_hits': sum(1 for record in self.records if record['cache'] == HIT),
+            'cache_misses': sum(1 for record in self.records if record['cache'] == MISS),
+            'operations': [dict(record) for record in self.records],
+        }
+
+
+class MetricsHook(object):
+    """Base class for hooks that receive the Profiler of every request a DatasetAPI handles"""
+
+    # whether requests are profiled with tracemalloc, which is slow
+    trace_memory = False
+
+    def observe(self, profiler):
+        """Records the profile of a finished request
+
+        Args:
+            profiler (Profiler): the request's profiler
+        """
+        raise NotImplementedError
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class PrometheusExporter(MetricsHook):
+    """Totals the profiles of requests by operation, and renders them in the Prometheus text format. serve starts a
+    server for Prometheus to scrape"""
+
+    # name suffix, help text and the record field totalled, None to count the records
+    OPERATION_COUNTERS = (
+        ('operations_total', 'Plan nodes evaluated.', None),
+        ('operation_seconds_total', 'Wall time of plan nodes, without their children.', 'wall_seconds'),
+        ('operation_cpu_seconds_total', 'CPU time of plan nodes, without their children.', 'cpu_seconds'),
+        ('operation_input_rows_total', 'Rows read by plan nodes from their children.', 'input_rows'),
+        ('operation_output_rows_total', 'Rows output by plan nodes.', 'output_rows'),
+        ('operation_allocated_bytes_total', 'Bytes allocated and held by plan nodes.', 'allocated_bytes'),
+    )
+
+    def __init__(self, namespace='tikametrics', trace_memory=False):
+        """
+        Args:
+            namespace (str): the prefix of the metric names
+            trace_memory (bool): if true, requests are profiled with tracemalloc, see Profiler
+        """
+        self.namespace = namespace
+        self.trace_memory = trace_memory
+        self.requests = 0
+        self.request_seconds = 0.0
+        self.cache = {HIT: 0, MISS: 0}
+        self.operations = {}
+        self.peak_bytes = {}
+        self._lock = threading.Lock()
+
+    def observe(self, profiler):
+        with self._lock:
+            self.requests += 1
+            self.request_seconds += profiler.wall_seconds or 0.0
+            for record in profiler.records:
+                totals = self.operations.setdefault(record['operation'], [0] * len(self.OPERATION_COUNTERS))
+                for i, (_, _, field) in enumerate(self.OPERATION_COUNTERS):
+                    totals[i] += 1 if field is None else record[field] or 0
+                if record['cache'] in self.cache:
+                    self.cache[record['cache']] += 1
+                if record['peak_bytes'] is not None:
+                    self.peak_bytes[record['operation']] = max(self.peak_bytes.get(record['operation'], 0),
+                                                               record['peak_bytes'])
+
+    def _metric(self, lines, name, metric_type, help_text, samples):
+        name = '{}_{}'.format(self.namespace, name)
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+        for labels, value in samples:
+            labels = ','.join('{}="{}"'.format(label, _escape(label_value)) for label, label_value in labels)
+            lines.append('{}{} {}'.format(name, '{' + labels + '}' if labels else '', value))
+
+    def render(self):
+        """Returns:
+            str: the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            self._metric(lines, 'requests_total', 'counter', 'Requests profiled.', [((), self.requests)])
+            self._metric(lines, 'request_seconds_total', 'counter', 'Wall time of profiled requests.',
+                         [((), self.request_seconds)])
+            self._metric(lines, 'cache_lookups_total', 'counter', 'Loads through a registry or cache.',
+                         [((('result', result),), count) for result, count in sorted(self.cache.items())])
+            for i, (name, help_text, _) in enumerate(self.OPERATION_COUNTERS):
+                self._metric(lines, name, 'counter', help_text,
+                             [((('operation', operation),), totals[i])
+                              for operation, totals in sorted(self.operations.items())])
+            self._metric(lines, 'operation_peak_bytes', 'gauge', 'Largest peak of traced memory of plan nodes.',
+                         [((('operation', operation),), peak) for operation, peak in sorted(self.peak_bytes.items())])
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, host='127.0.0.1', port=9100):
+        """Serves the metrics at /metrics from a background thread
+
+        Returns:
+            ThreadingHTTPServer: the server, whose server_address gives the port when it was 0. shutdown stops it
+        """
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
@@ -0,0 +1,170 @@
+import csv
+import io
+import os
+from itertools import islice
+
+from schema import DEFAULT_SAMPLE_SIZE, Schema
+
+DEFAULT_CHUNK_SIZE = 10000
+INFER = 'infer'
+
+
+def read_header(csv_path):
+    """Reads just the column names of a csv
+
+    Args:
+        csv_path (str): the path to the csv
+
+    Returns:
+        list of str: the column names, empty if the file is empty
+    """
+    with open(csv_path) as csv_file:
+        return next(csv.reader(csv_file, delimiter=','), [])
+
+
+def read_sample(csv_path, sample_size=DEFAULT_SAMPLE_SIZE):
+    """Reads the column names and the leading rows of a csv, unparsed
+
+    Args:
+        csv_path (str): the path to the csv
+        sample_size (int): the maximum number of rows to read
+
+    Returns:
+        tuple of list, list: the column names and the sampled rows
+    """
+    with open(csv_path) as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter=',')
+        header = next(csv_reader, [])
+        return header, list(islice(csv_reader, sample_size))
+
+
+def resolve_schema(header, sample, schema=None):
+    """Works out the schema a csv is parsed with
+
+    Args:
+        header (list of str): the column names of the csv
+        sample (list of list of str): the leading rows of the csv
+        schema (Schema or dict or str): None to keep parsing numbers as floats and everything else as strings,
+            'infer' to infer every column's type from the sample, or the types of some or all of the columns.
+            Columns left out of a given schema are parsed as floats or strings
+
+    Returns:
+        Schema: the schema covering every column of the csv
+    """
+    if schema == INFER:
+        return Schema.infer(header, sample)
+    inferred = Schema.infer(header, sample, legacy=True)
+    if schema is None:
+        return inferred
+    if not isinstance(schema, Schema):
+        schema = Schema(schema)
+    return inferred.merge(schema)
+
+
+class CsvReader(object):
+    """Reads a csv in fixed size chunks of parsed rows, so that at most chunk_size rows are held at once.
+
+    Only the columns that are kept or tested by the predicate are parsed, and rows that fail the predicate
+    are dropped before they are added to a chunk.
+    """
+
+    def __init__(self, csv_path, columns=None, predicate=None, chunk_size=DEFAULT_CHUNK_SIZE, limit=None,
+                 schema=None, sample_size=DEFAULT_SAMPLE_SIZE, byte_range=None):
+        """
+        Args:
+            csv_path (str): the path to the csv
+            columns (list of str): if passed, only these columns are kept, in this order
+            predicate (Predicate): if passed, only rows that pass this predicate are kept
+            chunk_size (int): the maximum number of rows in each chunk
+            limit (int): if passed, stops after limit rows have been kept
+            schema (Schema or dict or str): the column types to parse with, see resolve_schema
+            sample_size (int): the number of leading rows used to infer column types
+            byte_range (tuple of int): if passed, only the rows between these start and end byte offsets are read,
+                see byte_ranges
+        """
+        self.csv_path = csv_path
+        self.byte_range = byte_range
+        self.header, sample = read_sample(csv_path, sample_size)
+        self.schema = resolve_schema(self.header, sample, schema)
+        self.columns = list(columns) if columns is not None else list(self.header)
+        if predicate is not None:
+            predicate = predicate.bind(self.schema)
+        self.predicate = predicate
+        self.chunk_size = chunk_size
+        self.limit = limit
+
+        # the predicate may read columns that are not kept, these are parsed after the kept columns
+        self._parsed_columns = list(self.columns)
+        if predicate is not None:
+            self._parsed_columns += sorted(predicate.columns() - set(self.columns))
+        for column_name in self._parsed_columns:
+            if column_name not in self.header:
+                raise ValueError('column name {} does not exist'.format(column_name))
+
+    def __iter__(self):
+        """Yields:
+            list of tuple: the next chunk of rows
+        """
+        parse_row = self.schema.row_parser(self.header, self._parsed_columns)
+        test = self.predicate.compile(self._parsed_columns) if self.predicate is not None else None
+        n_columns = len(self.columns)
+        project = len(self._parsed_columns) != n_columns
+
+        chunk = []
+        kept = 0
+        if self.limit is not None and self.limit <= 0:
+            return
+        with self._open() as csv_file:
+            csv_reader = csv.reader(csv_file, delimiter=',')
+            if self.byte_range is None:
+                next(csv_reader, None)
+            for row in csv_reader:
+                row = parse_row(row)
+                if test is not None and not test(row):
+                    continue
+                chunk.append(row[:n_columns] if project else row)
+                kept += 1
+                if self.limit is not None and kept >= self.limit:
+                    break
+
+                if len(chunk) >= self.chunk_size:
+                    yield chunk
+                    chunk = []
+
+        if chunk:
+            yield chunk
+
+    def _open(self):
+        if self.byte_range is None:
+            return open(self.csv_path)
+        start, end = self.byte_range
+        with open(self.csv_path, 'rb') as csv_file:
+            csv_file.seek(start)
+            return io.StringIO(csv_file.read(end - start).decode(), newline=None)
+
+
+def byte_ranges(csv_path, partition_size):
+    """Splits the rows of a csv into ranges of roughly partition_size bytes, each starting at the start of a line.
+    Cells are assumed not to contain line breaks
+
+    Args:
+        csv_path (str): the path to the csv
+        partition_size (int): the approximate number of bytes in each range
+
+    Returns:
+        list of tuple: the start and end byte offsets of each range, in file order, covering every row after the
+            header
+    """
+    size = os.path.getsize(csv_path)
+    ranges = []
+    with open(csv_path, 'rb') as csv_file:
+        csv_file.readline()
+        start = csv_file.tell()
+        while start < size:
+            csv_file.seek(min(start + partition_size, size) - 1)
+            # finish the line the range ends in
+            csv_file.readline()
+            end = csv_file.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
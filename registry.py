@@ -0,0 +1,163 @@
+"""A process wide registry of loaded datasets, so that every request against the same csv shares one read only
+copy of it instead of parsing and holding its own."""
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from columnar import ColumnarDataset
+
+
+def source_version(csv_path):
+    """Returns:
+        tuple: the modification time and size of the csv, which change whenever the csv is rewritten
+    """
+    stat = os.stat(csv_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class _Entry(object):
+    def __init__(self, key, version):
+        self.key = key
+        self.version = version
+        self.dataset = None
+        self.size = 0
+        self.references = 0
+        # held while the dataset is loaded, so concurrent requests for the same csv wait for one load
+        self.lock = threading.Lock()
+
+
+class DatasetRegistry(object):
+    """Loads each csv once and hands the same frozen ColumnarDataset to every caller.
+
+    Callers acquire a dataset and release it when they are done with it. Datasets that are not in use are
+    evicted, least recently used first, when the registry holds more than its memory budget. Datasets that are in
+    use are never evicted, so the budget can be exceeded while they are held.
+
+    Shared datasets are read only: operations on them return new datasets, so one caller's results are never seen
+    by another. copy gives a caller a writable dataset of its own.
+    """
+
+    def __init__(self, memory_budget=None, cache=None):
+        """
+        Args:
+            memory_budget (int): if passed, the number of bytes of unused datasets the registry keeps
+            cache (DatasetCache): if passed, datasets are loaded through this cache
+        """
+        self.memory_budget = memory_budget
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._leases = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _load(self, csv_path, schema):
+        if self.cache is not None:
+            return self.cache.load(csv_path, schema=schema)
+        return ColumnarDataset(os.path.basename(csv_path)).populate(csv_path, schema=schema)
+
+    def acquire(self, csv_path, name=None, schema=None):
+        """Gets the shared dataset for a csv, loading it if it is not registered or the csv has changed. Every
+        acquire must be matched by a release of the returned dataset
+
+        Args:
+            csv_path (str): the path to the csv
+            name (str): the name of the returned dataset
+            schema (Schema or dict or str): the column types to parse with, see Dataset.populate
+
+        Returns:
+            ColumnarDataset: a read only view of the shared dataset
+        """
+        key = (os.path.abspath(csv_path), repr(schema))
+        version = source_version(csv_path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.version != version:
+                # callers still holding the old version keep it until they release it
+                self._remove(entry)
+                entry = None
+            if entry is None:
+                entry = _Entry(key, version)
+                self._entries[key] = entry
+                self.misses += 1
+            else:
+                self.hits += 1
+            self._entries.move_to_end(key)
+            entry.references += 1
+
+        try:
+            with entry.lock:
+                if entry.dataset is None:
+                    dataset = self._load(csv_path, schema).freeze()
+                    with self._lock:
+                        entry.dataset = dataset
+                        entry.size = dataset.memory_usage()
+                        if self._entries.get(key) is entry:
+                            self._bytes += entry.size
+                            self._evict()
+        except BaseException:
+            with self._lock:
+                entry.references -= 1
+                if entry.dataset is None:
+                    self._remove(entry)
+            raise
+
+        dataset = entry.dataset.view(name)
+        with self._lock:
+            self._leases[id(dataset)] = entry
+        return dataset
+
+    def release(self, dataset):
+        """Gives back a dataset returned by acquire
+
+        Args:
+            dataset (ColumnarDataset): the acquired dataset
+        """
+        with self._lock:
+            entry = self._leases.pop(id(dataset), None)
+            if entry is None:
+                raise ValueError('dataset {} was not acquired from this registry'.format(dataset.name))
+            entry.references -= 1
+            self._evict()
+
+    @contextmanager
+    def borrow(self, csv_path, name=None, schema=None):
+        """Acquires a dataset for the duration of a with block, see acquire"""
+        dataset = self.acquire(csv_path, name=name, schema=schema)
+        try:
+            yield dataset
+        finally:
+            self.release(dataset)
+
+    def _remove(self, entry):
+        if self._entries.get(entry.key) is entry:
+            del self._entries[entry.key]
+            self._bytes -= entry.size
+
+    def _evict(self):
+        if self.memory_budget is None:
+            return
+        for entry in list(self._entries.values()):
+            if self._bytes <= self.memory_budget:
+                break
+            if entry.references == 0 and entry.dataset is not None:
+                self._remove(entry)
+                self.evictions += 1
+
+    def stats(self):
+        """Returns:
+            dict: the hit, miss and eviction counts, and the number and total size of the registered datasets
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'in_use': sum(1 for entry in self._entries.values() if entry.references),
+                'bytes': self._bytes,
+                'memory_budget': self.memory_budget,
+            }
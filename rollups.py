@@ -0,0 +1,238 @@
+"""Materialized daily rollups of an ad report, for rolling window queries.
+
+A Rollup keeps the sums of some value columns for each group, such as an asin, and each day. It also keeps the
+running totals of each group's daily sums in day order. The sum of a group over any date range is then the
+difference of two running totals, found by binary search. A window query takes time in proportion to the number of
+groups, however many rows and days the rollup was built from.
+
+Appending rows only updates the groups and days they touch. For rows of days after a group's last day, this just
+adds running totals at the end. Daily sums and running totals are kept exactly, as an int and an exact expansion
+of floats like Sum keeps, so window sums are the same correctly rounded values that aggregating the raw rows with
+Sum gives.
+
+A rollup can also keep a mergeable aggregation, such as the sketches of the sketches module, of each group and day.
+These have no running totals, so a window query merges the daily accumulators of the days in the window.
+"""
+import math
+from bisect import bisect_left, bisect_right
+from datetime import date, timedelta
+
+from aggregators import Sum, exact_expansion, resolve_aggregations
+from dataset import Dataset, group_and_accumulate, tuple_getter
+from schema import coerce_literal
+
+DEFAULT_VALUE_COLUMNS = ('sales', 'ad_spend', 'clicks', 'impressions')
+
+
+def _shift(day, days):
+    """Returns:
+        date or str: the day, an ISO date string or a date, moved by a number of days
+    """
+    if isinstance(day, str):
+        return (date.fromisoformat(day) + timedelta(days=days)).isoformat()
+    return day + timedelta(days=days)
+
+
+def _add(total, other):
+    """Returns:
+        tuple of int, list of float: the exact sum of two exact sums, see Sum.exact
+    """
+    return total[0] + other[0], exact_expansion(total[1] + other[1])
+
+
+class _Series(object):
+    """The daily sums of one group, and their running totals in day order"""
+
+    def __init__(self, n_columns):
+        self.daily = {}
+        self.days = []
+        # totals[i] holds the sums of the days before days[i]
+        self.totals = [[(0, [])] * n_columns]
+        # the accumulators of the rollup's aggregations for each day
+        self.accumulators = {}
+        self._new_days = set()
+        self._earliest = None
+
+    def add(self, day, sums, accumulators=None):
+        daily = self.daily.get(day)
+        if daily is None:
+            self.daily[day] = sums
+            self._new_days.add(day)
+        else:
+            self.daily[day] = [_add(a, b) for a, b in zip(daily, sums)]
+        if accumulators is not None:
+            existing = self.accumulators.get(day)
+            if existing is None:
+                self.accumulators[day] = accumulators
+            else:
+                for accumulator, other in zip(existing, accumulators):
+                    accumulator.merge(other)
+        if self._earliest is None or day < self._earliest:
+            self._earliest = day
+
+    def refresh(self):
+        """Recomputes the running totals from the earliest day that changed"""
+        if self._earliest is None:
+            return
+        new_days = sorted(self._new_days)
+        if not self.days or new_days and new_days[0] > self.days[-1]:
+            self.days.extend(new_days)
+        elif new_days:
+            self.days = sorted(self.days + new_days)
+        start = bisect_left(self.days, self._earliest)
+        del self.totals[start + 1:]
+        for day in self.days[start:]:
+            self.totals.append([_add(a, b) for a, b in zip(self.totals[-1], self.daily[day])])
+        self._new_days = set()
+        self._earliest = None
+
+
+class Rollup(object):
+    """The daily sums of value columns for each group of a dataset, see the module docstring"""
+
+    def __init__(self, group_by_columns=('asin',), value_columns=DEFAULT_VALUE_COLUMNS, date_column='date',
+                 name='rollup', aggregations=()):
+        """
+        Args:
+            group_by_columns (iterable of str): the columns to group by
+            value_columns (iterable of str): the numeric columns to sum
+            date_column (str): the column holding the day of each row
+            name (str): the name of the datasets returned by queries
+            aggregations (iterable of tuple): (column, Aggregator, output_column) tuples of other aggregations to
+                keep for each day, e.g. ('keyword_id', ApproxCountDistinct(), 'keywords'), see
+                aggregators.resolve_aggregations. Each Aggregator must support merge
+        """
+        self.group_by_columns = list(group_by_columns)
+        self.value_columns = list(value_columns)
+        self.date_column = date_column
+        self.name = name
+        self.aggregations = resolve_aggregations(aggregations)
+        for aggregate_column, _, output_column in self.aggregations:
+            if isinstance(aggregate_column, tuple):
+                raise ValueError('rollup aggregations read a single column, not {}'.format(aggregate_column))
+            if output_column in self.group_by_columns + self.value_columns:
+                raise ValueError('output column {} is already a column of the rollup'.format(output_column))
+        self.schema = None
+        self._groups = {}
+        # like Sum, a column only sums to an int while every value in it is one
+        self._integer = [True] * len(self.value_columns)
+
+    def update(self, dataset):
+        """Adds the rows of a dataset to the rollup. Rows without a day are ignored
+
+        Args:
+            dataset (Dataset or ColumnarDataset): rows with the group by, value and date columns
+
+        Returns:
+            Rollup: self
+        """
+        aggregate_columns = [aggregate_column for aggregate_column, _, _ in self.aggregations]
+        for column_name in self.group_by_columns + self.value_columns + [self.date_column] + aggregate_columns:
+            dataset._validate_column_name(column_name)
+        if self.schema is None and dataset.schema is not None:
+            self.schema = dataset.schema.select(self.group_by_columns + [self.date_column])
+
+        get_key = tuple_getter([dataset.columns.index(column_name)
+                                for column_name in self.group_by_columns + [self.date_column]])
+        get_values = tuple_getter([dataset.columns.index(column_name) for column_name in self.value_columns])
+        date_index = dataset.columns.index(self.date_column)
+        rows = [row for row in dataset.data if row[date_index] is not None]
+        daily_sums = group_and_accumulate(map(get_key, rows), map(get_values, rows),
+                                          [Sum() for _ in self.value_columns])
+        daily_accumulators = {}
+        if self.aggregations:
+            get_aggregate_values = tuple_getter([dataset.columns.index(column_name)
+                                                 for column_name in aggregate_columns])
+            daily_accumulators = group_and_accumulate(map(get_key, rows), map(get_aggregate_values, rows),
+                                                      [prototype for _, prototype, _ in self.aggregations])
+
+        touched = []
+        for key, sums in daily_sums.items():
+            accumulators = daily_accumulators.get(key)
+            key, day = key[:-1], key[-1]
+            for i, total in enumerate(sums):
+                if not isinstance(total.result(), int):
+                    self._integer[i] = False
+            series = self._groups.get(key)
+            if series is None:
+                series = self._groups[key] = _Series(len(self.value_columns))
+            series.add(day, [total.exact() for total in sums], accumulators)
+            touched.append(series)
+        for series in touched:
+            series.refresh()
+        return self
+
+    def _day(self, day):
+        return coerce_literal(self.schema.get(self.date_column) if self.schema is not None else None, day)
+
+    def _difference(self, i, start, end):
+        """Returns:
+            int or float: the correctly rounded difference of two running totals of a value column
+        """
+        integer = end[0] - start[0]
+        if self._integer[i]:
+            return integer
+        return math.fsum(end[1] + [-value for value in start[1]] + [integer])
+
+    def window(self, start, end, inclusive=False):
+        """Sums the value columns of each group over a date range, like between_filter on the date column followed
+        by aggregating with Sum, and the rollup's aggregations. Groups without rows in the range are left out, and
+        the rest are in the order they were first added to the rollup
+
+        Args:
+            start (date or str): the start of the range
+            end (date or str): the end of the range
+            inclusive (bool): if true, the range includes its start and end days
+
+        Returns:
+            Dataset: the group by columns, the sum of each value column and the output column of each aggregation
+        """
+        start, end = self._day(start), self._day(end)
+        lower, upper = (bisect_left, bisect_right) if inclusive else (bisect_right, bisect_left)
+        data = []
+        for key, series in self._groups.items():
+            i, j = lower(series.days, start), upper(series.days, end)
+            if i < j:
+                sums = [self._difference(k, a, b) for k, (a, b) in enumerate(zip(series.totals[i], series.totals[j]))]
+                data.append(key + tuple(sums) + self._merged(series, series.days[i:j]))
+        schema = self.schema.select(self.group_by_columns) if self.schema is not None else None
+        columns = self.group_by_columns + self.value_columns + [output for _, _, output in self.aggregations]
+        return Dataset(self.name, columns=columns, data=data, schema=schema)
+
+    def _merged(self, series, days):
+        """Returns:
+            tuple: the results of the aggregations over the given days of a group
+        """
+        if not self.aggregations:
+            return ()
+        merged = [prototype.new() for _, prototype, _ in self.aggregations]
+        for day in days:
+            for accumulator, daily in zip(merged, series.accumulators[day]):
+                accumulator.merge(daily)
+        return tuple(accumulator.result() for accumulator in merged)
+
+    def trailing(self, end, days):
+        """Sums each group over the given number of days before end, not including end itself
+
+        Args:
+            end (date or str): the day after the window
+            days (int): the length of the window in days
+
+        Returns:
+            Dataset: see window
+        """
+        return self.window(_shift(self._day(end), -days - 1), end)
+
+    def top_n(self, column_name, n, start, end, inclusive=False, descending=True):
+        """Returns:
+            Dataset: the n groups with the largest sums of a value column over a date range, see window
+        """
+        return self.window(start, end, inclusive=inclusive).top_n(column_name, n, descending=descending)
+
+    def trailing_top_n(self, column_name, n, end, days, descending=True):
+        """Returns:
+            Dataset: the n groups with the largest sums of a value column over the days before end, see trailing,
+                e.g. trailing_top_n('sales', 1, '2017-06-01', 30) for the best selling asin of the 30 days before
+                June 1st
+        """
+        return self.trailing(end, days).top_n(column_name, n, descending=descending)
@@ -0,0 +1,247 @@
+"""Column types, and the converters used to parse csv cells into them.
+
+A Schema maps column names to one of the types below. The converter for each column is picked once, so
+parsing a row is a single pass of converter calls with no exception handling unless a cell does not
+convert.
+
+Without a schema, a csv is parsed the way the Dataset always has, every cell that converts to a float as a float
+and every other cell, empty ones included, as a string. The float or string type of each column is inferred from
+a sample, and cells of a later row that do not fit it fall back to that parsing, so the result is the same as
+trying every cell as a float. With an inferred or given schema, empty cells are parsed as None.
+"""
+import sys
+from datetime import date
+from operator import itemgetter
+
+try:
+    from operator import call
+except ImportError:  # python < 3.11
+    def call(function, *args):
+        return function(*args)
+
+INT64 = 'int64'
+FLOAT64 = 'float64'
+DATE = 'date'
+CATEGORICAL = 'categorical'
+STRING = 'string'
+
+CONVERTERS = {
+    INT64: int,
+    FLOAT64: float,
+    DATE: date.fromisoformat,
+    # interning stores each distinct value of a repetitive column once
+    CATEGORICAL: sys.intern,
+    STRING: str,
+}
+
+DEFAULT_SAMPLE_SIZE = 1000
+# the most distinct cells of a column of strings whose parsed value is kept, see string_cell_parser
+MAX_CACHED_CELLS = 100000
+# the first characters of the cells that float may convert, besides digits and whitespace
+_NUMBER_STARTS = '+-.iInN'
+# string columns with at most this ratio of distinct values to rows are inferred as categorical
+CATEGORICAL_RATIO = 0.5
+
+
+def parse_cell(cell):
+    """Converts a cell to a float if it looks like a number, otherwise leaves it as a string"""
+    try:
+        return float(cell)
+    except ValueError:
+        return cell
+
+
+def string_cell_parser(max_cached=MAX_CACHED_CELLS):
+    """Builds the parse_cell of a column of strings of a csv parsed without a schema. Only the cells that may be
+    numbers are tried as floats, and the value of up to max_cached distinct cells is kept, so a repetitive column
+    such as dates only tries each value once
+
+    Returns:
+        callable: a function that takes a cell and returns it as a float or string
+    """
+    parsed = {}
+
+    def parse_string_cell(cell):
+        value = parsed.get(cell)
+        if value is None:
+            first = cell[:1]
+            value = parse_cell(cell) if first.isdigit() or first in _NUMBER_STARTS or first.isspace() else cell
+            if len(parsed) < max_cached:
+                parsed[cell] = value
+        return value
+
+    return parse_string_cell
+
+
+def _all_convert(converter, values):
+    try:
+        for value in values:
+            converter(value)
+    except ValueError:
+        return False
+    return True
+
+
+def _has_leading_zeros(values):
+    """Identifiers such as 00123 look like numbers but lose information when parsed as one"""
+    return any(len(value) > 1 and value[0] == '0' and value[1].isdigit() for value in values)
+
+
+def infer_type(values, legacy=False):
+    """Infers the type of a column from a sample of its cells
+
+    Args:
+        values (list of str): the raw cells sampled from the column
+        legacy (bool): if true, only chooses between float64 and string, the types the Dataset has always
+            parsed to
+
+    Returns:
+        str: the inferred type
+    """
+    values = [value for value in values if value != '']
+    if not values:
+        return STRING
+    if legacy:
+        return FLOAT64 if _all_convert(float, values) else STRING
+
+    if not _has_leading_zeros(values):
+        if _all_convert(int, values):
+            return INT64
+        if _all_convert(float, values):
+            return FLOAT64
+    if _all_convert(date.fromisoformat, values):
+        return DATE
+    if len(set(values)) <= CATEGORICAL_RATIO * len(values):
+        return CATEGORICAL
+    return STRING
+
+
+def coerce_literal(column_type, value):
+    """Converts a constant compared against a column to the column's type, so that a date column can be
+    filtered with date strings
+
+    Args:
+        column_type (str): the type of the column, or None if it is not known
+        value (object): the constant
+
+    Returns:
+        object: the converted constant
+    """
+    if column_type == DATE and isinstance(value, str):
+        return date.fromisoformat(value)
+    return value
+
+
+class Schema(object):
+    """The types of the columns of a dataset"""
+
+    def __init__(self, types, inferred=(), legacy=()):
+        """
+        Args:
+            types (dict of str, str): a mapping of column name to type
+            inferred (iterable of str): the columns whose type was guessed from a sample. Cells in these columns
+                that do not convert fall back to the float or string parsing, rather than raising an error
+            legacy (iterable of str): the inferred columns that are parsed without a schema, see the module
+                docstring
+        """
+        for column_name, column_type in types.items():
+            if column_type not in CONVERTERS:
+                raise ValueError('column type {} of column {} is not supported'.format(column_type, column_name))
+        self.types = dict(types)
+        self.inferred = frozenset(inferred)
+        self.legacy = frozenset(legacy) & self.inferred
+
+    @classmethod
+    def infer(cls, columns, rows, legacy=False):
+        """Infers a schema from a sample of csv rows
+
+        Args:
+            columns (list of str): the column names
+            rows (list of list of str): the sampled rows
+            legacy (bool): see infer_type
+
+        Returns:
+            Schema: the inferred schema
+        """
+        types = {}
+        for i, column_name in enumerate(columns):
+            types[column_name] = infer_type([row[i] for row in rows if i < len(row)], legacy=legacy)
+        return cls(types, inferred=columns, legacy=columns if legacy else ())
+
+    def get(self, column_name):
+        return self.types.get(column_name)
+
+    def select(self, columns):
+        """Returns:
+            Schema: the part of this schema that covers the given columns
+        """
+        return Schema(
+            {column_name: self.types[column_name] for column_name in columns if column_name in self.types},
+            inferred=self.inferred & set(columns),
+            legacy=self.legacy & set(columns)
+        )
+
+    def merge(self, other):
+        """Returns:
+            Schema: this schema with the types of the other schema added, the other schema winning conflicts
+        """
+        types = dict(self.types)
+        types.update(other.types)
+        return Schema(types, inferred=(self.inferred - set(other.types)) | other.inferred,
+                      legacy=(self.legacy - set(other.types)) | other.legacy)
+
+    def row_parser(self, header, columns):
+        """Builds a function that parses the given columns out of a raw csv row
+
+        Args:
+            header (list of str): the column names of the csv
+            columns (list of str): the columns to parse, in output order
+
+        Returns:
+            callable: a function that takes a list of cells and returns a tuple of values
+        """
+        indices = [header.index(column_name) for column_name in columns]
+        converters = [self._converter(column_name) for column_name in columns]
+        if indices == list(range(len(header))):
+            select = None
+        elif len(indices) == 1:
+            select = lambda row: (row[indices[0]],)
+        else:
+            select = itemgetter(*indices)
+
+        def parse_row(row):
+            try:
+                return tuple(map(call, converters, row if select is None else select(row)))
+            except ValueError:
+                # only rows with a missing or unexpected cell take the cell by cell path
+                return tuple([self._parse_cell(column_name, row[i]) for column_name, i in zip(columns, indices)])
+
+        return parse_row
+
+    def _converter(self, column_name):
+        column_type = self.types.get(column_name, STRING)
+        if column_type == STRING and column_name in self.legacy:
+            return string_cell_parser()
+        return CONVERTERS[column_type]
+
+    def _parse_cell(self, column_name, cell):
+        if column_name in self.legacy:
+            return parse_cell(cell)
+        column_type = self.types.get(column_name, STRING)
+        try:
+            return CONVERTERS[column_type](cell)
+        except ValueError:
+            if cell == '':
+                return None
+            if column_name in self.inferred:
+                return parse_cell(cell)
+            raise ValueError('could not convert {!r} in column {} to {}'.format(cell, column_name, column_type))
+
+    def __eq__(self, other):
+        return isinstance(other, Schema) and self.types == other.types
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Schema({!r})'.format(self.types)
@@ -0,0 +1,307 @@
+"""Incremental encodings of DatasetAPI results.
+
+Each format is produced as a sequence of byte chunks, a block of rows or of one column's values at a time, so a
+result is never copied into a list of row tuples or encoded in one step:
+
+    json      {<name>: {"columns": [...], "data": [[<row>], ...]}, ...}, the layout handle_request returns
+    ndjson    per dataset, a line {"dataset": <name>, "columns": [...], ...} followed by one line per row
+    columns   {<name>: {"columns": [...], "data": {<column>: [<values>], ...}}, ...}
+    binary    per dataset, a frame of the typed buffers of its columns, see read_binary
+
+Dates are encoded as ISO strings, except in binary dictionary columns, which keep them as dates.
+
+Results can be paged. With max_rows, each dataset includes at most that many rows, starting at an offset. Its
+header then has a next_cursor, an opaque token that is passed back with the same request to get the following
+page of that dataset alone, or null once the last row has been sent.
+
+A binary frame is MAGIC, the length of its JSON header as a little endian uint32, the header, padding to ALIGNMENT
+from the start of the frame, and then the buffer of each column, each padded to ALIGNMENT. The header holds the
+name, columns, offset, rows, total_rows and next_cursor of the page, and the byteorder and layout of each column
+buffer, one of:
+
+    numeric      an array of the typecode's items
+    dictionary   an array of codes of the typecode into the header's dictionary of strings or ISO dates
+    json         the JSON list of the values
+"""
+import base64
+import hashlib
+import json
+import struct
+import sys
+from datetime import date
+from itertools import islice
+from operator import itemgetter
+
+from columnar import ColumnarDataset, DictionaryColumn, NumericColumn, ObjectColumn, build_column, typecode
+
+JSON = 'json'
+NDJSON = 'ndjson'
+COLUMNS = 'columns'
+BINARY = 'binary'
+FORMATS = (JSON, NDJSON, COLUMNS, BINARY)
+CONTENT_TYPES = {
+    JSON: 'application/json',
+    NDJSON: 'application/x-ndjson',
+    COLUMNS: 'application/json',
+    BINARY: 'application/octet-stream',
+}
+
+# rows, or values of a column, encoded at a time
+BLOCK_SIZE = 1000
+MAGIC = b'TKMB\x00\x00\x00\x01'
+_HEADER_LENGTH = struct.Struct('<I')
+ALIGNMENT = 8
+
+_encoder = json.JSONEncoder(separators=(',', ':'), default=str)
+
+
+def _aligned(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _dumps(value):
+    return _encoder.encode(value)
+
+
+def canonical_json(payload):
+    """Returns:
+        str: the JSON of a payload with sorted keys and no whitespace, the same for equal payloads
+    """
+    return json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str)
+
+
+def request_key(payload):
+    """Returns:
+        str: a hash of the canonical JSON of a request, which ties a cursor to the request it came from
+    """
+    return hashlib.sha256(canonical_json(payload).encode()).hexdigest()[:16]
+
+
+def encode_cursor(key, dataset_name, offset):
+    """Returns:
+        str: a token for the page of a dataset that starts at offset
+    """
+    cursor = _dumps({'request': key, 'dataset': dataset_name, 'offset': offset})
+    return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+
+def decode_cursor(cursor, key):
+    """Reads a token made by encode_cursor
+
+    Args:
+        cursor (str): the token
+        key (str): the request_key of the request the token was passed with
+
+    Returns:
+        tuple of str, int: the dataset name and offset of the page
+    """
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        dataset_name, offset = decoded['dataset'], int(decoded['offset'])
+    except (ValueError, KeyError, TypeError):
+        raise ValueError('cursor {!r} is not valid'.format(cursor))
+    if decoded.get('request') != key:
+        raise ValueError('cursor {!r} belongs to a different request'.format(cursor))
+    return dataset_name, offset
+
+
+class _Page(object):
+    """The rows of a dataset that are sent, and the cursor to the rows after them"""
+
+    def __init__(self, key, name, dataset, offset, max_rows):
+        self.name = name
+        self.dataset = dataset
+        self.total_rows = len(dataset) if isinstance(dataset, ColumnarDataset) else len(dataset.data)
+        self.start = min(offset, self.total_rows)
+        self.stop = self.total_rows if max_rows is None else min(self.start + max_rows, self.total_rows)
+        self.next_cursor = encode_cursor(key, name, self.stop) if self.stop < self.total_rows else None
+        self.paged = max_rows is not None or offset > 0
+
+    def header(self):
+        header = {'columns': self.dataset.columns}
+        if self.paged:
+            header.update(offset=self.start, rows=self.stop - self.start, total_rows=self.total_rows,
+                          next_cursor=self.next_cursor)
+        return header
+
+    def row_blocks(self):
+        """Yields:
+            list of tuple: the next block of rows of the page
+        """
+        dataset = self.dataset
+        for start in range(self.start, self.stop, BLOCK_SIZE):
+            stop = min(start + BLOCK_SIZE, self.stop)
+            if isinstance(dataset, ColumnarDataset):
+                yield list(zip(*[column.slice(slice(start, stop)).to_list() for column in dataset.column_data]))
+            else:
+                yield dataset.data[start:stop]
+
+    def column(self, i):
+        """Returns:
+            Column: the page's values of one column
+        """
+        if isinstance(self.dataset, ColumnarDataset):
+            return self.dataset.column_data[i].slice(slice(self.start, self.stop))
+        return build_column(map(itemgetter(i), islice(self.dataset.data, self.start, self.stop)))
+
+    def value_blocks(self, i):
+        """Yields:
+            list: the next block of values of one column of the page
+        """
+        if isinstance(self.dataset, ColumnarDataset):
+            column = self.dataset.column_data[i]
+            for start in range(self.start, self.stop, BLOCK_SIZE):
+                yield column.slice(slice(start, min(start + BLOCK_SIZE, self.stop))).to_list()
+        else:
+            values = map(itemgetter(i), islice(self.dataset.data, self.start, self.stop))
+            for block in iter(lambda: list(islice(values, BLOCK_SIZE)), []):
+                yield block
+
+
+def _json_list(blocks):
+    """Yields the chunks of a JSON list, one block of items at a time"""
+    yield '['
+    first = True
+    for block in blocks:
+        if block:
+            encoded = _dumps(block)[1:-1]
+            yield encoded if first else ',' + encoded
+            first = False
+    yield ']'
+
+
+def _json(pages):
+    yield '{'
+    for n, page in enumerate(pages):
+        header = _dumps(page.header())[:-1]
+        yield '{}{}:{},"data":'.format(',' if n else '', _dumps(page.name), header)
+        for chunk in _json_list(page.row_blocks()):
+            yield chunk
+        yield '}'
+    yield '}'
+
+
+def _ndjson(pages):
+    for page in pages:
+        header = dict(dataset=page.name, **page.header())
+        yield _dumps(header) + '\n'
+        for block in page.row_blocks():
+            if block:
+                yield '\n'.join(map(_dumps, block)) + '\n'
+
+
+def _columns(pages):
+    yield '{'
+    for n, page in enumerate(pages):
+        header = _dumps(page.header())[:-1]
+        yield '{}{}:{},"data":{{'.format(',' if n else '', _dumps(page.name), header)
+        for i, column_name in enumerate(page.dataset.columns):
+            yield '{}{}:'.format(',' if i else '', _dumps(column_name))
+            for chunk in _json_list(page.value_blocks(i)):
+                yield chunk
+        yield '}}'
+    yield '}'
+
+
+def _column_buffer(column):
+    """Returns:
+        tuple of dict, bytes-like: the layout of a column in a binary frame, and its buffer
+    """
+    if isinstance(column, NumericColumn):
+        return {'kind': 'numeric', 'typecode': typecode(column.values)}, memoryview(column.values).cast('B')
+    if isinstance(column, DictionaryColumn) and all(type(value) in (str, date) for value in column.dictionary):
+        is_date = bool(column.dictionary) and type(column.dictionary[0]) is date
+        layout = {
+            'kind': 'dictionary',
+            'typecode': typecode(column.values),
+            'dictionary_type': 'date' if is_date else 'str',
+            'dictionary': [value.isoformat() for value in column.dictionary] if is_date else list(column.dictionary),
+        }
+        return layout, memoryview(column.values).cast('B')
+    return {'kind': 'json'}, ''.join(_json_list([column.to_list()])).encode()
+
+
+def _binary(pages):
+    for page in pages:
+        # each column is built once, and released once it is written
+        layouts, buffers = [], []
+        for i in range(len(page.dataset.columns)):
+            layout, buffer = _column_buffer(page.column(i))
+            layout['length'] = len(buffer)
+            layouts.append(layout)
+            buffers.append(buffer)
+        header = dict(name=page.name, byteorder=sys.byteorder, column_data=layouts, **page.header())
+        header = _dumps(header).encode()
+        start = len(MAGIC) + _HEADER_LENGTH.size + len(header)
+        yield MAGIC + _HEADER_LENGTH.pack(len(header)) + header + b'\0' * (_aligned(start) - start)
+        for i, buffer in enumerate(buffers):
+            buffers[i] = None
+            yield bytes(buffer) + b'\0' * (_aligned(len(buffer)) - len(buffer))
+
+
+def serialize(datasets, response_format=JSON, max_rows=None, key=None, offset=0):
+    """Encodes datasets incrementally in one of the FORMATS
+
+    Args:
+        datasets (dict of str, Dataset): the datasets to encode, by the name to give them
+        response_format (str): one of the FORMATS
+        max_rows (int): if passed, the most rows of each dataset to encode
+        key (str): the request_key of the request, which the cursors are tied to
+        offset (int): the first row of each dataset to encode
+
+    Yields:
+        bytes: the next chunk of the encoding
+    """
+    if response_format not in FORMATS:
+        raise ValueError('response format {} is not supported'.format(response_format))
+    if max_rows is not None and max_rows < 0:
+        raise ValueError('max_rows must not be negative')
+    pages = [_Page(key, name, dataset, offset, max_rows) for name, dataset in datasets.items()]
+    if response_format == BINARY:
+        for chunk in _binary(pages):
+            yield chunk
+        return
+
+    encode = {JSON: _json, NDJSON: _ndjson, COLUMNS: _columns}[response_format]
+    for chunk in encode(pages):
+        yield chunk.encode()
+
+
+def read_binary(data):
+    """Decodes the binary format
+
+    Args:
+        data (bytes): the frames of one or more datasets
+
+    Returns:
+        list of tuple: the header and a ColumnarDataset of each frame. The ColumnarDatasets share data's memory
+    """
+    buffer = memoryview(data)
+    frames = []
+    position = 0
+    while position < len(buffer):
+        if bytes(buffer[position:position + len(MAGIC)]) != MAGIC:
+            raise ValueError('data at {} is not a binary frame'.format(position))
+        header_start = position + len(MAGIC) + _HEADER_LENGTH.size
+        header_length, = _HEADER_LENGTH.unpack(buffer[position + len(MAGIC):header_start])
+        header = json.loads(bytes(buffer[header_start:header_start + header_length]).decode())
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError('frame {} was written with byteorder {}'.format(header['name'], header['byteorder']))
+
+        offset = position + _aligned(header_start + header_length - position)
+        column_data = []
+        for layout in header['column_data']:
+            column_buffer = buffer[offset:offset + layout['length']]
+            offset += _aligned(layout['length'])
+            if layout['kind'] == 'numeric':
+                column_data.append(NumericColumn(column_buffer.cast(layout['typecode'])))
+            elif layout['kind'] == 'dictionary':
+                dictionary = layout['dictionary']
+                if layout['dictionary_type'] == 'date':
+                    dictionary = [date.fromisoformat(value) for value in dictionary]
+                column_data.append(DictionaryColumn(column_buffer.cast(layout['typecode']), dictionary))
+            else:
+                column_data.append(ObjectColumn(json.loads(bytes(column_buffer).decode())))
+        frames.append((header, ColumnarDataset(header['name'], columns=header['columns'], column_data=column_data)))
+        position = offset
+    return frames
@@ -0,0 +1,503 @@
+"""An asyncio HTTP service around DatasetAPI.handle_request.
+
+    POST /query     runs a request, see DatasetAPI.handle_request, and responds with its result as JSON. The query
+                    parameters format, max_rows and cursor choose another encoding and page the result, see
+                    DatasetAPI.stream_request, e.g. /query?format=ndjson&max_rows=1000
+    POST /explain   responds with the plan a request would run, see DatasetAPI.explain
+    POST /profile   runs a request and responds with its result and profile as JSON, see DatasetAPI.profile_request
+    GET /health     responds with ok
+    GET /stats      responds with the service's counters as JSON
+
+Requests are run in a pool of worker processes, so the event loop only parses and routes them. Workers send the
+result back a chunk at a time as it is encoded, and each chunk is written to the connection as it arrives, with
+chunked transfer encoding, so no result is held whole. Identical requests that arrive while one of them is running
+share its result rather than running again. Responses up to max_cached_body bytes are kept in a least recently used
+cache keyed on a hash of the canonical JSON of the request and the versions of the csvs it reads, so a csv that is
+rewritten is never answered from the cache. Each request waits at most the timeout for the start of its result,
+and once max_pending distinct requests are running new ones are turned away until some finish.
+
+Run it with python service.py --port 8080, and see loadtest.py to measure it.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import threading
+from collections import OrderedDict
+from itertools import count
+from urllib.parse import parse_qs
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from api import DatasetAPI
+from partitioned import MANIFEST, is_partitioned
+from registry import source_version
+from serialization import CONTENT_TYPES, JSON, canonical_json
+
+DEFAULT_CACHE_SIZE = 256
+DEFAULT_TIMEOUT = 30.0
+DEFAULT_MAX_PENDING = 64
+# the largest request body read, in bytes
+MAX_BODY_SIZE = 1 << 20
+# the largest response body cached, in bytes
+MAX_CACHED_BODY = 1 << 20
+# the bytes of a result a worker sends back at a time
+STREAM_CHUNK_SIZE = 1 << 16
+
+STATUS_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable',
+    504: 'Gateway Timeout',
+}
+
+# the DatasetAPI of a worker and the queue its results are sent back on, see _set_api
+_api = None
+_chunks = None
+
+
+def _set_api(api, chunks=None):
+    global _api, _chunks
+    _api = api
+    _chunks = chunks
+
+
+def _execute(stream_id, payload, response_format, max_rows, cursor):
+    """Runs a request in a worker, sending its encoded result back on the chunk queue as (stream_id, chunk) pairs
+    of about STREAM_CHUNK_SIZE bytes, followed by (stream_id, None), see DatasetAPI.stream_request
+    """
+    try:
+        pending, size = [], 0
+        for chunk in _api.stream_request(payload, response_format, max_rows=max_rows, cursor=cursor):
+            pending.append(chunk)
+            size += len(chunk)
+            if size >= STREAM_CHUNK_SIZE:
+                _chunks.put((stream_id, b''.join(pending)))
+                pending, size = [], 0
+        if pending:
+            _chunks.put((stream_id, b''.join(pending)))
+    finally:
+        _chunks.put((stream_id, None))
+
+
+def _profile(payload):
+    """Profiles a request in a worker
+
+    Returns:
+        bytes: the JSON encoded result and profile
+    """
+    return json.dumps(_api.profile_request(payload), default=str).encode()
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super(HttpError, self).__init__(message)
+        self.status = status
+
+
+class Execution(object):
+    """The chunks of a request running in a worker, handed to every request reading it as they arrive"""
+
+    def __init__(self, loop, max_kept):
+        """
+        Args:
+            loop (asyncio.AbstractEventLoop): the loop of the requests reading it
+            max_kept (int): the most bytes of chunks kept for the cache and for requests that start reading later
+        """
+        self.loop = loop
+        self.max_kept = max_kept
+        # the chunks so far, None once they are more than max_kept bytes
+        self.chunks = []
+        self.size = 0
+        self.ended = asyncio.Event()
+        # the task that waits for the worker and caches the result, see DatasetService._run
+        self.task = None
+        self._readers = []
+
+    def put(self, chunk):
+        """Hands a chunk to the readers, None at the end of the result"""
+        if chunk is None:
+            self.ended.set()
+        elif self.chunks is not None:
+            self.size += len(chunk)
+            if self.size > self.max_kept:
+                self.chunks = None
+            else:
+                self.chunks.append(chunk)
+        for reader in self._readers:
+            reader.put_nowait(chunk)
+
+    def read(self):
+        """Returns:
+            asyncio.Queue: the chunks so far, and those that arrive later, ending with None
+        """
+        reader = asyncio.Queue()
+        for chunk in self.chunks:
+            reader.put_nowait(chunk)
+        if self.ended.is_set():
+            reader.put_nowait(None)
+        self._readers.append(reader)
+        return reader
+
+    def close(self, reader):
+        """Stops handing chunks to a reader"""
+        self._readers.remove(reader)
+
+
+async def read_body(body):
+    """Returns:
+        bytes: a body DatasetService.handle returned, read whole
+    """
+    if isinstance(body, bytes):
+        return body
+    return b''.join([chunk async for chunk in body])
+
+
+class DatasetService(object):
+    """Serves DatasetAPI requests over HTTP, see the module docstring"""
+
+    def __init__(self, api=None, workers=None, processes=True, cache_size=DEFAULT_CACHE_SIZE, timeout=DEFAULT_TIMEOUT,
+                 max_pending=DEFAULT_MAX_PENDING, max_cached_body=MAX_CACHED_BODY):
+        """
+        Args:
+            api (DatasetAPI): the api requests are run with, a new row based one by default. Each worker process
+                gets its own copy
+            workers (int): the number of workers, the number of cpus by default
+            processes (bool): if true, requests run in worker processes, otherwise in threads
+            cache_size (int): the number of responses cached, 0 to disable the cache
+            timeout (float): the number of seconds a request waits for the start of its result, None to wait forever
+            max_pending (int): the number of distinct requests that can run at once before new ones are refused
+            max_cached_body (int): the largest response cached, in bytes. Identical requests only share a running
+                result up to this size, as they may start reading it after its first chunks were written
+        """
+        self.api = api if api is not None else DatasetAPI()
+        pool_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        self._chunks = multiprocessing.Queue() if processes else queue.Queue()
+        self.pool = pool_class(max_workers=workers or os.cpu_count() or 1, initializer=_set_api,
+                               initargs=(self.api, self._chunks))
+        self.cache_size = cache_size
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.max_cached_body = max_cached_body
+        self.stats = {
+            'requests': 0,
+            'cache_hits': 0,
+            'coalesced': 0,
+            'executions': 0,
+            'timeouts': 0,
+            'rejected': 0,
+            'errors': 0,
+        }
+        self._cache = OrderedDict()
+        # the Execution that requests read by their request_key, and every running Execution by its stream_id
+        self._running = {}
+        self._streams = {}
+        self._stream_ids = count()
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def request_key(self, payload, options=()):
+        """Returns:
+            str: identifies the result of a request, from its canonical JSON, its encoding options and the versions
+                of the csvs it reads
+        """
+        versions = []
+        for csv_path in sorted(payload['datasets'].values()):
+            # a partitioned dataset's manifest is replaced on every append
+            path = os.path.join(csv_path, MANIFEST) if is_partitioned(csv_path) else csv_path
+            try:
+                versions.append((csv_path,) + source_version(path))
+            except OSError:
+                raise HttpError(404, 'dataset {} does not exist'.format(csv_path))
+        return hashlib.sha256((canonical_json(payload) + repr(tuple(options)) + repr(versions)).encode()).hexdigest()
+
+    def _cached(self, key):
+        body = self._cache.get(key)
+        if body is not None:
+            self._cache.move_to_end(key)
+        return body
+
+    def _dispatch(self):
+        """Hands the chunks the workers send back to their executions, until close"""
+        while True:
+            item = self._chunks.get()
+            if item is None:
+                break
+            stream_id, chunk = item
+            execution = self._streams.get(stream_id)
+            if execution is None:
+                continue
+            try:
+                execution.loop.call_soon_threadsafe(execution.put, chunk)
+            except RuntimeError:
+                # the loop of the requests reading it was closed
+                pass
+
+    async def _run(self, key, stream_id, execution, future):
+        """Waits for an execution to finish, caching its result if it is small enough"""
+        try:
+            await future
+            await execution.ended.wait()
+            if self.cache_size and execution.chunks is not None:
+                self._cache[key] = b''.join(execution.chunks)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        finally:
+            if not execution.ended.is_set():
+                # the worker failed before sending the end of the result
+                execution.put(None)
+            if self._running.get(key) is execution:
+                del self._running[key]
+            del self._streams[stream_id]
+
+    async def handle(self, payload, response_format=JSON, max_rows=None, cursor=None):
+        """Runs a request, or shares the result of an identical one that is cached or already running
+
+        Args:
+            payload (dict): see DatasetAPI.handle_request
+            response_format (str): the encoding of the result, see DatasetAPI.stream_request
+            max_rows (int): if passed, the most rows of each returned dataset to include
+            cursor (str): the next_cursor of a dataset from an earlier response to the same payload
+
+        Returns:
+            bytes or async iterator of bytes: the encoded result, whole if it was cached, otherwise its chunks as
+                they arrive, see read_body
+        """
+        self.stats['requests'] += 1
+        if not isinstance(payload, dict) or not isinstance(payload.get('datasets'), dict):
+            raise HttpError(400, 'a request needs a datasets object')
+        options = (response_format, max_rows, cursor)
+        key = self.request_key(payload, options)
+        body = self._cached(key)
+        if body is not None:
+            self.stats['cache_hits'] += 1
+            return body
+
+        execution = self._running.get(key)
+        if execution is not None and execution.chunks is not None:
+            self.stats['coalesced'] += 1
+        elif len(self._streams) >= self.max_pending:
+            self.stats['rejected'] += 1
+            raise HttpError(503, 'too many pending requests')
+        else:
+            self.stats['executions'] += 1
+            loop = asyncio.get_running_loop()
+            stream_id = next(self._stream_ids)
+            execution = Execution(loop, self.max_cached_body)
+            self._streams[stream_id] = execution
+            future = loop.run_in_executor(self.pool, _execute, stream_id, payload, *options)
+            # identical requests that arrive later read this one, unless its result also gets too big to share
+            self._running[key] = execution
+            execution.task = loop.create_task(self._run(key, stream_id, execution, future))
+            # its error is raised to the requests reading it, if any still are
+            execution.task.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+        reader = execution.read()
+        try:
+            # a request that times out leaves the execution running for the others reading it, and the cache
+            chunk = await asyncio.wait_for(reader.get(), self.timeout)
+            if chunk is None:
+                await execution.task
+        except asyncio.TimeoutError:
+            execution.close(reader)
+            self.stats['timeouts'] += 1
+            raise HttpError(504, 'the request did not start within {} seconds'.format(self.timeout))
+        except (KeyError, ValueError) as e:
+            execution.close(reader)
+            raise HttpError(400, 'invalid request: {}'.format(e))
+        return self._stream(execution, reader, chunk)
+
+    async def _stream(self, execution, reader, chunk):
+        """Yields:
+            bytes: the chunks of an execution from the first one a request read, then its error if it failed
+        """
+        try:
+            while chunk is not None:
+                yield chunk
+                chunk = await reader.get()
+            await execution.task
+        finally:
+            execution.close(reader)
+
+    async def _route(self, method, target, body):
+        """Returns:
+            tuple: the status, content type and body of the response
+        """
+        path, _, query = target.partition('?')
+        if path == '/health':
+            return 200, 'text/plain', b'ok'
+        if path == '/stats':
+            stats = dict(self.stats, running=len(self._streams), cached=len(self._cache))
+            return 200, 'application/json', json.dumps(stats).encode()
+        if path not in ('/query', '/explain', '/profile'):
+            raise HttpError(404, 'no such path {}'.format(path))
+        if method != 'POST':
+            raise HttpError(405, '{} only accepts POST'.format(path))
+
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            raise HttpError(400, 'the request body is not JSON')
+        if path == '/explain':
+            try:
+                return 200, 'text/plain', self.api.explain(payload).encode()
+            except (KeyError, ValueError) as e:
+                raise HttpError(400, 'invalid request: {}'.format(e))
+        if path == '/profile':
+            # profiles are never cached or shared, as they measure the request running
+            try:
+                return 200, 'application/json', await asyncio.get_running_loop().run_in_executor(
+                    self.pool, _profile, payload)
+            except (KeyError, ValueError) as e:
+                raise HttpError(400, 'invalid request: {}'.format(e))
+        params = {name: values[-1] for name, values in parse_qs(query).items()}
+        response_format = params.get('format', JSON)
+        if response_format not in CONTENT_TYPES:
+            raise HttpError(400, 'format {} is not supported'.format(response_format))
+        max_rows = params.get('max_rows')
+        if max_rows is not None:
+            if not max_rows.isdigit():
+                raise HttpError(400, 'max_rows must be a non negative integer')
+            max_rows = int(max_rows)
+        body = await self.handle(payload, response_format, max_rows=max_rows, cursor=params.get('cursor'))
+        return 200, CONTENT_TYPES[response_format], body
+
+    async def _serve_connection(self, reader, writer):
+        """Serves the requests of one connection, keeping it open between requests unless asked not to"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                parts = request_line.decode('latin-1').split()
+                chunked = len(parts) == 3 and parts[2] == 'HTTP/1.1'
+                keep_alive = chunked and headers.get('connection', '').lower() != 'close'
+                try:
+                    if len(parts) != 3 or not headers.get('content-length', '0').isdigit():
+                        # the end of a malformed request cannot be found, so the connection is closed after it
+                        keep_alive = False
+                        raise HttpError(400, 'malformed request')
+                    length = int(headers.get('content-length', 0))
+                    if length > MAX_BODY_SIZE:
+                        keep_alive = False
+                        raise HttpError(413, 'the request body is larger than {} bytes'.format(MAX_BODY_SIZE))
+                    body = await reader.readexactly(length)
+                    status, content_type, response = await self._route(parts[0], parts[1], body)
+                    if not chunked:
+                        # an HTTP/1.0 client cannot read chunked transfer encoding
+                        response = await read_body(response)
+                except HttpError as e:
+                    status, content_type, response = e.status, 'text/plain', str(e).encode()
+                except Exception as e:
+                    self.stats['errors'] += 1
+                    status, content_type, response = 500, 'text/plain', repr(e).encode()
+
+                if isinstance(response, bytes):
+                    writer.write(_response(status, content_type, response, keep_alive))
+                    await writer.drain()
+                elif not await self._write_stream(writer, content_type, response, keep_alive):
+                    break
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # a connection still open when the server stops is cancelled, like one the client drops
+            pass
+        finally:
+            writer.close()
+
+    async def _write_stream(self, writer, content_type, chunks, keep_alive):
+        """Writes a response whose body is written a chunk at a time as it arrives, with chunked transfer encoding
+
+        Returns:
+            bool: false if the body could not be finished, which leaves the connection unusable
+        """
+        writer.write(_head(200, content_type, 'Transfer-Encoding: chunked', keep_alive))
+        try:
+            async for chunk in chunks:
+                writer.write('{:x}\r\n'.format(len(chunk)).encode('latin-1') + chunk + b'\r\n')
+                await writer.drain()
+        except ConnectionError:
+            raise
+        except Exception:
+            # the status was already sent, so the client only sees the body cut short
+            self.stats['errors'] += 1
+            return False
+        finally:
+            await chunks.aclose()
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+        return True
+
+    async def start(self, host='127.0.0.1', port=8080):
+        """Starts listening
+
+        Returns:
+            asyncio.Server: the server, whose sockets give the port when it was 0
+        """
+        return await asyncio.start_server(self._serve_connection, host, port)
+
+    def close(self):
+        """Stops the workers once the requests that are running finish"""
+        self.pool.shutdown(wait=True, cancel_futures=True)
+        self._chunks.put(None)
+        self._dispatcher.join()
+
+
+def _head(status, content_type, framing, keep_alive):
+    """Returns:
+        bytes: the status line and headers of a response, whose body is framed by the framing header
+    """
+    headers = [
+        'HTTP/1.1 {} {}'.format(status, STATUS_REASONS.get(status, '')),
+        'Content-Type: {}'.format(content_type),
+        framing,
+        'Connection: {}'.format('keep-alive' if keep_alive else 'close'),
+    ]
+    if status == 503:
+        headers.append('Retry-After: 1')
+    return ('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1')
+
+
+def _response(status, content_type, body, keep_alive):
+    return _head(status, content_type, 'Content-Length: {}'.format(len(body)), keep_alive) + body
+
+
+async def serve(service, host, port):
+    server = await service.start(host, port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serves DatasetAPI requests over HTTP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--columnar', action='store_true', help='load datasets into column oriented storage')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE)
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT)
+    parser.add_argument('--max-pending', type=int, default=DEFAULT_MAX_PENDING)
+    args = parser.parse_args()
+
+    service = DatasetService(DatasetAPI(columnar=args.columnar), workers=args.workers, cache_size=args.cache_size,
+                             timeout=args.timeout, max_pending=args.max_pending)
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
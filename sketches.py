@@ -0,0 +1,278 @@
+"""Approximate aggregations that keep a small, bounded accumulator per group, however many values it sees.
+
+Like the aggregators module's exact aggregations, each is updated one value at a time and merges with another of
+the same kind and parameters, so they can be computed over partitions in parallel and kept per day in a Rollup.
+Missing values (None) are ignored.
+
+    ApproxCountDistinct   HyperLogLog, 2 ** precision one byte registers, a relative standard error of about
+                          1.04 / sqrt(2 ** precision), 1.6% at the default precision
+    ApproxQuantile        a KLL sketch of about 3 * k values, a rank error of roughly 1.7 / k, under 1% at the
+                          default k
+    SampledQuantile       a uniform sample of at most size values, whose quantile comes with a distribution free
+                          confidence interval, see SampledQuantile.rank_error
+
+Values are hashed with blake2b rather than the builtin hash, which differs between processes, so sketches built
+in separate processes, or stored and loaded again, merge correctly. Sketches of the same values give the same
+results whatever order they were merged in only for ApproxCountDistinct, the other two give results within their
+error bounds.
+"""
+import hashlib
+import math
+import random
+
+from aggregators import Aggregator
+
+DEFAULT_PRECISION = 12
+DEFAULT_K = 200
+DEFAULT_SAMPLE_SIZE = 1024
+DEFAULT_CONFIDENCE = 0.95
+LOWER = 'lower'
+UPPER = 'upper'
+
+# the fraction of its level's capacity that each lower level of a KLL sketch can hold
+_CAPACITY_DECAY = 2.0 / 3
+
+
+def hash64(value):
+    """Returns:
+        int: a 64 bit hash of a value that is the same in every process. Floats equal to integers hash like them
+    """
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    data = b's' + value.encode() if isinstance(value, str) else b'r' + repr(value).encode()
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'big')
+
+
+class ApproxCountDistinct(Aggregator):
+    """Estimates the number of distinct values with a HyperLogLog sketch. The first precision bits of each value's
+    hash pick a register, which keeps the largest position of the first set bit among the rest of the bits. Small
+    counts, which leave registers empty, are estimated by linear counting"""
+
+    def __init__(self, precision=DEFAULT_PRECISION):
+        """
+        Args:
+            precision (int): the number of bits that pick a register, from 4 to 16
+        """
+        if not 4 <= precision <= 16:
+            raise ValueError('precision must be from 4 to 16, not {}'.format(precision))
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def new(self):
+        return ApproxCountDistinct(self.precision)
+
+    def update(self, value):
+        if value is not None:
+            hashed = hash64(value)
+            bits = 64 - self.precision
+            index = hashed >> bits
+            rank = bits - (hashed & ((1 << bits) - 1)).bit_length() + 1
+            if rank > self.registers[index]:
+                self.registers[index] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('cannot merge sketches of precision {} and {}'.format(self.precision, other.precision))
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def result(self):
+        m = len(self.registers)
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+        estimate = alpha * m * m / math.fsum(2.0 ** -register for register in self.registers)
+        empty = self.registers.count(0)
+        if estimate <= 2.5 * m and empty:
+            estimate = m * math.log(m / empty)
+        return int(round(estimate))
+
+    def __repr__(self):
+        return 'ApproxCountDistinct(precision={!r})'.format(self.precision)
+
+
+class ApproxQuantile(Aggregator):
+    """Estimates a quantile of the values with a KLL sketch. Values are kept in levels of compactors, where each
+    value of level h stands for 2 ** h values. When the sketch is full, a level at its capacity is sorted and every
+    other value of it is moved up a level. The upper levels hold up to k values and each lower one 2 / 3 as many.
+    The quantile is the first value whose cumulative weight reaches q of the total"""
+
+    def __init__(self, q=0.5, k=DEFAULT_K):
+        """
+        Args:
+            q (float): the quantile, from 0 to 1, e.g. 0.95 for the 95th percentile
+            k (int): the capacity of the top level, which trades memory for accuracy
+        """
+        if not 0 <= q <= 1:
+            raise ValueError('q must be from 0 to 1, not {}'.format(q))
+        if k < 8:
+            raise ValueError('k must be at least 8, not {}'.format(k))
+        self.q = q
+        self.k = k
+        self.count = 0
+        self.compactors = [[]]
+        self._size = 0
+        self._max_size = self._capacity(0)
+        # which of each pair of values is kept alternates, so that neither the smaller nor the larger is favored
+        self._odd = False
+
+    def new(self):
+        return ApproxQuantile(self.q, self.k)
+
+    def _capacity(self, level):
+        depth = len(self.compactors) - level - 1
+        return int(math.ceil(self.k * _CAPACITY_DECAY ** depth)) + 1
+
+    def _grow(self):
+        self.compactors.append([])
+        self._max_size = sum(self._capacity(level) for level in range(len(self.compactors)))
+
+    def _compress(self):
+        while self._size >= self._max_size:
+            for level, compactor in enumerate(self.compactors):
+                if len(compactor) >= self._capacity(level):
+                    if level + 1 == len(self.compactors):
+                        self._grow()
+                    compactor.sort()
+                    # an odd value out stays behind
+                    kept = compactor[:len(compactor) % 2]
+                    promoted = compactor[len(kept) + self._odd::2]
+                    self._odd = not self._odd
+                    self.compactors[level] = kept
+                    self.compactors[level + 1].extend(promoted)
+                    self._size += len(kept) + len(promoted) - len(compactor)
+                    break
+
+    def update(self, value):
+        if value is not None:
+            self.compactors[0].append(value)
+            self.count += 1
+            self._size += 1
+            if self._size >= self._max_size:
+                self._compress()
+
+    def merge(self, other):
+        if other.k != self.k:
+            raise ValueError('cannot merge sketches with k {} and {}'.format(self.k, other.k))
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+        for compactor, values in zip(self.compactors, other.compactors):
+            compactor.extend(values)
+        self.count += other.count
+        self._size += other._size
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        """Returns:
+            the estimated q-th quantile of the values, None if there are none
+        """
+        weighted = sorted((value, 1 << level) for level, compactor in enumerate(self.compactors)
+                          for value in compactor)
+        if not weighted:
+            return None
+        target = q * sum(weight for _, weight in weighted)
+        cumulative = 0
+        for value, weight in weighted:
+            cumulative += weight
+            if cumulative >= target:
+                return value
+        return weighted[-1][0]
+
+    def result(self):
+        return self.quantile(self.q)
+
+    def __repr__(self):
+        return 'ApproxQuantile(q={!r}, k={!r})'.format(self.q, self.k)
+
+
+class SampledQuantile(Aggregator):
+    """A quantile of a uniform random sample of the values, kept by reservoir sampling. Merging draws a uniform
+    sample of both accumulators' values, taking from each in proportion to the number of values it has seen.
+
+    By the Dvoretzky-Kiefer-Wolfowitz inequality, the true q-th quantile lies between the sample's quantiles at
+    q - rank_error and q + rank_error with the given confidence. With a bound, the result is that end of the
+    interval rather than the estimate, so an aggregation can output the estimate and both bounds as three columns.
+    The result is exact while every value fits in the sample"""
+
+    def __init__(self, q=0.5, size=DEFAULT_SAMPLE_SIZE, bound=None, confidence=DEFAULT_CONFIDENCE, seed=0):
+        """
+        Args:
+            q (float): the quantile, from 0 to 1
+            size (int): the most values sampled
+            bound (str): None for the estimate, or 'lower' or 'upper' for that end of its confidence interval
+            confidence (float): the probability that the interval holds the true quantile
+            seed (int): the seed of the sampling, so that the same values in the same order give the same sample
+        """
+        if not 0 <= q <= 1:
+            raise ValueError('q must be from 0 to 1, not {}'.format(q))
+        if size < 1:
+            raise ValueError('size must be at least 1, not {}'.format(size))
+        if bound not in (None, LOWER, UPPER):
+            raise ValueError('bound must be None, {!r} or {!r}, not {!r}'.format(LOWER, UPPER, bound))
+        if not 0 < confidence < 1:
+            raise ValueError('confidence must be between 0 and 1, not {}'.format(confidence))
+        self.q = q
+        self.size = size
+        self.bound = bound
+        self.confidence = confidence
+        self.seed = seed
+        self.count = 0
+        self.sample = []
+        self._random = random.Random(seed)
+
+    def new(self):
+        return SampledQuantile(self.q, self.size, self.bound, self.confidence, self.seed)
+
+    def update(self, value):
+        if value is not None:
+            self.count += 1
+            if len(self.sample) < self.size:
+                self.sample.append(value)
+            else:
+                i = self._random.randrange(self.count)
+                if i < self.size:
+                    self.sample[i] = value
+
+    def merge(self, other):
+        if other.size != self.size:
+            raise ValueError('cannot merge samples of size {} and {}'.format(self.size, other.size))
+        if self.count + other.count <= self.size:
+            self.sample.extend(other.sample)
+        else:
+            mine = self._random.sample(self.sample, len(self.sample))
+            theirs = self._random.sample(other.sample, len(other.sample))
+            remaining, other_remaining = self.count, other.count
+            taken = other_taken = 0
+            for _ in range(self.size):
+                if self._random.random() * (remaining + other_remaining) < remaining:
+                    taken += 1
+                    remaining -= 1
+                else:
+                    other_taken += 1
+                    other_remaining -= 1
+            self.sample = mine[:taken] + theirs[:other_taken]
+        self.count += other.count
+        return self
+
+    def rank_error(self):
+        """Returns:
+            float: how far from q, as a fraction of the values, the quantile of the sample may be at the confidence
+        """
+        if len(self.sample) >= self.count:
+            return 0.0
+        return math.sqrt(math.log(2 / (1 - self.confidence)) / (2 * len(self.sample)))
+
+    def result(self):
+        if not self.sample:
+            return None
+        q = self.q
+        if self.bound == LOWER:
+            q = max(q - self.rank_error(), 0.0)
+        elif self.bound == UPPER:
+            q = min(q + self.rank_error(), 1.0)
+        values = sorted(self.sample)
+        # the nearest rank quantile
+        return values[min(max(int(math.ceil(q * len(values))) - 1, 0), len(values) - 1)]
+
+    def __repr__(self):
+        return 'SampledQuantile(q={!r}, size={!r}, bound={!r}, confidence={!r}, seed={!r})'.format(
+            self.q, self.size, self.bound, self.confidence, self.seed)
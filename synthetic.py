@@ -0,0 +1,191 @@
+"""A deterministic generator of synthetic ad, keyword and product reports, for benchmarks.
+
+The reports have the columns of the files in data/ and test/. Each ad report row gets an asin and a keyword drawn
+from a Zipf-like distribution: the i-th most common value is drawn with weight 1 / i ** skew, so a skew of 0 draws
+uniformly and larger skews concentrate the rows on fewer values. Rows are spread evenly over the days of the date
+span, in descending date order like the real reports.
+
+Rows are generated and written a block at a time, so reports of 1e8 rows take no more memory than small ones, and
+the same arguments always write the same bytes.
+
+    python synthetic.py --rows 1000000 --asins 10000 --skew 1.1 data/synthetic
+"""
+import argparse
+import csv
+import os
+import random
+import string
+from datetime import date, timedelta
+from itertools import accumulate
+
+AD_REPORT = 'ad_report.csv'
+KEYWORD_REPORT = 'keyword_report.csv'
+PRODUCT_REPORT = 'product_report.csv'
+
+# rows generated at a time
+BLOCK_SIZE = 10000
+ID_LENGTH = 10
+AD_GROUP_ID_LENGTH = 20
+
+_COLOURS = ('Red', 'Green', 'Blue', 'Aqua', 'Black', 'White', 'Yellow', 'Purple')
+_ADJECTIVES = ('New', 'Old', 'Big', 'Small', 'Huge', 'Tiny', 'Bad', 'Good')
+_PRODUCTS = ('Eraser', 'Marker', 'Pencil', 'Pen', 'Notebook', 'Ruler', 'Stapler', 'Crayon')
+
+
+class SyntheticReports(object):
+    """The settings of a set of synthetic reports, see the module docstring"""
+
+    def __init__(self, rows=10000, asins=1000, keywords=5000, ad_groups=500, days=365, end_date=date(2017, 6, 19),
+                 skew=1.0, seed=0):
+        """
+        Args:
+            rows (int): the number of rows of the ad report
+            asins (int): the number of products
+            keywords (int): the number of keywords
+            ad_groups (int): the number of ad groups the keywords belong to
+            days (int): the number of days the ad report spans
+            end_date (date or str): the last day of the ad report
+            skew (float): the Zipf exponent asins and keywords are drawn with, 0 for uniform draws
+            seed (int): the seed of the random numbers
+        """
+        if min(asins, keywords, ad_groups, days) < 1:
+            raise ValueError('asins, keywords, ad_groups and days must be at least 1')
+        if rows < 0 or skew < 0:
+            raise ValueError('rows and skew must not be negative')
+        self.rows = rows
+        self.asins = asins
+        self.keywords = keywords
+        self.ad_groups = ad_groups
+        self.days = days
+        self.end_date = date.fromisoformat(end_date) if isinstance(end_date, str) else end_date
+        self.skew = skew
+        self.seed = seed
+
+    def config(self):
+        """Returns:
+            dict: the settings, as JSON compatible values
+        """
+        return {
+            'rows': self.rows,
+            'asins': self.asins,
+            'keywords': self.keywords,
+            'ad_groups': self.ad_groups,
+            'days': self.days,
+            'end_date': self.end_date.isoformat(),
+            'skew': self.skew,
+            'seed': self.seed,
+        }
+
+    def _random(self, stream):
+        # each report has its own stream of random numbers, so changing one setting leaves the others' values alone
+        return random.Random('{}-{}'.format(self.seed, stream))
+
+    @staticmethod
+    def _ids(rng, n, length):
+        ids, seen = [], set()
+        while len(ids) < n:
+            value = ''.join(rng.choices(string.ascii_uppercase + string.digits, k=length))
+            if value not in seen:
+                seen.add(value)
+                ids.append(value)
+        return ids
+
+    def asin_ids(self):
+        """Returns:
+            list of str: the asins, most commonly drawn first
+        """
+        return self._ids(self._random('asins'), self.asins, ID_LENGTH)
+
+    def keyword_ids(self):
+        """Returns:
+            list of str: the keyword ids, most commonly drawn first
+        """
+        return self._ids(self._random('keywords'), self.keywords, ID_LENGTH)
+
+    def _cum_weights(self, n):
+        return list(accumulate(1.0 / (i + 1) ** self.skew for i in range(n)))
+
+    def ad_report_rows(self):
+        """Yields:
+            list: the next row of the ad report, with the columns date, impressions, clicks, sales, ad_spend,
+                keyword_id and asin
+        """
+        rng = self._random('ad_report')
+        asins, asin_weights = self.asin_ids(), self._cum_weights(self.asins)
+        keywords, keyword_weights = self.keyword_ids(), self._cum_weights(self.keywords)
+        first_day = self.end_date - timedelta(days=self.days - 1)
+        for start in range(0, self.rows, BLOCK_SIZE):
+            n = min(BLOCK_SIZE, self.rows - start)
+            block_asins = rng.choices(asins, cum_weights=asin_weights, k=n)
+            block_keywords = rng.choices(keywords, cum_weights=keyword_weights, k=n)
+            for i in range(n):
+                # rows are spread evenly over the days, latest first
+                day = first_day + timedelta(days=self.days - 1 - (start + i) * self.days // self.rows)
+                impressions = rng.randint(0, 10000)
+                clicks = rng.randint(0, impressions // 2)
+                sales = rng.randint(0, clicks)
+                ad_spend = '{:.2f}'.format(clicks * rng.uniform(0.01, 0.5))
+                yield [day.isoformat(), impressions, clicks, sales, ad_spend, block_keywords[i], block_asins[i]]
+
+    def keyword_report_rows(self):
+        """Yields:
+            list: the next row of the keyword report, with the columns ad_group, keyword_id and keyword
+        """
+        rng = self._random('keyword_report')
+        ad_groups = self._ids(rng, self.ad_groups, AD_GROUP_ID_LENGTH)
+        for keyword_id in self.keyword_ids():
+            keyword = ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 12)))
+            yield [rng.choice(ad_groups), keyword_id, keyword]
+
+    def product_report_rows(self):
+        """Yields:
+            list: the next row of the product report, with the columns asin and name
+        """
+        rng = self._random('product_report')
+        for asin in self.asin_ids():
+            yield [asin, ' '.join(rng.choice(words) for words in (_COLOURS, _ADJECTIVES, _ADJECTIVES, _PRODUCTS))]
+
+    def write(self, directory):
+        """Writes the reports to a directory, creating it if needed
+
+        Args:
+            directory (str): the directory to write to
+
+        Returns:
+            dict of str, str: the path of each report, by the name of its dataset
+        """
+        os.makedirs(directory, exist_ok=True)
+        reports = (
+            (AD_REPORT, ['date', 'impressions', 'clicks', 'sales', 'ad_spend', 'keyword_id', 'asin'],
+             self.ad_report_rows()),
+            (KEYWORD_REPORT, ['ad_group', 'keyword_id', 'keyword'], self.keyword_report_rows()),
+            (PRODUCT_REPORT, ['asin', 'name'], self.product_report_rows()),
+        )
+        paths = {}
+        for file_name, header, rows in reports:
+            path = os.path.join(directory, file_name)
+            with open(path, 'w', newline='') as csv_file:
+                writer = csv.writer(csv_file, lineterminator='\n')
+                writer.writerow(header)
+                writer.writerows(rows)
+            paths[os.path.splitext(file_name)[0]] = path
+        return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes synthetic ad, keyword and product reports')
+    parser.add_argument('directory', help='the directory to write the reports to')
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--asins', type=int, default=1000)
+    parser.add_argument('--keywords', type=int, default=5000)
+    parser.add_argument('--ad-groups', type=int, default=500)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--end-date', type=date.fromisoformat, default=date(2017, 6, 19))
+    parser.add_argument('--skew', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    reports = SyntheticReports(rows=args.rows, asins=args.asins, keywords=args.keywords, ad_groups=args.ad_groups,
+                               days=args.days, end_date=args.end_date, skew=args.skew, seed=args.seed)
+    for path in reports.write(args.directory).values():
+        print(path)
@@ -1,5 +1,39 @@
+import asyncio
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+from bisect import bisect_left
+from datetime import date
+from operator import itemgetter
 from unittest import TestCase
+from urllib.request import urlopen
 from dataset import Dataset
+from aggregators import Count, CountDistinct, First, Last, Max, Mean, Min, Ratio, Sum, Variance
+from columnar import ColumnarDataset, DictionaryColumn, NumericColumn, build_column
+from api import DatasetAPI
+from cache import DatasetCache
+from registry import DatasetRegistry
+from reader import CsvReader, byte_ranges
+from schema import Schema
+from plan import Aggregate, Derive, ExecutionContext, Filter, Join, Limit, Scan, Sort, optimize
+from external import external_join, external_sort, merge_join, sort_csv
+from joins import is_sorted, join_indices
+from parallel import ParallelExecutor
+from partitioned import MONTH, PartitionedReader, PartitionedStore
+from rollups import Rollup
+from serialization import read_binary
+from synthetic import SyntheticReports
+from benchmark import WORKLOADS, compare, run, summarize
+from profiling import PrometheusExporter
+from batch import SharedScan, result_key, shared_scans
+from sketches import LOWER, UPPER, ApproxCountDistinct, ApproxQuantile, SampledQuantile
+from service import DatasetService, HttpError, read_body
+from loadtest import percentile, run_with_service
+from expressions import Conditional, Field, metric, parse_expression
+from predicates import Between, Comparison, In, IsNull, NotNull, parse_predicate
 
 
 class Tests(TestCase):
@@ -156,3 +190,1640 @@ class Tests(TestCase):
 
         self.assertListEqual(actual.columns, expected_columns)
         self.assertListEqual(actual.data, expected_data)
+
+
+class ColumnarTests(TestCase):
+    def setUp(self):
+        self.rows = Dataset('test').populate('ad_report_test.csv')
+        self.dataset = ColumnarDataset('test').populate('ad_report_test.csv')
+
+    def test_populate(self):
+        self.assertListEqual(self.dataset.columns, self.rows.columns)
+        self.assertListEqual(self.dataset.data, self.rows.data)
+        self.assertIsInstance(self.dataset.get_column_data('clicks'), NumericColumn)
+        self.assertIsInstance(self.dataset.get_column_data('asin'), DictionaryColumn)
+        self.assertListEqual(self.dataset.get_column_data('asin').dictionary, ['ASIN1', 'ASIN2'])
+
+    def test_filter(self):
+        actual = self.dataset.between_filter('date', '2017-06-08', '2017-06-15')
+        expected = self.rows.between_filter('date', '2017-06-08', '2017-06-15')
+
+        self.assertIsInstance(actual, ColumnarDataset)
+        self.assertListEqual(actual.data, expected.data)
+
+    def test_group_by_and_aggregate(self):
+        actual = self.dataset.group_by_and_aggregate(('keyword_id', 'asin'), 'clicks', max)
+        expected = self.rows.group_by_and_aggregate(('keyword_id', 'asin'), 'clicks', max)
+
+        self.assertListEqual(actual.columns, expected.columns)
+        self.assertListEqual(actual.data, expected.data)
+
+    def test_sort_by_and_limit(self):
+        for column_name in ('sales', 'asin'):
+            for reverse in (False, True):
+                actual = self.dataset.sort_by(column_name, reverse=reverse).limit(5)
+                expected = self.rows.sort_by(column_name, reverse=reverse).limit(5)
+                self.assertListEqual(actual.data, expected.data)
+
+    def test_inner_join(self):
+        other_dataset = Dataset(
+            'other_dc',
+            columns=['keyword_id', 'name'],
+            data=[
+                ('KEYWORDID1', 'a keyword'),
+                ('KEYWORDID1', 'another keyword'),
+                ('KEYWORDID3', 'another similar keyword')
+            ]
+        )
+
+        actual = self.dataset.inner_join(other_dataset, 'keyword_id')
+        expected = self.rows.inner_join(other_dataset, 'keyword_id')
+
+        self.assertListEqual(actual.columns, expected.columns)
+        self.assertListEqual(actual.data, expected.data)
+
+    def test_ints_outside_int64(self):
+        values = [1, 2 ** 63, -2 ** 70, 3]
+        self.assertListEqual(build_column(values).to_list(), values)
+        self.assertListEqual(build_column([2 ** 64, 1]).to_list(), [2 ** 64, 1])
+
+        dataset = ColumnarDataset.from_rows('big', ['id', 'clicks'], [(2 ** 63, 1), (1, 2)])
+        self.assertListEqual(dataset.data, [(2 ** 63, 1), (1, 2)])
+
+
+class PredicateTests(TestCase):
+    def setUp(self):
+        self.rows = Dataset('test').populate('ad_report_test.csv')
+        self.columnar = self.rows.to_columnar()
+
+    def assertWhere(self, predicate, expected):
+        self.assertListEqual(self.rows.where(predicate).data, expected)
+        self.assertListEqual(self.columnar.where(predicate).data, expected)
+
+    def test_between(self):
+        expected = self.rows.filter('date', lambda x: '2017-06-08' < x < '2017-06-12').data
+        self.assertEqual(len(expected), 3)
+        self.assertWhere(Between('date', '2017-06-08', '2017-06-12'), expected)
+
+        expected = self.rows.filter('clicks', lambda x: 113 <= x <= 3237).data
+        self.assertWhere(Between('clicks', 113, 3237, inclusive=True), expected)
+
+    def test_combinators(self):
+        predicate = (Comparison('asin', '==', 'ASIN1') & ~In('keyword_id', ['KEYWORDID2'])) | \
+            Comparison('ad_spend', '>', 68)
+        expected = [
+            row for row in self.rows.data
+            if (row[6] == 'ASIN1' and row[5] != 'KEYWORDID2') or row[4] > 68
+        ]
+        self.assertWhere(predicate, expected)
+
+    def test_nulls(self):
+        rows = Dataset('nulls', columns=['a'], data=[(1.0,), (None,), ('',), (3.0,)])
+        self.assertListEqual(rows.where(IsNull('a')).data, [(None,), ('',)])
+        self.assertListEqual(rows.where(NotNull('a')).data, [(1.0,), (3.0,)])
+        self.assertListEqual(rows.where(Comparison('a', '==', None)).data, [(None,)])
+
+    def test_parse_predicate(self):
+        predicate = parse_predicate({
+            'op': 'and',
+            'predicates': [
+                {'op': 'between', 'column_name': 'date', 'start': '2017-06-08', 'end': '2017-06-15'},
+                {'op': 'not', 'predicate': {'op': '==', 'column_name': 'clicks', 'value': 0}}
+            ]
+        })
+        expected = self.rows.between_filter('date', '2017-06-08', '2017-06-15').filter('clicks', lambda x: x != 0)
+        self.assertWhere(predicate, expected.data)
+
+    def test_unknown_column(self):
+        self.assertRaises(ValueError, self.rows.where, Comparison('foo', '==', 1))
+        self.assertRaises(ValueError, self.columnar.where, Comparison('foo', '==', 1))
+
+
+class ReaderTests(TestCase):
+    def test_chunks(self):
+        chunks = list(CsvReader('ad_report_test.csv', chunk_size=5))
+
+        self.assertListEqual([len(chunk) for chunk in chunks], [5, 5, 4])
+        self.assertListEqual(sum(chunks, []), Dataset('test').populate('ad_report_test.csv').data)
+
+    def test_projection_and_predicate(self):
+        reader = CsvReader('ad_report_test.csv', columns=['asin', 'sales'], predicate=Comparison('clicks', '>', 3000))
+
+        self.assertListEqual(reader.columns, ['asin', 'sales'])
+        self.assertListEqual(sum(list(reader), []), [('ASIN1', 1233.0), ('ASIN1', 4635.0), ('ASIN1', 2169.0)])
+
+    def test_limit(self):
+        dataset = Dataset('test').populate('ad_report_test.csv', limit=2, predicate=Comparison('clicks', '==', 0))
+        self.assertListEqual(dataset.data, [
+            ('2017-06-17', 0.0, 0.0, 0.0, 21.77, 'KEYWORDID1', 'ASIN2'),
+            ('2017-06-16', 0.0, 0.0, 0.0, 68.99, 'KEYWORDID1', 'ASIN2')
+        ])
+
+    def test_unknown_column(self):
+        self.assertRaises(ValueError, CsvReader, 'ad_report_test.csv', columns=['foo'])
+
+
+def best_selling_item_payload():
+    """The best selling item query over the test csvs"""
+    return {
+        'datasets': {
+            'ad_report': 'ad_report_test.csv',
+            'product_report': 'product_report_test.csv'
+        },
+        'operations': [
+            {
+                'dataset': 'ad_report',
+                'operation_name': 'between_filter',
+                'operation_args': {'column_name': 'date', 'start': '2017-06-06', 'end': '2017-06-17'}
+            },
+            {
+                'dataset': 'ad_report',
+                'operation_name': 'group_by_and_aggregate',
+                'operation_args': {'group_by_columns': ['asin'], 'aggregate_column': 'sales', 'aggregation': 'sum'}
+            },
+            {
+                'dataset': 'ad_report',
+                'operation_name': 'sort_by_desc',
+                'operation_args': {'column_name': 'sales'}
+            },
+            {
+                'dataset': 'ad_report',
+                'operation_name': 'limit',
+                'operation_args': {'value': 1}
+            },
+            {
+                'dataset': 'ad_report',
+                'operation_name': 'inner_join',
+                'operation_args': {'column_name': 'asin', 'other_dataset': 'product_report'}
+            }
+        ],
+        'return': ['ad_report']
+    }
+
+
+BEST_SELLING_ITEM_RESULT = {
+    'ad_report': {
+        'columns': ['asin', 'sales', 'name'],
+        'data': [('ASIN1', 9798.0, 'Green New Bad Eraser')]
+    }
+}
+
+
+class APITests(TestCase):
+    def setUp(self):
+        self.payload = best_selling_item_payload()
+        self.expected = BEST_SELLING_ITEM_RESULT
+
+    def test_handle_request(self):
+        self.assertDictEqual(DatasetAPI().handle_request(self.payload), self.expected)
+        self.assertDictEqual(DatasetAPI(columnar=True).handle_request(self.payload), self.expected)
+
+    def test_explain(self):
+        self.assertEqual(DatasetAPI().explain(self.payload), '\n'.join([
+            'ad_report:',
+            '  InnerJoin on asin',
+            '    TopN 1 by [sales] desc',
+            '      Aggregate by [asin]: sales = Sum() of sales',
+            "        Scan ad_report (ad_report_test.csv) columns=[sales, asin] where '2017-06-06' < date < '2017-06-17'",
+            '    Scan product_report (product_report_test.csv)',
+        ]))
+
+
+class SchemaTests(TestCase):
+    def test_infer(self):
+        dataset = Dataset('test').populate('ad_report_test.csv', schema='infer')
+
+        self.assertDictEqual(dataset.schema.types, {
+            'date': 'date',
+            'impressions': 'int64',
+            'clicks': 'int64',
+            'sales': 'int64',
+            'ad_spend': 'float64',
+            'keyword_id': 'categorical',
+            'asin': 'categorical'
+        })
+        self.assertTupleEqual(dataset.data[0], (date(2017, 6, 19), 4451, 1006, 608, 24.87, 'KEYWORDID1', 'ASIN1'))
+        self.assertIs(type(dataset.data[0][1]), int)
+
+    def test_default_schema(self):
+        dataset = Dataset('test').populate('ad_report_test.csv')
+
+        self.assertEqual(dataset.schema.get('date'), 'string')
+        self.assertEqual(dataset.schema.get('clicks'), 'float64')
+
+    def test_explicit_schema(self):
+        dataset = Dataset('test').populate('ad_report_test.csv', schema={'clicks': 'string', 'date': 'date'})
+
+        self.assertTupleEqual(dataset.data[0], (date(2017, 6, 19), 4451.0, '1006', 608.0, 24.87, 'KEYWORDID1', 'ASIN1'))
+        self.assertRaises(ValueError, Dataset('test').populate, 'ad_report_test.csv', schema={'asin': 'int64'})
+        self.assertRaises(ValueError, Schema, {'asin': 'decimal'})
+
+    def test_date_filter(self):
+        expected = Dataset('test').populate('ad_report_test.csv').between_filter('date', '2017-06-08', '2017-06-12')
+
+        for dataset in (Dataset('test'), ColumnarDataset('test')):
+            dataset.populate('ad_report_test.csv', schema='infer')
+            actual = dataset.between_filter('date', '2017-06-08', '2017-06-12')
+            self.assertListEqual([row[0].isoformat() for row in actual.data], [row[0] for row in expected.data])
+
+            pushed = type(dataset)('test').populate(
+                'ad_report_test.csv', schema='infer', predicate=Between('date', '2017-06-08', '2017-06-12')
+            )
+            self.assertListEqual(pushed.data, actual.data)
+
+    def test_missing_cells(self):
+        schema = Schema.infer(['a', 'b'], [['1', 'x'], ['', 'y'], ['00', 'z']])
+        self.assertEqual(schema.get('a'), 'string')
+
+        schema = Schema({'a': 'int64', 'b': 'string'})
+        parse_row = schema.row_parser(['a', 'b'], ['b', 'a'])
+        self.assertTupleEqual(parse_row(['', 'y']), ('y', None))
+
+    def test_default_parsing_matches_float_or_string(self):
+        # the first rows infer a as float64 and b as string, which later rows do not fit
+        rows = [['1', 'x']] * 1500 + [['', '2.5'], ['n/a', ''], ['3', ' 4'], ['4', 'inf']]
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as csv_file:
+            csv_file.write('a,b\n' + ''.join('{},{}\n'.format(*row) for row in rows))
+        try:
+            for dataset_class in (Dataset, ColumnarDataset):
+                dataset = dataset_class('test').populate(csv_file.name)
+                self.assertListEqual(dataset.data[-4:], [('', 2.5), ('n/a', ''), (3.0, 4.0), (4.0, float('inf'))])
+                self.assertListEqual(dataset.data, [Dataset('test')._parse_row(row) for row in rows])
+
+            dataset = Dataset('test').populate(csv_file.name, schema='infer')
+            self.assertTupleEqual(dataset.data[-4], (None, '2.5'))
+        finally:
+            os.remove(csv_file.name)
+
+
+class CacheTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.directory, 'ad_report.csv')
+        shutil.copy('ad_report_test.csv', self.csv_path)
+        self.cache = DatasetCache(os.path.join(self.directory, 'cache'))
+        self.expected = Dataset('test').populate('ad_report_test.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_load(self):
+        first = self.cache.load(self.csv_path, schema='infer')
+        second = self.cache.load(self.csv_path, schema='infer')
+
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertListEqual(second.data, first.data)
+        self.assertEqual(second.schema, first.schema)
+        self.assertEqual(second.data[0][0], date(2017, 6, 19))
+        # numeric columns are read straight from the mapped file
+        self.assertIsInstance(second.get_column_data('clicks').values, memoryview)
+
+        self.assertListEqual(self.cache.load(self.csv_path).data, self.expected.data)
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_invalidation(self):
+        self.cache.load(self.csv_path)
+
+        # touching the file without changing it keeps the cache file
+        stat = os.stat(self.csv_path)
+        os.utime(self.csv_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.cache.load(self.csv_path)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+        with open(self.csv_path, 'a') as csv_file:
+            csv_file.write('\n2017-06-05,1,2,3,4.5,KEYWORDID3,ASIN3')
+        dataset = self.cache.load(self.csv_path)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+        self.assertEqual(len(dataset), 15)
+
+    def test_eviction(self):
+        other_path = os.path.join(self.directory, 'other.csv')
+        shutil.copy('product_report_test.csv', other_path)
+        self.cache.load(self.csv_path)
+        self.cache.max_bytes = os.path.getsize(self.cache.cache_path(self.csv_path))
+
+        self.cache.load(other_path)
+
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertFalse(os.path.exists(self.cache.cache_path(self.csv_path)))
+        self.assertTrue(os.path.exists(self.cache.cache_path(other_path)))
+
+    def test_api(self):
+        api = DatasetAPI(cache=self.cache)
+
+        self.assertDictEqual(api.handle_request(best_selling_item_payload()), BEST_SELLING_ITEM_RESULT)
+        self.assertDictEqual(api.handle_request(best_selling_item_payload()), BEST_SELLING_ITEM_RESULT)
+        self.assertEqual(self.cache.hits, 2)
+
+
+class RegistryTests(TestCase):
+    def setUp(self):
+        self.registry = DatasetRegistry()
+
+    def test_shared(self):
+        first = self.registry.acquire('ad_report_test.csv', name='first')
+        second = self.registry.acquire('ad_report_test.csv', name='second')
+
+        self.assertEqual((first.name, second.name), ('first', 'second'))
+        self.assertIs(first.column_data[0], second.column_data[0])
+        self.assertDictEqual(self.registry.stats(), {
+            'hits': 1, 'misses': 1, 'evictions': 0, 'entries': 1, 'in_use': 1,
+            'bytes': first.memory_usage(), 'memory_budget': None
+        })
+
+        self.registry.release(first)
+        self.registry.release(second)
+        self.assertRaises(ValueError, self.registry.release, second)
+
+    def test_read_only(self):
+        with self.registry.borrow('ad_report_test.csv') as dataset:
+            self.assertRaises(ValueError, dataset.populate, 'ad_report_test.csv')
+            self.assertRaises(TypeError, dataset.get_column_data('clicks').values.__setitem__, 0, 1.0)
+
+            derived = dataset.sort_by('clicks').limit(3)
+            copy = dataset.copy()
+            copy.populate('product_report_test.csv')
+
+        with self.registry.borrow('ad_report_test.csv') as dataset:
+            self.assertListEqual(dataset.data, Dataset('test').populate('ad_report_test.csv').data)
+        self.assertListEqual([row[2] for row in derived.data], [0.0, 0.0, 0.0])
+
+    def test_eviction(self):
+        self.registry.memory_budget = 0
+
+        with self.registry.borrow('ad_report_test.csv'):
+            with self.registry.borrow('product_report_test.csv'):
+                self.assertEqual(self.registry.stats()['entries'], 2)
+
+        stats = self.registry.stats()
+        self.assertEqual((stats['entries'], stats['evictions'], stats['bytes']), (0, 2, 0))
+
+    def test_api(self):
+        api = DatasetAPI(registry=self.registry)
+
+        self.assertDictEqual(api.handle_request(best_selling_item_payload()), BEST_SELLING_ITEM_RESULT)
+        self.assertDictEqual(api.handle_request(best_selling_item_payload()), BEST_SELLING_ITEM_RESULT)
+        stats = self.registry.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['in_use']), (2, 2, 0))
+
+
+class AggregatorTests(TestCase):
+    def setUp(self):
+        self.dataset = Dataset('test').populate('ad_report_test.csv')
+
+    def test_exact_sum(self):
+        values = [0.1] * 1000 + [1e16, 1.0, -1e16]
+        total = Sum()
+        for value in values:
+            total.update(value)
+
+        left, right = Sum(), Sum()
+        for value in values[:500]:
+            right.update(value)
+        for value in reversed(values[500:]):
+            left.update(value)
+        self.assertEqual(total.result(), math.fsum(values))
+        self.assertEqual(left.merge(right).result(), total.result())
+
+    def test_aggregate(self):
+        aggregations = [('sales', Sum), ('ad_spend', Sum()), ('clicks', Mean(), 'average_clicks')]
+        expected = {}
+        for asin, rows in self.dataset._partition(['asin']).items():
+            expected[asin[0]] = (
+                math.fsum(row[3] for row in rows),
+                math.fsum(row[4] for row in rows),
+                sum(row[2] for row in rows) / len(rows)
+            )
+
+        for dataset in (self.dataset, self.dataset.to_columnar()):
+            result = dataset.aggregate(['asin'], aggregations)
+            self.assertListEqual(result.columns, ['asin', 'sales', 'ad_spend', 'average_clicks'])
+            self.assertDictEqual({row[0]: row[1:] for row in result.data}, expected)
+
+        self.assertRaises(ValueError, self.dataset.aggregate, ['asin'], [('sales', Sum), ('sales', Max)])
+
+    def test_group_by_and_aggregate(self):
+        for dataset in (self.dataset, self.dataset.to_columnar()):
+            by_function = dataset.group_by_and_aggregate(['asin'], 'clicks', max)
+            by_aggregator = dataset.group_by_and_aggregate(['asin'], 'clicks', Max)
+            self.assertListEqual(by_function.data, by_aggregator.data)
+
+            result = dataset.group_by_and_aggregate([], 'keyword_id', CountDistinct)
+            self.assertListEqual(result.data, [(2,)])
+
+    def test_aggregators(self):
+        values = [4.0, None, 2.0, 6.0]
+        for prototype, expected in ((Count(), 3), (Mean(), 4.0), (Variance(), 4.0),
+                                    (Variance(sample=False), 8 / 3), (First(), 4.0), (Last(), 6.0)):
+            accumulator = prototype.new()
+            for value in values[:2]:
+                accumulator.update(value)
+            other = prototype.new()
+            for value in values[2:]:
+                other.update(value)
+            self.assertAlmostEqual(accumulator.merge(other).result(), expected)
+
+    def test_api(self):
+        payload = best_selling_item_payload()
+        payload['operations'][1] = {
+            'dataset': 'ad_report',
+            'operation_name': 'aggregate',
+            'operation_args': {
+                'group_by_columns': ['asin'],
+                'aggregations': [
+                    {'column': 'sales', 'aggregation': 'sum'},
+                    {'column': 'clicks', 'aggregation': 'count', 'output_column': 'days'}
+                ]
+            }
+        }
+        expected = {
+            'ad_report': {
+                'columns': ['asin', 'sales', 'days', 'name'],
+                'data': [('ASIN1', 9798.0, 8, 'Green New Bad Eraser')]
+            }
+        }
+        self.assertDictEqual(DatasetAPI().handle_request(payload), expected)
+        self.assertDictEqual(DatasetAPI(columnar=True).handle_request(payload), expected)
+
+
+class ExpressionTests(TestCase):
+    def setUp(self):
+        self.dataset = Dataset('test').populate('ad_report_test.csv')
+
+    def test_derive(self):
+        expression = Conditional(Comparison('clicks', '>', 0), Field('ad_spend') / Field('clicks'), 0.0)
+        expected = [(row[4] / row[2] if row[2] > 0 else 0.0) for row in self.dataset.data]
+
+        for dataset in (self.dataset, self.dataset.to_columnar()):
+            result = dataset.derive('cpc', expression)
+            self.assertListEqual(result.columns, self.dataset.columns + ['cpc'])
+            self.assertListEqual([row[-1] for row in result.data], expected)
+            self.assertListEqual(result.data, dataset.derive('cpc', expression).data)
+            self.assertRaises(ValueError, dataset.derive, 'sales', Field('sales') * 2)
+            self.assertRaises(ValueError, dataset.derive, 'margin', Field('sales') - Field('cost'))
+
+    def test_safe_arithmetic(self):
+        dataset = Dataset('test', columns=['a', 'b'], data=[(1.0, 2.0), (1.0, 0.0), (None, 2.0)])
+        expression = (Field('a') + 1) / Field('b')
+        self.assertEqual(repr(expression), '((a + 1) / b)')
+
+        for dataset in (dataset, dataset.to_columnar()):
+            self.assertListEqual([row[-1] for row in dataset.derive('c', expression).data], [1.0, None, None])
+
+    def test_filter_group_and_sort(self):
+        for dataset in (self.dataset, self.dataset.to_columnar()):
+            result = dataset.derive('acos', metric('acos')).where(Comparison('acos', '<', 0.1))
+            self.assertTrue(all(row[-1] < 0.1 for row in result.data))
+
+            result = result.derive('profitable', Conditional(Comparison('acos', '<', 0.05), 'yes', 'no'))
+            result = result.group_by_and_aggregate(['profitable'], 'sales', Sum).sort_by('sales', reverse=True)
+            self.assertListEqual(result.columns, ['profitable', 'sales'])
+            self.assertEqual(len(result.data), 2)
+
+    def test_ratio_of_sums(self):
+        for dataset in (self.dataset, self.dataset.to_columnar()):
+            result = dataset.aggregate(['asin'], [(['ad_spend', 'sales'], Ratio(), 'acos')])
+            for asin, acos in result.data:
+                rows = dataset.equals_filter('asin', asin).data
+                sales = sum(row[3] for row in rows)
+                if sales:
+                    self.assertAlmostEqual(acos, sum(row[4] for row in rows) / sales)
+                else:
+                    self.assertIsNone(acos)
+
+        self.assertRaises(ValueError, self.dataset.aggregate, ['asin'], [(['ad_spend', 'sales'], Ratio())])
+
+    def test_api(self):
+        payload = best_selling_item_payload()
+        payload['operations'][1:3] = [
+            {
+                'dataset': 'ad_report',
+                'operation_name': 'derive',
+                'operation_args': {
+                    'column_name': 'profit',
+                    'expression': {'op': '-', 'left': 'sales', 'right': 'ad_spend'}
+                }
+            },
+            {
+                'dataset': 'ad_report',
+                'operation_name': 'aggregate',
+                'operation_args': {
+                    'group_by_columns': ['asin'],
+                    'aggregations': [
+                        {'column': 'profit', 'aggregation': 'sum'},
+                        {'aggregation': 'roas'}
+                    ]
+                }
+            },
+            {
+                'dataset': 'ad_report',
+                'operation_name': 'sort_by_desc',
+                'operation_args': {'column_name': 'roas'}
+            },
+        ]
+
+        rows = [row for row in self.dataset.between_filter('date', '2017-06-06', '2017-06-17').data
+                if row[6] == 'ASIN1']
+        expected = (
+            'ASIN1',
+            math.fsum(row[3] - row[4] for row in rows),
+            math.fsum(row[3] for row in rows) / math.fsum(row[4] for row in rows),
+            'Green New Bad Eraser'
+        )
+        for api in (DatasetAPI(), DatasetAPI(columnar=True)):
+            result = api.handle_request(payload)['ad_report']
+            self.assertListEqual(result['columns'], ['asin', 'profit', 'roas', 'name'])
+            self.assertEqual(result['data'][0][0], 'ASIN1')
+            self.assertAlmostEqual(result['data'][0][1], expected[1])
+            self.assertAlmostEqual(result['data'][0][2], expected[2])
+
+        self.assertEqual(repr(parse_expression({'metric': 'ctr'})), '(clicks / impressions)')
+
+
+class TopNTests(TestCase):
+    def setUp(self):
+        self.dataset = Dataset('test').populate('ad_report_test.csv')
+
+    def test_top_n(self):
+        for dataset in (self.dataset, self.dataset.to_columnar()):
+            for n in (0, 1, 3, 100):
+                for descending in (False, True):
+                    # clicks has ties, which must come out in the same order as a stable sort
+                    expected = dataset.sort_by('clicks', reverse=descending).limit(n).data
+                    self.assertListEqual(dataset.top_n('clicks', n, descending=descending).data, expected)
+
+    def test_multiple_columns(self):
+        expected = sorted(self.dataset.data, key=lambda row: (row[6], row[3]), reverse=True)[:4]
+        for dataset in (self.dataset, self.dataset.to_columnar()):
+            self.assertListEqual(dataset.top_n(['asin', 'sales'], 4, descending=True).data, expected)
+        self.assertRaises(ValueError, self.dataset.top_n, ['asin', 'cost'], 1)
+
+    def test_api(self):
+        payload = best_selling_item_payload()
+        payload['operations'][2:4] = [{
+            'dataset': 'ad_report',
+            'operation_name': 'top_n',
+            'operation_args': {'column_names': ['sales'], 'n': 1, 'descending': True}
+        }]
+        self.assertDictEqual(DatasetAPI().handle_request(payload), BEST_SELLING_ITEM_RESULT)
+
+
+class PlanTests(TestCase):
+    def setUp(self):
+        self.ad_report = Scan('ad_report', 'ad_report_test.csv')
+        self.product_report = Scan('product_report', 'product_report_test.csv')
+
+    def run_plan(self, plan):
+        context = ExecutionContext(lambda scan: Dataset(scan.dataset_name).populate(
+            scan.csv_path, limit=scan.limit, columns=scan.projection, predicate=scan.predicate
+        ))
+        return context.evaluate(plan)
+
+    def assertOptimizedEqual(self, plan, expected_plan):
+        optimized = optimize(plan)
+        self.assertEqual(optimized.explain(), expected_plan)
+        result, expected = self.run_plan(optimized), self.run_plan(plan)
+        self.assertListEqual(result.columns, expected.columns)
+        self.assertListEqual(result.data, expected.data)
+
+    def test_filters(self):
+        joined = Join(self.ad_report, self.product_report, 'asin')
+        plan = Filter(Filter(joined, Comparison('asin', '==', 'ASIN1')), Comparison('name', '!=', 'x'))
+        self.assertOptimizedEqual(plan, '\n'.join([
+            'InnerJoin on asin',
+            "  Scan ad_report (ad_report_test.csv) where asin == 'ASIN1'",
+            "  Scan product_report (product_report_test.csv) where (asin == 'ASIN1' and name != 'x')",
+        ]))
+
+        aggregated = Aggregate(Derive(self.ad_report, 'profit', Field('sales') - Field('ad_spend')),
+                               ['asin'], [('profit', Sum)])
+        plan = Filter(aggregated, Comparison('asin', '==', 'ASIN2') & Comparison('profit', '>', 0))
+        self.assertOptimizedEqual(plan, '\n'.join([
+            'Filter profit > 0',
+            '  Aggregate by [asin]: profit = Sum() of profit',
+            '    Derive profit = (sales - ad_spend)',
+            "      Scan ad_report (ad_report_test.csv) columns=[sales, ad_spend, asin] where asin == 'ASIN2'",
+        ]))
+
+    def test_sorts_and_limits(self):
+        plan = Aggregate(Sort(self.ad_report, 'clicks'), ['asin'], [('sales', Sum)])
+        self.assertEqual(optimize(plan).explain(), '\n'.join([
+            'Aggregate by [asin]: sales = Sum() of sales',
+            '  Scan ad_report (ad_report_test.csv) columns=[sales, asin]',
+        ]))
+
+        plan = Aggregate(Sort(self.ad_report, 'clicks'), ['asin'], [('sales', First)])
+        self.assertOptimizedEqual(plan, '\n'.join([
+            'Aggregate by [asin]: sales = First() of sales',
+            '  Sort by clicks',
+            '    Scan ad_report (ad_report_test.csv) columns=[clicks, sales, asin]',
+        ]))
+
+        plan = Limit(Derive(Filter(self.ad_report, Comparison('clicks', '>', 0)), 'cpc', metric('cpc')), 3)
+        self.assertOptimizedEqual(plan, '\n'.join([
+            'Derive cpc = (ad_spend / clicks)',
+            '  Scan ad_report (ad_report_test.csv) where clicks > 0 limit 3',
+        ]))
+
+    def test_lazy(self):
+        payload = best_selling_item_payload()
+        payload['datasets']['unused'] = 'does_not_exist.csv'
+        payload['operations'].append({
+            'dataset': 'unused',
+            'operation_name': 'sort_by',
+            'operation_args': {'column_name': 'sales'}
+        })
+        self.assertDictEqual(DatasetAPI().handle_request(payload), BEST_SELLING_ITEM_RESULT)
+
+
+class JoinTests(TestCase):
+    def setUp(self):
+        self.ad_report = Dataset('test').populate('ad_report_test.csv')
+        self.keywords = Dataset('keywords', columns=['keyword_id', 'asin', 'keyword'], data=[
+            ('KEYWORDID2', 'ASIN2', 'marker'),
+            ('KEYWORDID1', 'ASIN1', 'eraser'),
+            ('KEYWORDID3', 'ASIN1', 'rubber'),
+            ('KEYWORDID1', 'ASIN1', 'green eraser'),
+            (None, 'ASIN1', 'unknown'),
+        ])
+
+    def nested_loop_join(self, left, right, join_columns):
+        left_indices = [left.columns.index(column_name) for column_name in join_columns]
+        right_indices = [right.columns.index(column_name) for column_name in join_columns]
+        their_indices = [i for i, column_name in enumerate(right.columns) if column_name not in join_columns]
+        return [our_row + tuple(their_row[i] for i in their_indices)
+                for our_row in left.data for their_row in right.data
+                if all(our_row[i] == their_row[j] and our_row[i] is not None
+                       for i, j in zip(left_indices, right_indices))]
+
+    def test_inner(self):
+        for join_columns in (['keyword_id'], ['keyword_id', 'asin']):
+            # each side is the smaller, built side once
+            for left, right in ((self.ad_report, self.keywords), (self.keywords, self.ad_report)):
+                expected = self.nested_loop_join(left, right, join_columns)
+                for dataset in (left, left.to_columnar()):
+                    result = dataset.join(right, join_columns)
+                    self.assertListEqual(result.data, expected)
+                    self.assertEqual(len(result.columns), len(left.columns) + len(right.columns) - len(join_columns))
+
+        self.assertRaises(ValueError, self.ad_report.join, self.keywords, ['keyword_id', 'date'])
+        self.assertRaises(ValueError, self.ad_report.join, self.keywords, 'keyword_id', how='outer')
+
+    def test_left(self):
+        for dataset in (self.keywords, self.keywords.to_columnar()):
+            ad_report = self.ad_report.select(['keyword_id', 'date', 'impressions', 'clicks', 'sales', 'ad_spend'])
+            result = dataset.join(ad_report.limit(2), 'keyword_id', how='left')
+            self.assertListEqual(result.columns, ['keyword_id', 'asin', 'keyword', 'date', 'impressions', 'clicks',
+                                                  'sales', 'ad_spend'])
+            self.assertListEqual([(row[2], row[3]) for row in result.data], [
+                ('marker', None),
+                ('eraser', '2017-06-19'),
+                ('eraser', '2017-06-18'),
+                ('rubber', None),
+                ('green eraser', '2017-06-19'),
+                ('green eraser', '2017-06-18'),
+                ('unknown', None),
+            ])
+
+    def test_semi_and_anti(self):
+        for dataset in (self.keywords, self.keywords.to_columnar()):
+            result = dataset.join(self.ad_report, 'keyword_id', how='semi')
+            self.assertListEqual(result.columns, self.keywords.columns)
+            self.assertListEqual([row[2] for row in result.data], ['marker', 'eraser', 'green eraser'])
+
+            # keywords with no ad activity for their asin
+            result = dataset.join(self.ad_report, ['keyword_id', 'asin'], how='anti')
+            self.assertListEqual([row[2] for row in result.data], ['marker', 'rubber', 'unknown'])
+
+    def test_batches(self):
+        for dataset in (self.ad_report, self.ad_report.to_columnar()):
+            batches = list(dataset.join_batches(self.keywords, 'keyword_id', batch_size=4))
+            self.assertTrue(all(0 < len(batch) <= 4 for batch in batches))
+            self.assertListEqual([row for batch in batches for row in batch],
+                                 self.ad_report.join(self.keywords, 'keyword_id').data)
+
+    def test_strategies(self):
+        left_keys = ['a', None, 'b', 'b', 'd', None]
+        right_keys = [None, 'b', 'b', 'c', 'd', 'd']
+        self.assertTrue(is_sorted(left_keys))
+        self.assertFalse(is_sorted(['b', 'a']))
+        self.assertFalse(is_sorted(['a', 1]))
+        for how in ('inner', 'left', 'semi', 'anti'):
+            expected = [pair for batch in join_indices(left_keys, right_keys, how=how, strategy='hash')
+                        for pair in batch]
+            # sorted keys are merge joined by default
+            for strategy in (None, 'merge'):
+                batches = list(join_indices(left_keys, right_keys, how=how, batch_size=2, strategy=strategy))
+                self.assertTrue(all(0 < len(batch) <= 2 for batch in batches))
+                self.assertListEqual([pair for batch in batches for pair in batch], expected)
+        self.assertRaises(ValueError, join_indices, left_keys, right_keys, strategy='nested')
+
+    def test_max_hash_rows(self):
+        for join_columns in (['keyword_id'], ['keyword_id', 'asin']):
+            for how in ('inner', 'left', 'semi', 'anti'):
+                for left, right in ((self.ad_report, self.keywords), (self.keywords, self.ad_report)):
+                    expected = left.join(right, join_columns, how=how)
+                    for dataset in (left, left.to_columnar()):
+                        # both sides have more rows than a hash table may hold, so they are sorted on disk
+                        result = dataset.join(right, join_columns, how=how, max_hash_rows=1)
+                        self.assertIsInstance(result, type(dataset))
+                        self.assertListEqual(result.columns, expected.columns)
+                        self.assertListEqual(result.data, expected.data)
+
+    def test_api(self):
+        payload = {
+            'datasets': {
+                'ad_report': 'ad_report_test.csv',
+                'product_report': 'product_report_test.csv'
+            },
+            'operations': [
+                {
+                    'dataset': 'product_report',
+                    'operation_name': 'join',
+                    'operation_args': {'other_dataset': 'ad_report', 'column_names': ['asin'], 'how': 'anti'}
+                }
+            ],
+            'return': ['product_report']
+        }
+        self.assertDictEqual(DatasetAPI().handle_request(payload), {
+            'product_report': {'columns': ['asin', 'name'], 'data': [('ASIN3', 'Red Old Tiny Pencil')]}
+        })
+        self.assertIn('AntiJoin on asin', DatasetAPI().explain(payload))
+
+
+class ExternalTests(TestCase):
+    def setUp(self):
+        self.dataset = Dataset('test').populate('ad_report_test.csv')
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_external_sort(self):
+        for reverse in (False, True):
+            expected = sorted(self.dataset.data, key=lambda row: row[2], reverse=reverse)
+            actual = external_sort(self.dataset.data, key=lambda row: row[2], reverse=reverse, run_size=3,
+                                   directory=self.directory)
+            self.assertListEqual(list(actual), expected)
+
+            for dataset_class in (Dataset, ColumnarDataset):
+                reader = CsvReader('ad_report_test.csv', predicate=Comparison('clicks', '>', 100))
+                actual = dataset_class.from_sorted('test', reader, 'clicks', reverse=reverse, run_size=4,
+                                                   directory=self.directory)
+                expected = self.dataset.where(Comparison('clicks', '>', 100)).sort_by('clicks', reverse=reverse)
+                self.assertIsInstance(actual, dataset_class)
+                self.assertListEqual(actual.data, expected.data)
+        self.assertRaises(ValueError, Dataset.from_sorted, 'test', CsvReader('ad_report_test.csv'), 'name')
+
+    def test_sort_by_max_rows(self):
+        for dataset in (self.dataset, self.dataset.to_columnar()):
+            for reverse in (False, True):
+                self.assertListEqual(dataset.sort_by('clicks', reverse=reverse, max_rows=2).data,
+                                     self.dataset.sort_by('clicks', reverse=reverse).data)
+
+    def test_sort_csv(self):
+        output_path = os.path.join(self.directory, 'sorted.csv')
+        sort_csv('ad_report_test.csv', output_path, ['asin', 'sales'], run_size=4, directory=self.directory)
+
+        expected = sorted(self.dataset.data, key=lambda row: (row[6], row[3]))
+        self.assertListEqual(Dataset('test').populate(output_path).data, expected)
+        self.assertListEqual(os.listdir(self.directory), ['sorted.csv'])
+
+    def test_merge_join(self):
+        keywords = Dataset('keywords', columns=['keyword_id', 'keyword'], data=[
+            ('KEYWORDID2', 'marker'), ('KEYWORDID1', 'eraser'), ('KEYWORDID3', 'rubber'), ('KEYWORDID1', 'pink')
+        ])
+        key = itemgetter(5)
+        pairs = merge_join(external_sort(self.dataset.data, key=key, run_size=3, directory=self.directory),
+                           sorted(keywords.data), key, itemgetter(0))
+        expected = self.dataset.sort_by('keyword_id').inner_join(keywords.sort_by('keyword_id'), 'keyword_id')
+        self.assertListEqual([left_row + right_row[1:] for left_row, right_row in pairs], expected.data)
+
+    def test_external_join(self):
+        keywords = Dataset('keywords', columns=['keyword_id', 'asin', 'keyword'], data=[
+            ('KEYWORDID2', 'ASIN1', 'marker'), ('KEYWORDID1', 'ASIN2', 'eraser'), (None, 'ASIN1', 'missing'),
+            ('KEYWORDID3', 'ASIN1', 'rubber'), ('KEYWORDID1', 'ASIN1', 'pink'), ('KEYWORDID1', None, 'blank')
+        ])
+        for join_columns in (['keyword_id'], ['keyword_id', 'asin']):
+            for how in ('inner', 'left', 'semi', 'anti'):
+                for left, right in ((self.dataset, keywords), (keywords, self.dataset)):
+                    expected = left.join(right, join_columns, how=how)
+                    for dataset_class in (Dataset, ColumnarDataset):
+                        sides = [CsvReader('ad_report_test.csv') if side is self.dataset else side
+                                 for side in (left, right)]
+                        actual = dataset_class.from_join('joined', sides[0], sides[1], join_columns, how=how,
+                                                         run_size=2, directory=self.directory)
+                        self.assertListEqual(actual.columns, expected.columns)
+                        self.assertListEqual(actual.data, expected.data)
+        self.assertRaises(ValueError, Dataset.from_join, 'joined', keywords, CsvReader('product_report_test.csv'),
+                          'keyword_id')
+        self.assertListEqual(os.listdir(self.directory), [])
+
+    def test_external_join_sorted(self):
+        key = itemgetter(5)
+        keywords = [('KEYWORDID1', 'eraser'), ('KEYWORDID1', 'pink'), ('KEYWORDID2', 'marker')]
+        ad_report = self.dataset.sort_by('keyword_id').data
+        for how in ('inner', 'left', 'semi', 'anti'):
+            expected = list(merge_join(ad_report, keywords, key, itemgetter(0), how=how))
+            # sorted sides are merge joined as they are
+            actual = external_join(ad_report, keywords, key, itemgetter(0), how=how, left_sorted=True,
+                                   right_sorted=True)
+            self.assertListEqual(list(actual), expected)
+
+            # without the left order, the joined rows of an unsorted left side are left in order of their keys
+            actual = external_join(self.dataset.data, keywords[2:] + keywords[:2], key, itemgetter(0), how=how,
+                                   run_size=2, ordered=False)
+            self.assertListEqual(list(actual), expected)
+
+        # a dataset that is already sorted on the join columns is not sorted again
+        sorted_dataset = self.dataset.sort_by('asin')
+        expected = sorted_dataset.join(Dataset('product_report').populate('product_report_test.csv'), 'asin',
+                                       how='left')
+        actual = Dataset.from_join('joined', sorted_dataset, CsvReader('product_report_test.csv'), 'asin',
+                                   how='left', run_size=2, directory=self.directory)
+        self.assertListEqual(actual.data, expected.data)
+
+    def test_api_run_size(self):
+        payload = {
+            'datasets': {'ad_report': 'ad_report_test.csv', 'product_report': 'product_report_test.csv'},
+            'operations': [
+                {'dataset': 'ad_report', 'operation_name': 'sort_by_desc', 'operation_args': {'column_name': 'sales'}},
+                {'dataset': 'ad_report', 'operation_name': 'join',
+                 'operation_args': {'other_dataset': 'product_report', 'column_names': ['asin'], 'how': 'left'}},
+                {'dataset': 'product_report', 'operation_name': 'sort_by',
+                 'operation_args': {'column_name': 'name'}},
+            ],
+            'return': ['ad_report', 'product_report']
+        }
+        for columnar in (False, True):
+            self.assertDictEqual(DatasetAPI(columnar=columnar, run_size=2, spill_bytes=0).handle_request(payload),
+                                 DatasetAPI(columnar=columnar).handle_request(payload))
+
+        # csvs no larger than spill_bytes are loaded and sorted or joined in memory
+        scan = Scan('ad_report', 'ad_report_test.csv')
+        api = DatasetAPI(run_size=2)
+        self.assertIsNone(api._load_sorted(scan, 'sales', True))
+        self.assertIsNone(api._load_join(scan, Scan('product_report', 'product_report_test.csv'), ['asin'], 'left',
+                                         True))
+        self.assertIsNotNone(DatasetAPI(run_size=2, spill_bytes=0)._load_sorted(scan, 'sales', True))
+        self.assertIsNone(DatasetAPI(run_size=2, spill_bytes=0)._load_sorted(scan.replace(limit=2), 'sales', True))
+
+    def test_api_unordered_join(self):
+        payload = {
+            'datasets': {'ad_report': 'ad_report_test.csv', 'product_report': 'product_report_test.csv'},
+            'operations': [
+                {'dataset': 'ad_report', 'operation_name': 'join',
+                 'operation_args': {'other_dataset': 'product_report', 'column_names': ['asin']}},
+                {'dataset': 'ad_report', 'operation_name': 'aggregate',
+                 'operation_args': {'group_by_columns': ['name'],
+                                    'aggregations': [{'column': 'sales', 'aggregation': 'sum'}]}},
+            ],
+            'return': ['ad_report']
+        }
+        # the joined rows are only aggregated, so they are not sorted back into the order of the ad report
+        self.assertIn('InnerJoin on asin unordered', DatasetAPI().explain(payload))
+        expected = DatasetAPI().handle_request(payload)['ad_report']
+        actual = DatasetAPI(run_size=2, spill_bytes=0).handle_request(payload)['ad_report']
+        self.assertListEqual(actual['columns'], expected['columns'])
+        self.assertListEqual(sorted(actual['data']), sorted(expected['data']))
+
+
+class ParallelTests(TestCase):
+    def setUp(self):
+        # small partitions, so that the test csvs are split several ways
+        self.executor = ParallelExecutor(workers=2, partition_size=64, partition_rows=3)
+        # use worker processes even on a single cpu, so that they are tested
+        self.executor.parallel = True
+        self.aggregations = [('sales', Sum()), ('clicks', Max()), ('ad_spend', Min(), 'min_spend'),
+                             ('date', Count()), ('impressions', Mean()), ('date', First(), 'first_date'),
+                             ('date', Last(), 'last_date'), (['ad_spend', 'sales'], Ratio(), 'acos')]
+
+    def tearDown(self):
+        self.executor.close()
+
+    def test_byte_ranges(self):
+        expected = Dataset('test').populate('ad_report_test.csv').data
+        for partition_size in (1, 64, 1000):
+            ranges = byte_ranges('ad_report_test.csv', partition_size)
+            data = [row for byte_range in ranges
+                    for row in Dataset('test').populate('ad_report_test.csv', byte_range=byte_range).data]
+            self.assertListEqual(data, expected)
+        self.assertEqual(len(byte_ranges('ad_report_test.csv', 64)), 7)
+
+    def test_matches_serial(self):
+        predicate = Comparison('clicks', '>', 0)
+        for dataset_class in (Dataset, ColumnarDataset):
+            for schema in (None, 'infer'):
+                dataset = dataset_class('test').populate('ad_report_test.csv', schema=schema)
+                loaded = self.executor.populate(dataset_class, 'test', 'ad_report_test.csv', schema=schema)
+                self.assertIsInstance(loaded, dataset_class)
+                self.assertListEqual(loaded.data, dataset.data)
+                self.assertEqual(repr(loaded.schema), repr(dataset.schema))
+                self.assertListEqual(self.executor.where(dataset, predicate).data, dataset.where(predicate).data)
+
+                expected = dataset.aggregate(['asin'], self.aggregations)
+                self.assertListEqual(self.executor.aggregate(dataset, ['asin'], self.aggregations).data,
+                                     expected.data)
+                scanned = self.executor.scan_aggregate(dataset_class, 'test', 'ad_report_test.csv', ['asin'],
+                                                       self.aggregations, schema=schema)
+                self.assertListEqual(scanned.columns, expected.columns)
+                self.assertListEqual(scanned.data, expected.data)
+
+                filtered = self.executor.scan_aggregate(dataset_class, 'test', 'ad_report_test.csv', [],
+                                                        self.aggregations, predicate=predicate, schema=schema)
+                self.assertListEqual(filtered.data, dataset.where(predicate).aggregate([], self.aggregations).data)
+
+    def test_api(self):
+        request = {
+            'datasets': {'ad_report': 'ad_report_test.csv', 'product_report': 'product_report_test.csv'},
+            'operations': [
+                {'dataset': 'ad_report', 'operation_name': 'where',
+                 'operation_args': {'predicate': {'column_name': 'clicks', 'op': '>', 'value': 0}}},
+                {'dataset': 'ad_report', 'operation_name': 'aggregate',
+                 'operation_args': {'group_by_columns': ['asin'],
+                                    'aggregations': [{'column': 'sales', 'aggregation': 'sum'},
+                                                     {'aggregation': 'acos'}]}},
+                {'dataset': 'product_report', 'operation_name': 'inner_join',
+                 'operation_args': {'other_dataset': 'ad_report', 'column_name': 'asin'}},
+            ],
+            'return': ['product_report'],
+        }
+        for columnar in (False, True):
+            expected = DatasetAPI(columnar=columnar).handle_request(request)
+            actual = DatasetAPI(columnar=columnar, executor=self.executor).handle_request(request)
+            self.assertDictEqual(actual, expected)
+
+    def test_partitions_sent_to_workers(self):
+        predicate = Comparison('clicks', '>', 100)
+        for dataset in (Dataset('test').populate('ad_report_test.csv'),
+                        ColumnarDataset('test').populate('ad_report_test.csv', schema='infer')):
+            expected = dataset.where(predicate).data
+            # frozen columns are memoryviews, which are sent to the workers as arrays
+            frozen = dataset.copy().freeze()
+            self.assertListEqual(self.executor.where(frozen, predicate).data, expected)
+            self.assertListEqual(self.executor.aggregate(frozen, ['asin'], self.aggregations).data,
+                                 dataset.aggregate(['asin'], self.aggregations).data)
+        pool = self.executor._pool
+        self.executor.where(dataset, predicate)
+        self.assertIs(self.executor._pool, pool)
+
+        with ParallelExecutor(workers=1, partition_rows=3) as serial:
+            self.assertFalse(serial.parallel)
+            self.assertListEqual(serial.where(dataset, predicate).data, expected)
+            self.assertIsNone(serial._pool)
+
+
+class PartitionedTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'ad_report')
+        self.store = PartitionedStore.create(self.path, 'ad_report_test.csv')
+        self.dataset = Dataset('test').populate('ad_report_test.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_may_match(self):
+        bounds = {'date': ('2017-06-06', '2017-06-10'), 'clicks': (0.0, 10.0)}
+        self.assertTrue(Between('date', '2017-06-01', '2017-06-07').may_match(bounds))
+        self.assertFalse(Between('date', '2017-06-01', '2017-06-06').may_match(bounds))
+        self.assertTrue(Between('date', '2017-06-01', '2017-06-06', inclusive=True).may_match(bounds))
+        self.assertFalse(Comparison('clicks', '>', 10.0).may_match(bounds))
+        self.assertTrue(Comparison('clicks', '!=', 0.0).may_match(bounds))
+        self.assertFalse(In('date', ['2017-06-01', '2017-06-11']).may_match(bounds))
+        self.assertTrue((Comparison('clicks', '>', 10.0) | Comparison('asin', '==', 'ASIN1')).may_match(bounds))
+        # bounds that cannot be compared to the constant never rule a partition out
+        self.assertTrue(Comparison('clicks', '==', 'many').may_match(bounds))
+
+    def test_populate(self):
+        self.assertEqual(len(self.store.partitions), 14)
+        # the partitions are in csv order, newest first
+        self.assertEqual(self.store.bounds(self.store.partitions[-1])['sales'], (0, 0))
+
+        predicate = Between('date', '2017-06-10', '2017-06-14')
+        reader = PartitionedReader(self.path, predicate=predicate)
+        self.assertListEqual([os.path.basename(path) for path in reader.paths()],
+                             ['2017-06-13.csv', '2017-06-12.csv', '2017-06-11.csv'])
+
+        for dataset_class in (Dataset, ColumnarDataset):
+            for schema in (None, 'infer'):
+                expected = dataset_class('test').populate('ad_report_test.csv', predicate=predicate, schema=schema)
+                actual = dataset_class('test').populate(self.path, predicate=predicate, schema=schema)
+                self.assertListEqual(actual.columns, expected.columns)
+                self.assertListEqual(actual.data, expected.data)
+                parallel = ParallelExecutor(workers=2).populate(dataset_class, 'test', self.path, predicate=predicate,
+                                                                schema=schema)
+                self.assertListEqual(parallel.data, actual.data)
+        self.assertEqual(len(Dataset('test').populate(self.path, limit=5, columns=['sales']).data), 5)
+        self.assertRaises(ValueError, Dataset('test').populate, self.path, columns=['missing'])
+
+    def test_partial_dates(self):
+        # constants that are not whole ISO dates compare as strings, like a csv read without a schema
+        for start, end in (('2017-05', '2017-06'), ('2017-06', '2017-06-09'), ('2017-06-05', '2017-06-10T')):
+            payloads = [{'datasets': {'ad_report': csv_path}, 'return': ['ad_report'], 'operations': [
+                {'dataset': 'ad_report', 'operation_name': 'between_filter',
+                 'operation_args': {'column_name': 'date', 'start': start, 'end': end}}]}
+                for csv_path in ('ad_report_test.csv', self.path)]
+            expected, actual = [DatasetAPI().handle_request(payload)['ad_report']['data'] for payload in payloads]
+            self.assertListEqual(actual, expected)
+        self.assertEqual(len(expected), 5)
+
+    def test_limit_zero(self):
+        limit = {'dataset': 'ad_report', 'operation_name': 'limit', 'operation_args': {'value': 0}}
+        between = {'dataset': 'ad_report', 'operation_name': 'between_filter',
+                   'operation_args': {'column_name': 'date', 'start': '2017-06-01', 'end': '2017-06-30'}}
+        for csv_path in ('ad_report_test.csv', self.path):
+            payloads = [{'datasets': {'ad_report': csv_path}, 'operations': operations, 'return': ['ad_report']}
+                        for operations in ([limit], [between, limit])]
+            for api in (DatasetAPI(), DatasetAPI(columnar=True), DatasetAPI(executor=ParallelExecutor(workers=2))):
+                results = [api.handle_request(payload) for payload in payloads] + api.handle_batch(payloads)
+                for result in results:
+                    self.assertListEqual(list(result['ad_report']['data']), [])
+
+    def test_append(self):
+        store = PartitionedStore.create(os.path.join(self.directory, 'monthly'), 'ad_report_test.csv',
+                                        granularity=MONTH)
+        self.assertListEqual([partition['key'] for partition in store.partitions], ['2017-06'])
+
+        new_rows = os.path.join(self.directory, 'new_rows.csv')
+        with open(new_rows, 'w') as csv_file:
+            csv_file.write('date,impressions,clicks,sales,ad_spend,keyword_id,asin\n'
+                           '2017-06-20,100,10,5,2.5,KEYWORDID1,ASIN1\n'
+                           '2017-06-19,200,20,10,5.0,KEYWORDID1,ASIN3\n')
+        old_partition = self.store.path(self.store.partitions[-1])
+        with open(old_partition) as partition_file:
+            old_content = partition_file.read()
+        self.store.append(new_rows)
+
+        store = PartitionedStore(self.path)
+        self.assertEqual(len(store.partitions), 15)
+        self.assertListEqual([store.partitions[0]['key'], store.partitions[-1]['key']], ['2017-06-19', '2017-06-20'])
+        self.assertEqual(store.partitions[0]['rows'], 2)
+        self.assertEqual(store.bounds(store.partitions[0])['asin'], ('ASIN1', 'ASIN3'))
+        with open(old_partition) as partition_file:
+            self.assertEqual(partition_file.read(), old_content)
+
+        request = {
+            'datasets': {'ad_report': self.path},
+            'operations': [{'dataset': 'ad_report', 'operation_name': 'between_filter',
+                            'operation_args': {'column_name': 'date', 'start': '2017-06-18', 'end': '2017-06-21'}}],
+            'return': ['ad_report'],
+        }
+        self.assertEqual(len(DatasetAPI().handle_request(request)['ad_report']['data']), 3)
+        self.assertRaises(ValueError, self.store.append, 'product_report_test.csv')
+
+
+class RollupTests(TestCase):
+    def setUp(self):
+        self.dataset = Dataset('test').populate('ad_report_test.csv')
+        self.rollup = Rollup().update(self.dataset)
+        self.columns = ['sales', 'ad_spend', 'clicks', 'impressions']
+
+    def expected(self, dataset, start, end, inclusive=False):
+        aggregations = [(column_name, Sum()) for column_name in self.columns]
+        filtered = dataset.where(Between('date', start, end, inclusive=inclusive))
+        return sorted(filtered.aggregate(['asin'], aggregations).data)
+
+    def test_window(self):
+        for start, end in (('2017-06-01', '2017-07-01'), ('2017-06-09', '2017-06-14'), ('2017-06-16', '2017-06-19'),
+                           ('2017-06-20', '2017-06-30')):
+            for inclusive in (False, True):
+                actual = self.rollup.window(start, end, inclusive=inclusive)
+                self.assertListEqual(actual.columns, ['asin'] + self.columns)
+                self.assertListEqual(sorted(actual.data), self.expected(self.dataset, start, end, inclusive))
+
+        typed = Dataset('test').populate('ad_report_test.csv', schema='infer')
+        actual = Rollup().update(typed).window('2017-06-09', '2017-06-14')
+        self.assertListEqual(sorted(actual.data), self.expected(typed, '2017-06-09', '2017-06-14'))
+        self.assertIsInstance(actual.data[0][1], int)
+
+    def test_exact_window(self):
+        days = ['2017-06-0{}'.format(day) for day in range(1, 6)]
+        values = [1e16, 0.1, 1.0, -1e16, 0.1]
+        data = [('A', day, value) for day, value in zip(days, values)] + [('A', days[2], 0.1)] * 100
+        dataset = Dataset('test', columns=['asin', 'date', 'sales'], data=data)
+        rollup = Rollup(value_columns=['sales']).update(dataset)
+        for start, end in ((days[0], days[4]), (days[1], days[3]), (days[2], days[4])):
+            expected = dataset.where(Between('date', start, end, inclusive=True)).aggregate(['asin'], [('sales', Sum)])
+            self.assertListEqual(rollup.window(start, end, inclusive=True).data, expected.data)
+
+    def test_incremental(self):
+        rows = self.dataset.data
+        rollup = Rollup()
+        # the newest days first, then older days that land before days already in the rollup
+        for start, end in ((0, 5), (5, 6), (10, 14), (6, 10)):
+            rollup.update(Dataset('test', columns=self.dataset.columns, data=rows[start:end]))
+        for start, end in (('2017-06-01', '2017-07-01'), ('2017-06-08', '2017-06-17')):
+            self.assertListEqual(sorted(rollup.window(start, end).data),
+                                 sorted(self.rollup.window(start, end).data))
+
+    def test_trailing_top_n(self):
+        expected = self.dataset.between_filter('date', '2017-06-09', '2017-06-20')\
+            .group_by_and_aggregate(('asin',), 'sales', sum)\
+            .top_n('sales', 1, descending=True)
+        actual = self.rollup.trailing_top_n('sales', 1, '2017-06-20', 10)
+        self.assertListEqual([row[:2] for row in actual.data], expected.data)
+        self.assertListEqual(self.rollup.trailing('2017-06-06', 5).data, [])
+
+
+class ServiceTests(TestCase):
+    def setUp(self):
+        self.payload = best_selling_item_payload()
+        self.expected = json.loads(json.dumps(BEST_SELLING_ITEM_RESULT))
+
+    def test_coalescing_and_cache(self):
+        service = DatasetService(workers=2, processes=False)
+
+        async def requests():
+            bodies = await asyncio.gather(*[service.handle(self.payload) for _ in range(5)])
+            results = await asyncio.gather(*[read_body(body) for body in bodies])
+            results.append(await read_body(await service.handle(json.loads(json.dumps(self.payload, sort_keys=True)))))
+            return results
+
+        try:
+            results = asyncio.run(requests())
+        finally:
+            service.close()
+        for result in results:
+            self.assertDictEqual(json.loads(result), self.expected)
+        self.assertEqual(service.stats['executions'], 1)
+        self.assertEqual(service.stats['coalesced'], 4)
+        self.assertEqual(service.stats['cache_hits'], 1)
+
+    def test_large_results_not_cached(self):
+        service = DatasetService(workers=1, processes=False, max_cached_body=10)
+
+        async def requests():
+            first = await service.handle(self.payload)
+            second = await service.handle(self.payload)
+            return await read_body(first), await read_body(second), await read_body(await service.handle(self.payload))
+
+        try:
+            results = asyncio.run(requests())
+        finally:
+            service.close()
+        for result in results:
+            self.assertDictEqual(json.loads(result), self.expected)
+        self.assertEqual(service.stats['executions'], 3)
+        self.assertEqual(service.stats['coalesced'], 0)
+        self.assertEqual(service.stats['cache_hits'], 0)
+
+    def test_limits(self):
+        service = DatasetService(workers=1, processes=False, timeout=0, max_pending=1)
+
+        other = best_selling_item_payload()
+        other['operations'][3]['operation_args']['value'] = 2
+
+        async def requests():
+            return await asyncio.gather(service.handle(self.payload), service.handle(other), return_exceptions=True)
+
+        try:
+            timed_out, rejected = asyncio.run(requests())
+        finally:
+            service.close()
+        self.assertEqual(timed_out.status, 504)
+        self.assertEqual(rejected.status, 503)
+
+    def test_http(self):
+        service = DatasetService(workers=2)
+        try:
+            report = asyncio.run(run_with_service(service, [self.payload, {'datasets': 'missing'}], requests=20,
+                                                  concurrency=4))
+        finally:
+            service.close()
+        self.assertEqual(report['requests'], 20)
+        self.assertDictEqual(report['error_statuses'], {400: 10})
+        self.assertEqual(service.stats['executions'], 1)
+        self.assertEqual(percentile([1, 2, 3, 4], 50), 2)
+        self.assertEqual(percentile([1, 2, 3, 4], 99), 4)
+
+    def test_percentile(self):
+        values = list(range(1, 11))
+        self.assertEqual([percentile(values, q) for q in (10, 30, 50, 90, 100)], [1, 3, 5, 9, 10])
+        self.assertEqual(percentile(values, 0), 1)
+        self.assertEqual(percentile(list(range(1, 101)), 99), 99)
+        self.assertIsNone(percentile([], 50))
+
+
+class SerializationTests(TestCase):
+    def setUp(self):
+        self.payload = {
+            'datasets': {'ad_report': 'ad_report_test.csv'},
+            'operations': [],
+            'return': ['ad_report'],
+        }
+        self.expected = json.loads(json.dumps(DatasetAPI().handle_request(self.payload), default=str))['ad_report']
+
+    def test_json(self):
+        for columnar in (False, True):
+            body = b''.join(DatasetAPI(columnar=columnar).stream_request(self.payload))
+            self.assertDictEqual(json.loads(body), {'ad_report': self.expected})
+
+            api = DatasetAPI(columnar=columnar)
+            self.assertDictEqual(json.loads(b''.join(api.stream_request(best_selling_item_payload()))),
+                                 json.loads(json.dumps(BEST_SELLING_ITEM_RESULT)))
+
+    def test_ndjson_and_columns(self):
+        for columnar in (False, True):
+            api = DatasetAPI(columnar=columnar)
+            lines = b''.join(api.stream_request(self.payload, 'ndjson')).decode().splitlines()
+            self.assertDictEqual(json.loads(lines[0]), {'dataset': 'ad_report', 'columns': self.expected['columns']})
+            self.assertListEqual([json.loads(line) for line in lines[1:]], self.expected['data'])
+
+            result = json.loads(b''.join(api.stream_request(self.payload, 'columns')))['ad_report']
+            self.assertListEqual(result['columns'], self.expected['columns'])
+            for i, column_name in enumerate(self.expected['columns']):
+                self.assertListEqual(result['data'][column_name], [row[i] for row in self.expected['data']])
+
+    def test_binary(self):
+        expected = ColumnarDataset('ad_report').populate('ad_report_test.csv')
+        for columnar in (False, True):
+            body = b''.join(DatasetAPI(columnar=columnar).stream_request(self.payload, 'binary'))
+            (header, dataset), = read_binary(body)
+            self.assertEqual(header['name'], 'ad_report')
+            self.assertListEqual(dataset.columns, expected.columns)
+            self.assertListEqual(dataset.data, expected.data)
+        self.assertIsInstance(dataset.column_data[0], DictionaryColumn)
+        self.assertIsInstance(dataset.column_data[1], NumericColumn)
+
+    def test_pages(self):
+        for response_format in ('json', 'ndjson', 'columns', 'binary'):
+            api = DatasetAPI(columnar=response_format == 'binary')
+            rows, cursor, pages = [], None, 0
+            while True:
+                body = b''.join(api.stream_request(self.payload, response_format, max_rows=5, cursor=cursor))
+                if response_format == 'binary':
+                    (header, dataset), = read_binary(body)
+                    page = [list(row) for row in dataset.to_rows().data]
+                elif response_format == 'ndjson':
+                    lines = body.decode().splitlines()
+                    header, page = json.loads(lines[0]), [json.loads(line) for line in lines[1:]]
+                else:
+                    header = json.loads(body)['ad_report']
+                    data = header['data']
+                    page = data if response_format == 'json' else [list(row) for row in zip(*data.values())]
+                self.assertEqual(header['total_rows'], 14)
+                self.assertEqual(header['offset'], len(rows))
+                self.assertEqual(header['rows'], len(page))
+                rows += page
+                pages += 1
+                cursor = header['next_cursor']
+                if cursor is None:
+                    break
+            self.assertEqual(pages, 3)
+            self.assertListEqual([[str(value) if isinstance(value, date) else value for value in row] for row in rows],
+                                 self.expected['data'])
+
+        other = dict(self.payload, operations=[{'dataset': 'ad_report', 'operation_name': 'limit',
+                                               'operation_args': {'value': 2}}])
+        cursor = json.loads(b''.join(DatasetAPI().stream_request(self.payload, max_rows=5)))['ad_report']['next_cursor']
+        with self.assertRaises(ValueError):
+            b''.join(DatasetAPI().stream_request(other, cursor=cursor))
+        with self.assertRaises(ValueError):
+            b''.join(DatasetAPI().stream_request(self.payload, cursor='not a cursor'))
+
+    def test_service(self):
+        service = DatasetService(workers=1, processes=False)
+
+        async def request(target):
+            status, content_type, body = await service._route('POST', target, json.dumps(self.payload).encode())
+            return status, content_type, await read_body(body)
+
+        try:
+            status, content_type, body = asyncio.run(request('/query?format=ndjson&max_rows=3'))
+            with self.assertRaises(HttpError):
+                asyncio.run(request('/query?format=xml'))
+        finally:
+            service.close()
+        self.assertEqual(content_type, 'application/x-ndjson')
+        self.assertEqual(len(body.decode().splitlines()), 4)
+
+
+class BenchmarkTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_synthetic_reports(self):
+        reports = SyntheticReports(rows=500, asins=20, keywords=50, ad_groups=5, days=10, skew=1.5, seed=1)
+        paths = reports.write(self.directory)
+        other_paths = SyntheticReports(**reports.config()).write(os.path.join(self.directory, 'other'))
+        for name, path in paths.items():
+            with open(path) as report_file, open(other_paths[name]) as other_file:
+                self.assertEqual(report_file.read(), other_file.read())
+
+        ad_report = Dataset('ad_report').populate(paths['ad_report'])
+        self.assertEqual(len(ad_report), 500)
+        self.assertEqual(len({row[0] for row in ad_report.data}), 10)
+        self.assertEqual(ad_report.data[0][0], '2017-06-19')
+        counts = ad_report.group_by_and_aggregate(['asin'], 'sales', Count()).sort_by('sales', reverse=True)
+        self.assertLessEqual(len(counts), 20)
+        # the most common asin is drawn first
+        self.assertEqual(counts.data[0][0], reports.asin_ids()[0])
+
+        joined = ad_report.inner_join(Dataset('product_report').populate(paths['product_report']), 'asin')
+        self.assertEqual(len(joined), 500)
+        keywords = Dataset('keyword_report').populate(paths['keyword_report'])
+        self.assertEqual(len(keywords), 50)
+        self.assertLessEqual(len({row[0] for row in keywords.data}), 5)
+
+    def test_summarize(self):
+        summary = summarize([40.0, 10.0, 30.0, 20.0])
+        self.assertEqual(summary['p50_ms'], 25.0)
+        self.assertEqual(summary['p90_ms'], 40.0)
+        self.assertEqual(summary['max_ms'], 40.0)
+        self.assertEqual(summarize([3.0, 1.0, 2.0])['p50_ms'], 2.0)
+
+    def test_run_and_compare(self):
+        reports = SyntheticReports(rows=300, asins=10, keywords=20, days=40)
+        results = run(reports, self.directory, repeats=2, isolate=False)
+        self.assertListEqual(list(results['workloads']), list(WORKLOADS))
+        for result in results['workloads'].values():
+            self.assertEqual(result['repeats'], 2)
+            self.assertLessEqual(result['p50_ms'], result['max_ms'])
+            self.assertGreater(result['peak_rss_mb'], 0)
+
+        baseline = json.loads(json.dumps(results))
+        self.assertListEqual(compare(results, baseline), [])
+        baseline['workloads']['populate']['p50_ms'] = results['workloads']['populate']['p50_ms'] / 2
+        regression, = compare(results, baseline, threshold=0.5)
+        self.assertEqual(regression['workload'], 'populate')
+        self.assertAlmostEqual(regression['change'], 1)
+        baseline['config']['rows'] = 1
+        with self.assertRaises(ValueError):
+            compare(results, baseline)
+
+
+class ProfilingTests(TestCase):
+    def test_profile_request(self):
+        result = DatasetAPI().profile_request(best_selling_item_payload())
+        self.assertDictEqual(result['result'], BEST_SELLING_ITEM_RESULT)
+        profile = result['profile']
+        operations = [record['operation'] for record in profile['operations']]
+        self.assertListEqual(operations, ['join', 'topn', 'aggregate', 'scan', 'scan'])
+        join, top_n, aggregate, ad_report, product_report = profile['operations']
+        self.assertEqual(aggregate['depth'], 2)
+        self.assertEqual(ad_report['output_rows'], 10)
+        self.assertIsNone(ad_report['input_rows'])
+        self.assertEqual(aggregate['input_rows'], 10)
+        self.assertEqual(aggregate['output_rows'], 2)
+        self.assertEqual(join['input_rows'], top_n['output_rows'] + product_report['output_rows'])
+        for record in profile['operations']:
+            self.assertGreaterEqual(record['wall_seconds'], 0)
+            self.assertGreater(record['peak_bytes'], 0)
+        # each node's own time leaves out its children's
+        self.assertLessEqual(sum(record['wall_seconds'] for record in profile['operations']), profile['wall_seconds'])
+
+        profile = DatasetAPI().profile_request(best_selling_item_payload(), trace_memory=False)['profile']
+        self.assertIsNone(profile['operations'][0]['allocated_bytes'])
+
+    def test_cache_hits(self):
+        api = DatasetAPI(columnar=True, registry=DatasetRegistry())
+        first = api.profile_request(best_selling_item_payload())['profile']
+        second = api.profile_request(best_selling_item_payload())['profile']
+        self.assertEqual((first['cache_hits'], first['cache_misses']), (0, 2))
+        self.assertEqual((second['cache_hits'], second['cache_misses']), (2, 0))
+
+    def test_prometheus_exporter(self):
+        exporter = PrometheusExporter()
+        api = DatasetAPI(metrics=exporter)
+        self.assertDictEqual(api.handle_request(best_selling_item_payload()), BEST_SELLING_ITEM_RESULT)
+        api.handle_request(best_selling_item_payload())
+
+        server = exporter.serve(port=0)
+        try:
+            url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+            with urlopen(url) as response:
+                self.assertIn('text/plain', response.headers['Content-Type'])
+                text = response.read().decode()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        samples = {}
+        for line in text.splitlines():
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        self.assertEqual(samples['tikametrics_requests_total'], 2)
+        self.assertEqual(samples['tikametrics_operations_total{operation="scan"}'], 4)
+        self.assertEqual(samples['tikametrics_operation_output_rows_total{operation="aggregate"}'], 4)
+        self.assertGreater(samples['tikametrics_operation_seconds_total{operation="join"}'], 0)
+        self.assertNotIn('tikametrics_operation_peak_bytes{operation="scan"}', samples)
+
+
+class SketchTests(TestCase):
+    def setUp(self):
+        rng = random.Random(7)
+        self.values = [rng.random() for _ in range(20000)]
+        self.sorted_values = sorted(self.values)
+
+    def rank(self, value):
+        return bisect_left(self.sorted_values, value) / len(self.sorted_values)
+
+    def test_approx_count_distinct(self):
+        self.assertEqual(ApproxCountDistinct().result(), 0)
+        small = ApproxCountDistinct()
+        for value in [1, 2.0, 2, 'a', None, 'a']:
+            small.update(value)
+        self.assertEqual(small.result(), 3)
+
+        first, second, whole = ApproxCountDistinct(), ApproxCountDistinct(), ApproxCountDistinct()
+        for i in range(60000):
+            (first if i % 2 else second).update('KEYWORD{}'.format(i % 40000))
+            whole.update('KEYWORD{}'.format(i % 40000))
+        self.assertEqual(len(whole.registers), 4096)
+        self.assertLess(abs(whole.result() - 40000) / 40000.0, 0.05)
+        # merging gives the same sketch as one pass
+        self.assertEqual(first.merge(second).registers, whole.registers)
+        with self.assertRaises(ValueError):
+            whole.merge(ApproxCountDistinct(precision=10))
+
+    def test_approx_quantile(self):
+        self.assertIsNone(ApproxQuantile().result())
+        for q in (0.5, 0.95):
+            sketch = ApproxQuantile(q)
+            first, second = ApproxQuantile(q), ApproxQuantile(q)
+            for i, value in enumerate(self.values):
+                sketch.update(value)
+                (first if i % 3 else second).update(value)
+            self.assertLess(sum(len(compactor) for compactor in sketch.compactors), 3 * sketch.k)
+            self.assertLess(abs(self.rank(sketch.result()) - q), 0.02)
+            merged = first.merge(second)
+            self.assertEqual(merged.count, len(self.values))
+            self.assertLess(abs(self.rank(merged.result()) - q), 0.02)
+
+        exact = ApproxQuantile(0.5)
+        for value in [3, 1, 2, None]:
+            exact.update(value)
+        self.assertEqual(exact.result(), 2)
+
+    def test_sampled_quantile(self):
+        exact = SampledQuantile(0.5, bound=UPPER)
+        for value in [5, 1, 4, 2, 3]:
+            exact.update(value)
+        self.assertEqual(exact.rank_error(), 0)
+        self.assertEqual(exact.result(), 3)
+
+        aggregations = [SampledQuantile(0.95, size=500, bound=bound) for bound in (LOWER, None, UPPER)]
+        parts = [[aggregation.new() for aggregation in aggregations] for _ in range(2)]
+        for i, value in enumerate(self.values):
+            for aggregation, part in zip(aggregations, parts[i % 2]):
+                aggregation.update(value)
+                part.update(value)
+        lower, estimate, upper = [aggregation.result() for aggregation in aggregations]
+        self.assertLessEqual(lower, estimate)
+        self.assertLessEqual(estimate, upper)
+        self.assertLessEqual(self.rank(lower), 0.95)
+        self.assertGreaterEqual(self.rank(upper), 0.95)
+
+        merged = parts[0][1].merge(parts[1][1])
+        self.assertEqual(len(merged.sample), 500)
+        self.assertEqual(merged.count, len(self.values))
+        self.assertLess(abs(self.rank(merged.result()) - 0.95), merged.rank_error())
+
+    def test_api_and_parallel(self):
+        payload = {
+            'datasets': {'ad_report': 'ad_report_test.csv'},
+            'operations': [{
+                'dataset': 'ad_report',
+                'operation_name': 'aggregate',
+                'operation_args': {
+                    'group_by_columns': ['asin'],
+                    'aggregations': [
+                        {'column': 'keyword_id', 'aggregation': 'approx_count_distinct', 'output_column': 'keywords'},
+                        {'column': 'sales', 'aggregation': 'approx_quantile', 'output_column': 'median_sales'},
+                        {'column': 'sales', 'aggregation': 'sampled_quantile', 'args': {'q': 1},
+                         'output_column': 'max_sales'},
+                    ],
+                },
+            }],
+            'return': ['ad_report'],
+        }
+        expected = Dataset('ad_report').populate('ad_report_test.csv').aggregate(
+            ['asin'], [('keyword_id', CountDistinct(), 'keywords'), ('sales', max, 'max_sales')])
+        result = DatasetAPI().handle_request(payload)['ad_report']
+        self.assertListEqual([(row[0], row[1], row[3]) for row in result['data']], expected.data)
+
+        parallel = DatasetAPI(executor=ParallelExecutor(workers=2, partition_size=64))
+        self.assertDictEqual(parallel.handle_request(payload), {'ad_report': result})
+
+        payload['operations'][0]['operation_args']['aggregations'][1]['args'] = {'quantile': 0.5}
+        with self.assertRaises(ValueError):
+            DatasetAPI().handle_request(payload)
+
+    def test_rollup(self):
+        dataset = Dataset('ad_report').populate('ad_report_test.csv')
+        rollup = Rollup(value_columns=['sales'], aggregations=[('keyword_id', ApproxCountDistinct(), 'keywords'),
+                                                               ('sales', ApproxQuantile(1), 'max_sales')])
+        for start in range(0, len(dataset), 4):
+            rollup.update(dataset.row_range(start, start + 4))
+        window = rollup.window('2017-06-10', '2017-06-19', inclusive=True)
+        expected = dataset.between_filter('date', '2017-06-09', '2017-06-20').aggregate(
+            ['asin'], [('sales', Sum()), ('keyword_id', CountDistinct(), 'keywords'), ('sales', Max(), 'max_sales')])
+        self.assertListEqual(window.columns, ['asin', 'sales', 'keywords', 'max_sales'])
+        self.assertListEqual(sorted(window.data), sorted(expected.data))
+        with self.assertRaises(ValueError):
+            Rollup(value_columns=['sales'], aggregations=[('keyword_id', ApproxCountDistinct(), 'sales')])
+
+
+class BatchTests(TestCase):
+    def setUp(self):
+        def aggregate(predicate, group_by_columns, aggregations):
+            operations = [] if predicate is None else [
+                {'dataset': 'ad_report', 'operation_name': 'where', 'operation_args': {'predicate': predicate}}]
+            operations.append({'dataset': 'ad_report', 'operation_name': 'aggregate',
+                               'operation_args': {'group_by_columns': group_by_columns,
+                                                  'aggregations': aggregations}})
+            return {'datasets': {'ad_report': 'ad_report_test.csv'}, 'operations': operations,
+                    'return': ['ad_report']}
+
+        limited = best_selling_item_payload()
+        limited['operations'] = [{'dataset': 'ad_report', 'operation_name': 'limit', 'operation_args': {'value': 3}}]
+        self.payloads = [
+            best_selling_item_payload(),
+            aggregate({'column_name': 'clicks', 'op': '>', 'value': 1000}, ['asin'],
+                      [{'column': 'sales', 'aggregation': 'sum'}, {'column': 'date', 'aggregation': 'first'}]),
+            aggregate({'column_name': 'asin', 'op': '==', 'value': 'ASIN1'}, ['keyword_id'],
+                      [{'column': 'ad_spend', 'aggregation': 'max'}, {'aggregation': 'acos'}]),
+            aggregate(None, [], [{'column': 'impressions', 'aggregation': 'count'}]),
+            limited,
+            best_selling_item_payload(),
+        ]
+
+    def test_matches_handle_request(self):
+        for columnar in (False, True):
+            api = DatasetAPI(columnar=columnar)
+            self.assertListEqual(api.handle_batch(self.payloads),
+                                 [api.handle_request(payload) for payload in self.payloads])
+        api = DatasetAPI(registry=DatasetRegistry())
+        self.assertListEqual(api.handle_batch(self.payloads[:2]),
+                             [api.handle_request(payload) for payload in self.payloads[:2]])
+
+    def test_run_size(self):
+        payloads = self.payloads + [{
+            'datasets': {'ad_report': 'ad_report_test.csv'},
+            'operations': [{'dataset': 'ad_report', 'operation_name': 'sort_by_desc',
+                            'operation_args': {'column_name': 'sales'}}],
+            'return': ['ad_report']
+        }]
+        expected = [DatasetAPI().handle_request(payload) for payload in payloads]
+        runs = []
+        run = SharedScan.run
+        from_sorted = Dataset.from_sorted.__func__
+        sorted_on_disk = []
+
+        def spy_run(shared_scan, *args, **kwargs):
+            runs.append(shared_scan.csv_path)
+            run(shared_scan, *args, **kwargs)
+
+        def spy_from_sorted(cls, *args, **kwargs):
+            sorted_on_disk.append(args[0])
+            return from_sorted(cls, *args, **kwargs)
+
+        SharedScan.run = spy_run
+        Dataset.from_sorted = classmethod(spy_from_sorted)
+        try:
+            # csvs larger than spill_bytes are sorted on disk by each request rather than loaded by a shared scan
+            self.assertListEqual(DatasetAPI(run_size=2, spill_bytes=0).handle_batch(payloads), expected)
+            self.assertListEqual(runs, [])
+            self.assertListEqual(sorted_on_disk, ['ad_report'])
+
+            # smaller ones are shared as usual, each read when the first request that needs it runs
+            self.assertListEqual(DatasetAPI(run_size=2).handle_batch(payloads), expected)
+            self.assertListEqual(runs, ['ad_report_test.csv', 'product_report_test.csv'])
+            self.assertListEqual(sorted_on_disk, ['ad_report'])
+        finally:
+            SharedScan.run = run
+            Dataset.from_sorted = classmethod(from_sorted)
+
+    def test_one_scan_per_csv(self):
+        api = DatasetAPI()
+        plans = [plan for payload in self.payloads for plan in api.build_plans(payload).values()]
+        scans = shared_scans(plans)
+        self.assertSetEqual({csv_path for csv_path, _ in scans}, {'ad_report_test.csv', 'product_report_test.csv'})
+        ad_report = scans[('ad_report_test.csv', 'None')]
+        # the limited scan is loaded, the rest are aggregated as they are read, and the repeated request only once
+        self.assertEqual(len(ad_report._scans), 1)
+        self.assertEqual(len(ad_report._aggregates), 4)
+
+    def test_metrics_and_release(self):
+        exporter = PrometheusExporter()
+        released = []
+        release = SharedScan.release
+
+        def spy(shared_scan, node):
+            self.assertIn(result_key(node), shared_scan._results)
+            released.append(result_key(node))
+            release(shared_scan, node)
+
+        SharedScan.release = spy
+        try:
+            results = DatasetAPI(metrics=exporter).handle_batch(self.payloads)
+        finally:
+            SharedScan.release = release
+        self.assertListEqual(results, [DatasetAPI().handle_request(payload) for payload in self.payloads])
+        # each request is recorded, and each shared result released once
+        self.assertEqual(exporter.requests, len(self.payloads))
+        self.assertEqual(len(released), len(set(released)))
+        self.assertEqual(len(released), 6)